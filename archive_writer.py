@@ -0,0 +1,145 @@
+"""
+Xenial guide archive writer
+===========================
+
+This module contains the low-level writer of the guide archive members which zipfile has no public API for: members
+whose data are prepared outside of the ZipFile (compressed in parallel worker threads or copied still compressed from
+a previous archive), members stored with their data aligned (the local header is padded by an extra field, as zipalign
+does it, so the data can be memory mapped right from the archive) and stored members rewritten in place once their
+content is known (the index of random access layout archives). The writer appends the local header and the member
+data to the archive and registers the member for the central directory, which ZipFile writes on close, the same way
+ZipFile.write does it. It relies on
+internals of zipfile (ZipFile.fp, start_dir, filelist and NameToInfo), so it is used only with the Python versions it
+is known to work with (ARCHIVE_WRITER_PYTHON_VERSIONS); with other versions the packers fall back to the public
+zipfile API, which compresses the members one by one in the archive writing thread.
+
+Modules API and guide format is experimental and highly unstable.
+"""
+
+import lzma
+import struct
+import sys
+import zlib
+from zipfile import ZipInfo, ZIP_DEFLATED, ZIP_LZMA, ZIP_STORED
+
+ARCHIVE_WRITER_PYTHON_VERSIONS = ((3, 8), (3, 13))  # oldest and newest Python versions with the relied on internals
+ARCHIVE_WRITER_CHUNK_SIZE = 1024 * 1024
+ALIGNMENT_EXTRA_ID = 0xD935  # id of the extra field padding local headers of aligned members (as zipalign)
+
+LZMA_ZIP_VERSION = (9, 4)  # version of the LZMA SDK in the header of LZMA members (as zipfile writes it)
+LZMA_PRESETS_DICT_SIZES = (1 << 18, 1 << 20, 1 << 21, 1 << 22, 1 << 22, 1 << 23, 1 << 23, 1 << 24, 1 << 25, 1 << 26)
+LZMA_LC, LZMA_LP, LZMA_PB = 3, 0, 2  # literal context bits, literal position bits and position bits of all presets
+
+
+class ArchiveWriter:
+    @staticmethod
+    def supported():
+        """ Public method which returns whether members prepared outside of the ZipFile can be written with the
+            zipfile of the running Python version """
+
+        oldest_version, newest_version = ARCHIVE_WRITER_PYTHON_VERSIONS
+        return oldest_version <= sys.version_info[:2] <= newest_version
+
+    @staticmethod
+    def compressor(compression, compresslevel):
+        """ Public method which returns compressor of the zip member data of the compression (ZIP_DEFLATED or
+            ZIP_LZMA) and level (preset of ZIP_LZMA) together with the header the member data start with """
+
+        if compression == ZIP_DEFLATED:
+            return zlib.compressobj(compresslevel, zlib.DEFLATED, -15), b''
+        if compression == ZIP_LZMA:
+            # raw LZMA1 stream preceded by its properties, the format of LZMA members of zip archives
+            dict_size = LZMA_PRESETS_DICT_SIZES[compresslevel]
+            props = struct.pack('<BI', (LZMA_PB * 5 + LZMA_LP) * 9 + LZMA_LC, dict_size)
+            compressor = lzma.LZMACompressor(lzma.FORMAT_RAW, filters=[{
+                'id': lzma.FILTER_LZMA1, 'preset': compresslevel, 'dict_size': dict_size,
+                'lc': LZMA_LC, 'lp': LZMA_LP, 'pb': LZMA_PB,
+            }])
+            return compressor, struct.pack('<BBH', *LZMA_ZIP_VERSION, len(props)) + props
+        raise ValueError('Provided an archive compression of unknown type.')
+
+    @classmethod
+    def write_member(cls, zipf, zinfo, data_file, alignment=None):
+        """ Public method which appends member of the info (with CRC, sizes and compression set) and compress_size
+            bytes of its data, read from the data file, to the archive opened for writing; with alignment, the data
+            start at a multiple of it (the local header is padded by an extra field, the central directory record is
+            written without it) """
+
+        cls._check_writable(zipf)
+        zipf.fp.seek(zipf.start_dir)
+        zinfo.header_offset = zipf.fp.tell()
+        if alignment is None:
+            zipf.fp.write(zinfo.FileHeader())
+        else:
+            extra = zinfo.extra
+            padding = -(zinfo.header_offset + len(zinfo.FileHeader()) + 6) % alignment
+            zinfo.extra += struct.pack('<HHH', ALIGNMENT_EXTRA_ID, 2 + padding, alignment) + bytes(padding)
+            zipf.fp.write(zinfo.FileHeader())
+            zinfo.extra = extra
+        cls._copy_data(data_file, zipf.fp, zinfo.compress_size)
+        cls._register_member(zipf, zinfo)
+
+    @classmethod
+    def rewrite_member(cls, zipf, zinfo, data):
+        """ Public method which rewrites data of a stored member (written without alignment) by data of the same
+            size, e.g. of a member reserved before its content is known; the CRC of the member is updated """
+
+        cls._check_writable(zipf)
+        if zinfo.compress_type != ZIP_STORED or len(data) != zinfo.file_size:
+            raise ValueError('Provided member data which do not fit the stored member.')
+        zinfo.CRC = zlib.crc32(data)
+        zipf.fp.seek(zinfo.header_offset)
+        zipf.fp.write(zinfo.FileHeader())
+        zipf.fp.write(data)
+        zipf.fp.seek(zipf.start_dir)
+
+    @classmethod
+    def copy_member(cls, zipf, previous_archive_file, previous_zinfo):
+        """ Public method which copies member of the previous archive (opened for reading as the previous archive
+            file), still compressed, into the archive opened for writing """
+
+        zinfo = ZipInfo(previous_zinfo.filename, previous_zinfo.date_time)
+        zinfo.compress_type = previous_zinfo.compress_type
+        zinfo.flag_bits = previous_zinfo.flag_bits & 0x02  # keep only the lzma end of stream marker flag
+        zinfo.external_attr = previous_zinfo.external_attr
+        zinfo.CRC = previous_zinfo.CRC
+        zinfo.file_size = previous_zinfo.file_size
+        zinfo.compress_size = previous_zinfo.compress_size
+
+        previous_archive_file.seek(previous_zinfo.header_offset)
+        local_header = previous_archive_file.read(30)
+        filename_length, extra_length = struct.unpack('<HH', local_header[26:30])
+        previous_archive_file.seek(previous_zinfo.header_offset + 30 + filename_length + extra_length)
+        cls.write_member(zipf, zinfo, previous_archive_file)
+
+    @classmethod
+    def _check_writable(cls, zipf):
+        """ Private method which checks that the archive can be written by the writer right now """
+
+        if not cls.supported():
+            raise RuntimeError('Archive writer does not support zipfile of this Python version.')
+        if zipf.mode not in ('w', 'x') or zipf.fp is None:
+            raise ValueError('Provided an archive which is not open for writing.')
+        if zipf._writing:
+            raise ValueError('Provided an archive with another member being written.')
+
+    @staticmethod
+    def _copy_data(data_file, archive_file, size):
+        """ Private method which copies size bytes of the data file into the archive file """
+
+        remaining_size = size
+        while remaining_size > 0:
+            chunk = data_file.read(min(ARCHIVE_WRITER_CHUNK_SIZE, remaining_size))
+            if not chunk:
+                raise ValueError('Provided a member data file shorter than the member compress size.')
+            archive_file.write(chunk)
+            remaining_size -= len(chunk)
+
+    @staticmethod
+    def _register_member(zipf, zinfo):
+        """ Private method which registers the written member for the central directory, as ZipFile does it when
+            a member written through ZipFile.open is closed """
+
+        zipf.start_dir = zipf.fp.tell()
+        zipf.filelist.append(zinfo)
+        zipf.NameToInfo[zinfo.filename] = zinfo
@@ -0,0 +1,462 @@
+"""
+Xenial guides asynchronous builder
+==================================
+
+This module contains class for generating and packing a dummy guide in a single asyncio pipeline whose stages overlap
+instead of running one after another:
+- articles are generated (their icons and media linked into the guide tmp directory) in a thread and handed over one
+  by one through a bounded queue,
+- every distinct media file is hashed, probed by an ffprobe subprocess and, if it is a video, its covers are extracted
+  by an ffmpeg subprocess as soon as the first article using it arrives (at most media_concurrency of them at once),
+- rows of an article are queued, once its media are probed, to a single writer task owning the guide.db connection,
+- archive members (icons, media and covers) are compressed and written into the archive as soon as they are final,
+  guide.json and guide.db last.
+Wall time of a build is thus close to the time of its slowest stage rather than to the sum of the stages times.
+Media are archived as they are in the walk layout; transcoding, incremental packaging, delta packages and the random
+access layout are provided by GuidePackager.pack. Run as a script, e.g.:
+
+    python async_build.py berlin --seed 1 --num-articles 1000
+
+Modules API and guide format is experimental and highly unstable.
+"""
+
+import argparse
+import asyncio
+from asyncio.subprocess import PIPE
+from concurrent.futures import ThreadPoolExecutor
+import ffmpeg
+import json
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import threading
+from zipfile import ZipFile, ZIP_DEFLATED, ZIP_LZMA, ZIP_STORED
+
+from archive_writer import ArchiveWriter
+import guide_generator
+from guide_catalog import GuideCatalog
+from guide_generator import GuideGenerator, GuideSize
+from guide_packager import GuidePackager, ARCHIVE_COMPRESSION, ARCHIVE_COMPRESSION_NAMES, ARCHIVE_COMPRESSLEVEL, \
+    ARCHIVE_MAX_WORKERS, ARCHIVE_STORED_EXTENSIONS, CATALOG, DB_PAGE_SIZE, DIST_PATH, MARKUP_SPANS, SEARCH_INDEX, \
+    VIDEO_COVER_SEEK_FRACTION
+from media_cache import MediaCache, MEDIA_CACHE_PATH
+from pack_metrics import PackMetrics
+from text_backend import TEXT_BACKEND
+
+ASYNC_MEDIA_CONCURRENCY = os.cpu_count() or 4  # media hashed, probed and covers extracted at once
+ASYNC_ARTICLES_QUEUE_SIZE = 64  # generated articles waiting for the pipeline, a full queue holds the generator back
+ASYNC_ARTICLES_IN_FLIGHT = 256  # articles waiting for their media, more articles are not taken from the queue
+
+
+class AsyncGuideBuilder:
+    @classmethod
+    def build(cls, guide_name, guide_size=None, text_backend=TEXT_BACKEND, media_cache_path=MEDIA_CACHE_PATH,
+              media_concurrency=ASYNC_MEDIA_CONCURRENCY, archive_compression=ARCHIVE_COMPRESSION,
+              archive_compresslevel=ARCHIVE_COMPRESSLEVEL, search_index=SEARCH_INDEX, db_page_size=DB_PAGE_SIZE,
+              catalog=CATALOG, progress=None, markup_spans=MARKUP_SPANS):
+        """ Public method which generates dummy guide and packs it into the guide archive in the asyncio pipeline
+            (see the module description) and returns report like GuidePackager.pack: guide.db size before and after
+            the finalization, errors of the videos whose covers failed to be extracted, unresolved refs and metrics of
+            the run, whose stages overlap; with markup_spans, the parsed spans of the block texts are stored too.
+            Media metadata and covers are cached in media_cache_path (None disables the cache).
+            Article ids follow the guide content order, as in GuidePackager.pack, so refs are resolved before the
+            referenced articles are generated. """
+
+        if search_index not in ('fts4', 'fts5'):
+            raise ValueError('Provided a search index of unknown type.')
+        if db_page_size not in [2 ** exponent for exponent in range(9, 17)]:
+            raise ValueError('Provided a page size of unsupported value.')
+        if archive_compression not in (ZIP_DEFLATED, ZIP_LZMA):
+            raise ValueError('Provided an archive compression of unsupported type.')
+        return asyncio.run(cls._build(guide_name, guide_size, text_backend, media_cache_path, media_concurrency,
+                                      archive_compression, archive_compresslevel, search_index, db_page_size,
+                                      catalog, markup_spans, PackMetrics(guide_name, progress)))
+
+    @classmethod
+    async def _build(cls, guide_name, guide_size, text_backend, media_cache_path, media_concurrency,
+                     archive_compression, archive_compresslevel, search_index, db_page_size, catalog, markup_spans,
+                     metrics):
+        loop = asyncio.get_running_loop()
+        with metrics.stage('build'):
+            with metrics.stage('generate_guide'):
+                guide_path, guide = await loop.run_in_executor(None, GuideGenerator.generate_guide, guide_name,
+                                                               guide_size, True, text_backend)
+            articles_queue = asyncio.Queue(ASYNC_ARTICLES_QUEUE_SIZE)
+            rows_queue = asyncio.Queue()  # holds at most rows of the articles in flight
+            members_queue = asyncio.Queue()
+            generation_stopped = threading.Event()
+            generate_task = asyncio.create_task(cls._generate_articles(guide, articles_queue, generation_stopped,
+                                                                       metrics))
+            db_task = asyncio.create_task(cls._write_db(guide_path, rows_queue, search_index, markup_spans, metrics))
+            archive_task = asyncio.create_task(cls._write_archive(guide_name, members_queue, archive_compression,
+                                                                  archive_compresslevel, metrics))
+            # the media cache connection is used only by this one thread, its queries (which wait for the cache
+            # database locked by concurrent packers) and file copies do not block the event loop
+            cache_executor = ThreadPoolExecutor(max_workers=1)
+            media = {'sources': {}, 'archived_sources': {}, 'probes': {}, 'hashes': {}, 'covers_failures': {},
+                     'transcode_failures': {},
+                     'cache_conn': await loop.run_in_executor(cache_executor, MediaCache.connect, media_cache_path)
+                     if media_cache_path is not None else None,
+                     'cache_path': media_cache_path, 'cache_executor': cache_executor}
+            media_tasks = {}
+            articles_tasks = []
+            unresolved_refs = {}
+            try:
+                members_queue.put_nowait((os.path.join(guide_path, guide.guide_icon), guide.guide_icon))
+                archived_paths = {guide.guide_icon}
+
+                tables_rows = GuidePackager._empty_tables_rows(markup_spans)
+                tags_ids = {}
+                categories = [category.to_dict() for category in guide.categories]
+                GuidePackager._append_categories_rows(tables_rows, tags_ids, guide_name, categories)
+                for category in categories:
+                    if category['icon'] not in archived_paths:
+                        members_queue.put_nowait((os.path.join(guide_path, category['icon']), category['icon']))
+                        archived_paths.add(category['icon'])
+                rows_queue.put_nowait(tables_rows)
+
+                articles_dicts = {article_name: [article_id, None]
+                                  for article_id, (article_name, article_title) in enumerate(guide.guide_content,
+                                                                                             start=1)}
+                blocks_next_ids = {f'{block_type}_blocks': 1
+                                   for block_type in ('subtitle', 'paragraph', 'image', 'audio', 'video')}
+                previous_article_queued = asyncio.Event()  # blocks ids are assigned in the articles order
+                previous_article_queued.set()
+                semaphore = asyncio.Semaphore(media_concurrency)
+                articles_in_flight = asyncio.Semaphore(ASYNC_ARTICLES_IN_FLIGHT)
+                while True:
+                    article = await articles_queue.get()
+                    if article is None:
+                        break
+                    await articles_in_flight.acquire()
+                    article = article.to_dict()
+                    if article['name'] not in articles_dicts:
+                        raise RuntimeError('Generated article is missing in the guide content.')
+                    article_id = articles_dicts[article['name']][0]
+                    tables_rows = GuidePackager._empty_tables_rows(markup_spans)
+                    GuidePackager._append_article_rows(tables_rows, tags_ids, guide_name, article_id, article)
+                    if article['icon'] not in archived_paths:
+                        members_queue.put_nowait((os.path.join(guide_path, article['icon']), article['icon']))
+                        archived_paths.add(article['icon'])
+                    for block in article['content']:
+                        if block['type'] in ('image', 'audio', 'video') and block['source'] not in media_tasks:
+                            media_tasks[block['source']] = asyncio.create_task(cls._prepare_media(
+                                guide_path, block['source'], block['type'], media, semaphore, members_queue,
+                                metrics))
+                    article_queued = asyncio.Event()
+                    articles_tasks.append(asyncio.create_task(cls._queue_article_blocks(
+                        guide_name, guide_path, article_id, article['content'], tables_rows, blocks_next_ids,
+                        articles_dicts, media, media_tasks, markup_spans, unresolved_refs, rows_queue,
+                        articles_in_flight, previous_article_queued, article_queued)))
+                    previous_article_queued = article_queued
+                await cls._wait_for([generate_task] + articles_tasks, [db_task, archive_task])
+                metrics.count('media', 'distinct', len(media_tasks))
+                metrics.count('media', 'video_covers_failures', len(media['covers_failures']))
+                metrics.count('refs', 'unresolved', sum(unresolved_refs.values()))
+
+                tables_rows = GuidePackager._empty_tables_rows(markup_spans)
+                GuidePackager._append_bookmarks_rows(tables_rows, articles_dicts,
+                                                     [bookmark.to_dict() for bookmark in guide.bookmarks])
+                rows_queue.put_nowait(tables_rows)
+                rows_queue.put_nowait(None)
+                await cls._wait_for([db_task], [archive_task])
+                with metrics.stage('finalize_db'):
+                    report = await loop.run_in_executor(None, GuidePackager._finalize_guide_db, guide_path,
+                                                        db_page_size)
+                guide.export_json(guide_path, with_sources=False)
+                members_queue.put_nowait((os.path.join(guide_path, 'guide.json'), 'guide.json'))
+                members_queue.put_nowait((os.path.join(guide_path, 'guide.db'), 'guide.db'))
+                members_queue.put_nowait(None)
+                archive_tmp_path = await archive_task
+                archive_path = os.path.join(DIST_PATH, f'{guide_name}.zip')
+                os.replace(archive_tmp_path, archive_path)
+            except BaseException:
+                generation_stopped.set()
+                while not generate_task.done():  # unblock the generator waiting for the full queue
+                    while not articles_queue.empty():
+                        articles_queue.get_nowait()
+                    await asyncio.wait([generate_task], timeout=0.1)
+                for task in [db_task, archive_task] + articles_tasks + list(media_tasks.values()):
+                    task.cancel()
+                await asyncio.gather(generate_task, db_task, archive_task, *articles_tasks, *media_tasks.values(),
+                                     return_exceptions=True)
+                raise
+            finally:
+                report_media = await loop.run_in_executor(cache_executor, GuidePackager._close_articles_media, media)
+                cache_executor.shutdown()
+                # Delete temporary guide directory when finished, also after a failure (when a cancelled writer thread
+                # may still be finishing with it)
+                shutil.rmtree(guide_path, ignore_errors=True)
+            if catalog:
+                with metrics.stage('catalog'):
+                    GuideCatalog.update(archive_path)
+        report.update(report_media)
+        report['unresolved_refs'] = unresolved_refs
+        report['metrics'] = metrics.to_dict()
+        return report
+
+    @staticmethod
+    async def _wait_for(tasks, running_tasks):
+        """ Private method which waits for the tasks to finish; an error of any of them, or of the running tasks
+            (which are not waited for), is raised as soon as it occurs """
+
+        while not all(task.done() for task in tasks):
+            done, pending = await asyncio.wait([task for task in tasks + running_tasks if not task.done()],
+                                               return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    raise task.exception()
+        for task in tasks:
+            task.result()
+
+    @staticmethod
+    async def _generate_articles(guide, articles_queue, generation_stopped, metrics):
+        """ Private method (task) which generates the guide articles in a thread and puts them into the queue one by
+            one, None after the last one; the generation stops early when generation_stopped is set """
+
+        loop = asyncio.get_running_loop()
+
+        def generate():
+            try:
+                for article in guide.articles:
+                    if generation_stopped.is_set():
+                        return
+                    asyncio.run_coroutine_threadsafe(articles_queue.put(article), loop).result()
+            finally:
+                if not generation_stopped.is_set():
+                    asyncio.run_coroutine_threadsafe(articles_queue.put(None), loop).result()
+
+        with metrics.stage('generate_articles'):
+            await loop.run_in_executor(None, generate)
+
+    @classmethod
+    async def _prepare_media(cls, guide_path, source, media_type, media, semaphore, members_queue, metrics):
+        """ Private method (task) which hashes and probes the media file and extracts covers of the video (probes
+            and covers are taken from the media cache if present) and queues the final files to the archive; generated
+            guides name media files by their content hash, so no two sources have the same payload """
+
+        media_path = os.path.join(guide_path, source)
+        cache_conn = media['cache_conn']
+        loop = asyncio.get_running_loop()
+        async with semaphore:
+            media_hash = await loop.run_in_executor(None, MediaCache.hash_file, media_path)
+        media['hashes'][source] = media_hash
+        media['sources'][source] = media['archived_sources'][source] = source
+        members_queue.put_nowait((media_path, source))
+
+        probe = (await loop.run_in_executor(media['cache_executor'], MediaCache.fetch_probes, cache_conn,
+                                            {media_hash})).get(media_hash) if cache_conn is not None else None
+        if probe is None:
+            async with semaphore:
+                probe = await cls._probe_media_file(media_path)
+            metrics.count('probes', 'run')
+            if cache_conn is not None:
+                await loop.run_in_executor(media['cache_executor'], MediaCache.store_probe, cache_conn, media_hash,
+                                           probe)
+        else:
+            metrics.count('probes', 'cached')
+        media['probes'][source] = probe
+        if media_type != 'video':
+            return
+
+        covers_variant = GuidePackager._video_covers_variant()
+        covers_filenames = GuidePackager._video_covers_filenames(source)
+        covers_paths = [os.path.join(guide_path, cover_filename) for cover_filename in covers_filenames]
+        cached_covers_paths = await loop.run_in_executor(media['cache_executor'], MediaCache.fetch_derived,
+                                                         cache_conn, media_hash, covers_variant) \
+            if cache_conn is not None else None
+        if cached_covers_paths is not None:
+            for cached_cover_path, cover_path in zip(cached_covers_paths, covers_paths):
+                await loop.run_in_executor(None, shutil.copy, cached_cover_path, cover_path)
+        else:
+            seek_time = float(probe['format'].get('duration', 0)) * VIDEO_COVER_SEEK_FRACTION
+            async with semaphore:
+                error = await cls._extract_video_cover_files(media_path, covers_paths, seek_time)
+            if error is not None:
+                media['covers_failures'][source] = error
+                for cover_path in covers_paths:
+                    if os.path.exists(cover_path):
+                        os.remove(cover_path)
+                return
+            if cache_conn is not None:
+                await loop.run_in_executor(media['cache_executor'], MediaCache.store_derived, cache_conn,
+                                           media['cache_path'], media_hash, covers_variant, covers_paths)
+        for cover_path, cover_filename in zip(covers_paths, covers_filenames):
+            members_queue.put_nowait((cover_path, cover_filename))
+
+    @staticmethod
+    async def _probe_media_file(media_path):
+        """ Private method which probes the media file by an ffprobe subprocess (with the arguments of ffmpeg.probe)
+            and returns the probe """
+
+        process = await asyncio.create_subprocess_exec('ffprobe', '-show_format', '-show_streams', '-of', 'json',
+                                                       media_path, stdout=PIPE, stderr=PIPE)
+        out, err = await process.communicate()
+        if process.returncode != 0:
+            raise ffmpeg.Error('ffprobe', out, err)
+        return json.loads(out.decode('utf-8'))
+
+    @staticmethod
+    async def _extract_video_cover_files(in_videofile_path, out_imagefiles_paths, seek_time):
+        """ Private method which extracts the video cover and its thumbnails by an ffmpeg subprocess (see
+            GuidePackager._extract_video_cover_files); returns an error message on failure, None otherwise """
+
+        args = GuidePackager._video_cover_outputs(in_videofile_path, out_imagefiles_paths, seek_time).get_args()
+        try:
+            process = await asyncio.create_subprocess_exec('ffmpeg', *args, stdout=PIPE, stderr=PIPE)
+        except OSError as e:  # ffmpeg is not installed
+            return str(e)
+        out, err = await process.communicate()
+        if process.returncode != 0:
+            stderr_lines = err.decode('utf8', 'replace').strip().splitlines()
+            return stderr_lines[-1] if stderr_lines else f'ffmpeg exited with code {process.returncode}'
+        return None
+
+    @staticmethod
+    async def _queue_article_blocks(guide_name, guide_path, article_id, article_content, tables_rows,
+                                    blocks_next_ids, articles_dicts, media, media_tasks, markup_spans,
+                                    unresolved_refs, rows_queue, articles_in_flight, previous_article_queued,
+                                    article_queued):
+        """ Private method (task) which waits for the media of the article, appends its content blocks rows to its
+            rows and queues them to the guide.db writer once rows of the previous article are queued (so the blocks
+            get the ids GuidePackager.pack assigns); ids of the blocks are taken from blocks_next_ids and its
+            unresolved refs are counted in unresolved_refs """
+
+        try:
+            await asyncio.gather(*[media_tasks[block['source']] for block in article_content
+                                   if block['type'] in ('image', 'audio', 'video')])
+            await previous_article_queued.wait()
+            GuidePackager._append_articles_blocks_rows(tables_rows, dict(blocks_next_ids), guide_name, guide_path,
+                                                       articles_dicts, [(article_id, article_content)], media,
+                                                       markup_spans, unresolved_refs)
+            for table_name in blocks_next_ids:
+                blocks_next_ids[table_name] += len(tables_rows[table_name])
+            rows_queue.put_nowait(tables_rows)
+            article_queued.set()
+        finally:
+            articles_in_flight.release()
+
+    @classmethod
+    async def _write_db(cls, guide_path, rows_queue, search_index, markup_spans, metrics):
+        """ Private method (task) which owns guide.db connection, used only by its single worker thread: it creates
+            the tables, inserts the queued rows (dicts of rows keyed by the table name) as they come until None is
+            queued and then builds the full-text table (from the collected rows), query indexes and statistics """
+
+        loop = asyncio.get_running_loop()
+        with ThreadPoolExecutor(max_workers=1) as db_executor:
+            conn = await loop.run_in_executor(db_executor, cls._open_db, guide_path, search_index, markup_spans)
+            try:
+                with metrics.stage('db_writes'):
+                    search_rows = []
+                    while True:
+                        tables_rows = await rows_queue.get()
+                        if tables_rows is None:
+                            break
+                        search_rows += tables_rows.pop('article_block_search')
+                        await loop.run_in_executor(db_executor, cls._insert_rows, conn, tables_rows)
+                        for table_name, rows in tables_rows.items():
+                            metrics.count('rows_inserted', table_name, len(rows))
+                    metrics.count('rows_inserted', 'article_block_search', len(search_rows))
+                with metrics.stage('search_index'):
+                    await loop.run_in_executor(db_executor, cls._fill_search_index, conn, search_rows)
+                with metrics.stage('index_and_analyze'):
+                    await loop.run_in_executor(db_executor, GuidePackager._create_query_indexes_and_analyze, conn)
+            finally:
+                await loop.run_in_executor(db_executor, conn.close)
+
+    @staticmethod
+    def _open_db(guide_path, search_index, markup_spans):
+        conn = sqlite3.connect(os.path.join(guide_path, 'guide.db'))
+        GuidePackager._set_bulk_load_pragmas(conn)
+        GuidePackager._create_guide_tables(conn, search_index, markup_spans)
+        return conn
+
+    @staticmethod
+    def _insert_rows(conn, tables_rows):
+        for table_name, rows in tables_rows.items():
+            if rows:
+                GuidePackager._insert_many_into(conn, table_name, rows)
+
+    @staticmethod
+    def _fill_search_index(conn, search_rows):
+        GuidePackager._fill_article_block_search_table_with_rows(conn, search_rows)
+        conn.commit()
+        GuidePackager._optimize_article_block_search_table(conn)
+
+    @classmethod
+    async def _write_archive(cls, guide_name, members_queue, archive_compression, archive_compresslevel, metrics):
+        """ Private method (task) which writes the queued members (pairs of file path and archive name) into
+            a temporary archive in the dist directory as they come until None is queued and returns its path;
+            already compressed media are stored, other members are compressed in parallel, the archive is written by
+            a single worker thread in order of the members completion """
+
+        loop = asyncio.get_running_loop()
+        archive_fd, archive_tmp_path = tempfile.mkstemp(suffix='.zip.part', dir=DIST_PATH)
+        try:
+            with os.fdopen(archive_fd, 'wb') as archive_file, ZipFile(archive_file, 'w') as zipf, \
+                    ThreadPoolExecutor(max_workers=ARCHIVE_MAX_WORKERS) as compress_executor, \
+                    ThreadPoolExecutor(max_workers=1) as write_executor:
+                with metrics.stage('archive'):
+                    members_writes = []
+                    while True:
+                        member = await members_queue.get()
+                        if member is None:
+                            break
+                        members_writes.append(asyncio.create_task(cls._write_archive_member(
+                            zipf, *member, archive_compression, archive_compresslevel, compress_executor,
+                            write_executor)))
+                    await asyncio.gather(*members_writes)
+                for zinfo in zipf.infolist():
+                    metrics.count('archive_bytes', ARCHIVE_COMPRESSION_NAMES[zinfo.compress_type], zinfo.compress_size)
+                    metrics.count('archive_members', ARCHIVE_COMPRESSION_NAMES[zinfo.compress_type])
+            os.chmod(archive_tmp_path, 0o644)  # mkstemp creates files readable only by the owner
+        except BaseException:
+            os.remove(archive_tmp_path)
+            raise
+        return archive_tmp_path
+
+    @staticmethod
+    async def _write_archive_member(zipf, file_path, arcname, archive_compression, archive_compresslevel,
+                                    compress_executor, write_executor):
+        loop = asyncio.get_running_loop()
+        if os.path.splitext(arcname)[1].lower() in ARCHIVE_STORED_EXTENSIONS:
+            await loop.run_in_executor(write_executor, lambda: zipf.write(file_path, arcname,
+                                                                          compress_type=ZIP_STORED))
+            return
+        if not ArchiveWriter.supported():  # compressed by zipfile in the writing thread
+            await loop.run_in_executor(write_executor, lambda: zipf.write(file_path, arcname,
+                                                                          compress_type=archive_compression,
+                                                                          compresslevel=archive_compresslevel))
+            return
+        zinfo, compressed_file = await loop.run_in_executor(compress_executor, GuidePackager._compress_archive_member,
+                                                            file_path, arcname, archive_compression,
+                                                            archive_compresslevel)
+        await loop.run_in_executor(write_executor, GuidePackager._write_compressed_archive_member, zipf, zinfo,
+                                   compressed_file)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate and pack a xenial dummy guide in an asyncio pipeline.')
+    parser.add_argument('guide_name', nargs='?', default='dummy', help='name of the guide')
+    parser.add_argument('--seed', type=int, help='seed of the guide content')
+    parser.add_argument('--num-articles', type=int, help='number of articles of the guide')
+    parser.add_argument('--text-backend', choices=['numpy', 'faker'], default=TEXT_BACKEND,
+                        help='synthesizer of the guide texts')
+    parser.add_argument('--media-concurrency', type=int, default=ASYNC_MEDIA_CONCURRENCY,
+                        help='number of media processed at once')
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+        guide_generator.fake.seed_instance(args.seed)
+    size = GuideSize()
+    if args.num_articles is not None:
+        size.min_num_articles = size.max_num_articles = args.num_articles
+    build_report = AsyncGuideBuilder.build(args.guide_name.lower().replace(' ', '_'), size, args.text_backend,
+                                           media_concurrency=args.media_concurrency)
+    print(f"{args.guide_name}: built in {build_report['metrics']['stages']['build']:.2f} s, guide.db finalized from "
+          f"{build_report['db_size_before']} to {build_report['db_size_after']} bytes")
+    for stage, stage_time in build_report['metrics']['stages'].items():
+        print(f'    {stage}: {stage_time:.2f} s')
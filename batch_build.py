@@ -0,0 +1,171 @@
+"""
+Xenial guides batch builder
+===========================
+
+This module contains class for generating and packing many dummy guides in parallel, each guide in its own worker
+process and its own tmp directory. Run as a script, e.g.:
+
+    python batch_build.py --count 300 --workers 8
+    python batch_build.py --names berlin athens --seeds 1 2
+    python batch_build.py --count 3 --archive-size-mib 100
+
+Modules API and guide format is experimental and highly unstable.
+"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import json
+import random
+import sys
+import time
+
+import guide_generator
+from async_build import AsyncGuideBuilder
+from guide_generator import GuideGenerator, GuideSize
+from guide_packager import GuidePackager, ARCHIVE_LAYOUT
+from media_transcoder import TRANSCODE_PROFILE, TRANSCODE_PROFILES
+from pack_metrics import PackMetrics
+from text_backend import TEXT_BACKEND
+
+BATCH_GUIDE_NAME_PREFIX = 'dummy'
+BATCH_MAX_WORKERS = None  # None means the number of CPUs
+
+
+class GuideBatchBuilder:
+    @classmethod
+    def build(cls, guides_names, seeds=None, guide_size=None, text_backend=TEXT_BACKEND, max_workers=BATCH_MAX_WORKERS,
+              progress=None, transcode_profile=TRANSCODE_PROFILE, archive_layout=ARCHIVE_LAYOUT, async_pipeline=False):
+        """ Public method which generates and packs given guides concurrently on a process pool and returns list of
+            per-guide reports (guide name, seed, generate and pack timings, guide.db sizes and error, if any) in the
+            guides order; a seed makes content of the guide reproducible, guide_size (GuideSize) sets size of every
+            guide, text_backend synthesizes its texts, media are transcoded for transcode_profile, archives are
+            written in archive_layout (see GuidePackager.pack) and progress is called with each report as it
+            completes. With async_pipeline, every guide is generated and packed in the asyncio pipeline (see
+            AsyncGuideBuilder.build, which does not transcode media and writes archives in walk layout), whose
+            report has the build time instead of the generate and pack timings """
+
+        guides_names = list(guides_names)
+        if len(set(guides_names)) != len(guides_names):
+            raise ValueError('Provided guides names are not unique.')
+        seeds = list(seeds) if seeds is not None else [None] * len(guides_names)
+        if len(seeds) != len(guides_names):
+            raise ValueError('Provided a different number of seeds than guides names.')
+
+        if async_pipeline and (transcode_profile is not None or archive_layout != 'walk'):
+            raise ValueError('Provided options are not supported by the asyncio pipeline.')
+
+        reports = {}
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(cls._build_guide, guide_name, seed, guide_size, text_backend, transcode_profile,
+                                       archive_layout, async_pipeline)
+                       for guide_name, seed in zip(guides_names, seeds)]
+            for future in as_completed(futures):
+                report = future.result()
+                reports[report['guide_name']] = report
+                if progress is not None:
+                    progress(report)
+        return [reports[guide_name] for guide_name in guides_names]
+
+    @staticmethod
+    def guides_names(count, prefix=BATCH_GUIDE_NAME_PREFIX):
+        """ Public method which returns count of numbered guides names with given prefix """
+
+        return [f'{prefix}_{number:0{len(str(count))}d}' for number in range(1, count + 1)]
+
+    @staticmethod
+    def _build_guide(guide_name, seed, guide_size, text_backend, transcode_profile, archive_layout, async_pipeline):
+        """ Private method which generates and packs a single guide in a worker process; guides have distinct
+            names, so each one is generated into its own tmp directory and packed into its own archive """
+
+        report = {'guide_name': guide_name, 'seed': seed, 'generate_time': None, 'pack_time': None, 'build_time': None,
+                  'db_size_before': None, 'db_size_after': None, 'error': None}
+        if seed is not None:
+            random.seed(seed)
+            guide_generator.fake.seed_instance(seed)
+        try:
+            if async_pipeline:
+                start_time = time.perf_counter()
+                report.update(AsyncGuideBuilder.build(guide_name, guide_size, text_backend))
+                report['build_time'] = time.perf_counter() - start_time
+                return report
+
+            start_time = time.perf_counter()
+            guide_path, guide = GuideGenerator.generate_guide(guide_name, guide_size, text_backend=text_backend)
+            report['generate_time'] = time.perf_counter() - start_time
+
+            start_time = time.perf_counter()
+            report.update(GuidePackager.pack(guide_name, guide_path, guide=guide, transcode_profile=transcode_profile,
+                                             archive_layout=archive_layout))
+            report['pack_time'] = time.perf_counter() - start_time
+        except Exception as e:
+            report['error'] = f'{type(e).__name__}: {e}'
+        return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate and pack many xenial dummy guides in parallel.')
+    names_group = parser.add_mutually_exclusive_group(required=True)
+    names_group.add_argument('--names', nargs='+', help='names of the guides to build')
+    names_group.add_argument('--count', type=int, help='number of guides to build with numbered names')
+    parser.add_argument('--prefix', default=BATCH_GUIDE_NAME_PREFIX, help='prefix of the numbered guides names')
+    seeds_group = parser.add_mutually_exclusive_group()
+    seeds_group.add_argument('--seeds', nargs='+', type=int, help='seed of each guide, in the guides order')
+    seeds_group.add_argument('--base-seed', type=int, help='seed of the first guide, following guides get next ones')
+    parser.add_argument('--num-articles', type=int, help='number of articles of every guide')
+    parser.add_argument('--max-article-blocks', type=int, help='maximal number of content blocks of an article')
+    parser.add_argument('--archive-size-mib', type=float,
+                        help='size of every guide archive in MiB (media are picked and articles added to reach it)')
+    parser.add_argument('--text-backend', choices=['numpy', 'faker'], default=TEXT_BACKEND,
+                        help='synthesizer of the guides texts')
+    parser.add_argument('--transcode-profile', choices=sorted(TRANSCODE_PROFILES), default=TRANSCODE_PROFILE,
+                        help='target devices profile the guides media are transcoded for')
+    parser.add_argument('--archive-layout', choices=['walk', 'random_access'], default=ARCHIVE_LAYOUT,
+                        help='order and compression of the guides archives members')
+    parser.add_argument('--async-pipeline', action='store_true',
+                        help='generate and pack every guide in the asyncio pipeline (see async_build.py)')
+    parser.add_argument('--workers', type=int, default=BATCH_MAX_WORKERS, help='number of worker processes')
+    parser.add_argument('--report', help='path of a JSON file to write the per-guide reports into')
+    parser.add_argument('--metrics', help='path of a JSON lines file to append the per-guide packaging metrics to')
+    args = parser.parse_args()
+
+    names = [name.lower().replace(' ', '_') for name in args.names] if args.names \
+        else GuideBatchBuilder.guides_names(args.count, args.prefix)
+    guides_seeds = args.seeds
+    if args.base_seed is not None:
+        guides_seeds = [args.base_seed + index for index in range(len(names))]
+
+    def print_report(report):
+        if args.metrics and report.get('metrics') is not None:
+            with open(args.metrics, 'a') as f:
+                f.write(PackMetrics.json_line(report['metrics']))
+        if report['error'] is not None:
+            print(f"{report['guide_name']}: FAILED ({report['error']})", flush=True)
+        elif report['build_time'] is not None:
+            print(f"{report['guide_name']}: built in {report['build_time']:.2f} s, "
+                  f"guide.db {report['db_size_after']} bytes", flush=True)
+        else:
+            print(f"{report['guide_name']}: generated in {report['generate_time']:.2f} s, "
+                  f"packed in {report['pack_time']:.2f} s, guide.db {report['db_size_after']} bytes", flush=True)
+
+    size = GuideSize()
+    if args.num_articles is not None:
+        size.min_num_articles = size.max_num_articles = args.num_articles
+    if args.max_article_blocks is not None:
+        size.max_num_article_content_items = args.max_article_blocks
+    if args.archive_size_mib is not None:
+        size.archive_size = int(args.archive_size_mib * 1024 ** 2)
+
+    if args.async_pipeline and (args.transcode_profile is not None or args.archive_layout != 'walk'):
+        parser.error('--async-pipeline supports neither --transcode-profile nor --archive-layout random_access')
+
+    batch_start_time = time.perf_counter()
+    guides_reports = GuideBatchBuilder.build(names, guides_seeds, size, args.text_backend, args.workers, print_report,
+                                             args.transcode_profile, args.archive_layout, args.async_pipeline)
+    num_failed = sum(report['error'] is not None for report in guides_reports)
+    print(f'Built {len(guides_reports) - num_failed} of {len(guides_reports)} guides '
+          f'in {time.perf_counter() - batch_start_time:.2f} s.')
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(guides_reports, f, indent=4)
+    sys.exit(1 if num_failed else 0)
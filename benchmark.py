@@ -0,0 +1,223 @@
+"""
+Xenial pipeline benchmark
+=========================
+
+This module contains class for benchmarking the dummy guides generate and pack pipeline at several guide sizes
+(numbers of articles). Every run generates and packs a seeded guide in a fresh worker process with the media cache
+disabled, records times of the generation and packaging stages (as timed by the generator and the packager, see
+pack_metrics.py), peak RSS of the worker (and of its ffmpeg subprocesses) and sizes of the packed archive. The JSON
+report can be compared against a baseline report of a previous run, e.g.:
+
+    python benchmark.py --sizes 10 100 1000 --output benchmark.json
+    python benchmark.py --sizes 10 100 1000 --baseline benchmark.json
+
+Runs offline, needs only ffmpeg (ffmpeg and ffprobe binaries) installed.
+
+Modules API and guide format is experimental and highly unstable.
+"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import sqlite3
+import sys
+import time
+from zipfile import ZipFile
+
+import guide_generator
+from guide_generator import GuideGenerator, GuideSize
+from guide_packager import GuidePackager, DIST_PATH
+from pack_metrics import PackMetrics
+from text_backend import TEXT_BACKEND
+
+BENCHMARK_SIZES = (10, 100, 1000, 10000)  # numbers of articles of the benchmarked guides
+BENCHMARK_SEED = 1
+BENCHMARK_REPEATS = 1  # runs of every size, the report keeps the minimum of every measurement
+BENCHMARK_GUIDE_NAME_PREFIX = 'benchmark'
+BENCHMARK_REPORT_VERSION = 2  # stages of version 1 reports were timed by the benchmark itself
+
+BENCHMARK_REGRESSION_THRESHOLD = 1.25  # measurements this many times the baseline ones are regressions
+BENCHMARK_MIN_TIME_DELTA = 0.05  # seconds, smaller slowdowns are treated as noise
+
+
+class PipelineBenchmark:
+    @classmethod
+    def run(cls, sizes=BENCHMARK_SIZES, seed=BENCHMARK_SEED, repeats=BENCHMARK_REPEATS, text_backend=TEXT_BACKEND,
+            progress=None, streaming=False):
+        """ Public method which benchmarks the pipeline for guides of given sizes (numbers of articles) and returns
+            the report; every size is run repeats times, each run in a fresh worker process, and progress is called
+            with each size's measurements as they complete. With streaming, articles are generated as they are
+            consumed (their generation is timed in the pack time and in the generation stages) and packed in the
+            streaming mode (see GuidePackager.pack), whose peak RSS does not grow with the guide content.
+            Workers are forked by the forkserver: a spawned worker is forked from this process before it executes
+            python again and its peak RSS would not be lower than the RSS of this process """
+
+        report = {'version': BENCHMARK_REPORT_VERSION,
+                  'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                  'environment': cls._environment(),
+                  'seed': seed,
+                  'text_backend': text_backend,
+                  'streaming': streaming,
+                  'runs': []}
+        for num_articles in sizes:
+            runs = []
+            for _ in range(repeats):
+                with ProcessPoolExecutor(max_workers=1,
+                                         mp_context=multiprocessing.get_context('forkserver')) as executor:
+                    runs.append(executor.submit(cls._run_size, num_articles, seed, text_backend,
+                                                streaming).result())
+            size_run = cls._minimum_of_runs(runs)
+            report['runs'].append(size_run)
+            if progress is not None:
+                progress(size_run)
+        return report
+
+    @staticmethod
+    def compare(report, baseline, threshold=BENCHMARK_REGRESSION_THRESHOLD, min_time_delta=BENCHMARK_MIN_TIME_DELTA):
+        """ Public method which compares measurements of the report with the baseline report of the same sizes and
+            returns list of regressions (size, measurement, baseline and current value), measurements above threshold
+            times the baseline ones (times also by more than min_time_delta seconds) """
+
+        if baseline.get('version') != report['version']:
+            raise ValueError('Provided a baseline report of another version.')
+        baseline_runs = {run['num_articles']: run for run in baseline['runs']}
+        regressions = []
+        for run in report['runs']:
+            baseline_run = baseline_runs.get(run['num_articles'])
+            if baseline_run is None:
+                continue
+            measurements = {name: run[name] for name in ('generate_time', 'pack_time', 'peak_rss_kib', 'archive_size',
+                                                         'db_size')}
+            measurements.update({f'stages.{stage}': stage_time for stage, stage_time in run['stages'].items()})
+            for name, value in measurements.items():
+                if name.startswith('stages.'):
+                    baseline_value = baseline_run['stages'].get(name[len('stages.'):])
+                else:
+                    baseline_value = baseline_run.get(name)
+                if baseline_value is None or value <= baseline_value * threshold:
+                    continue
+                if name.endswith('_time') or name.startswith('stages.'):
+                    if value - baseline_value <= min_time_delta:
+                        continue
+                regressions.append((run['num_articles'], name, baseline_value, value))
+        return regressions
+
+    @classmethod
+    def _run_size(cls, num_articles, seed, text_backend, streaming):
+        """ Private method which generates and packs a single guide of num_articles articles in a worker process and
+            returns its measurements; the media cache is disabled, so every media file is probed (and covers
+            extracted) as in the first packaging of a guide """
+
+        guide_name = f'{BENCHMARK_GUIDE_NAME_PREFIX}_{num_articles}'
+        guide_size = GuideSize(min_num_articles=num_articles, max_num_articles=num_articles)
+        random.seed(seed)
+        guide_generator.fake.seed_instance(seed)
+
+        generate_metrics = PackMetrics(guide_name)
+        start_time = time.perf_counter()
+        guide_path, guide = GuideGenerator.generate_guide(guide_name, guide_size, stream=streaming,
+                                                          text_backend=text_backend, metrics=generate_metrics)
+        generate_time = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        pack_report = GuidePackager.pack(guide_name, guide_path, media_cache_path=None, guide=guide,
+                                         catalog=False, streaming=streaming)
+        pack_time = time.perf_counter() - start_time
+
+        archive_path = os.path.join(DIST_PATH, f'{guide_name}.zip')
+        with ZipFile(archive_path, 'r') as zipf:
+            media_size = sum(zinfo.file_size for zinfo in zipf.infolist() if zinfo.filename.startswith('media/'))
+            num_members = len(zipf.infolist())
+        archive_size = os.path.getsize(archive_path)
+        os.remove(archive_path)
+        return {
+            'num_articles': num_articles,
+            'generate_time': generate_time,
+            'pack_time': pack_time,
+            'stages': {**generate_metrics.to_dict()['stages'], **pack_report['metrics']['stages']},
+            'peak_rss_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'peak_children_rss_kib': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+            'archive_size': archive_size,
+            'db_size': pack_report['db_size_after'],
+            'media_size': media_size,
+            'num_members': num_members,
+            'video_covers_failures': len(pack_report['video_covers_failures']),
+            'pack_counters': pack_report['metrics']['counters'],
+        }
+
+    @staticmethod
+    def _minimum_of_runs(runs):
+        """ Private method which merges repeated runs of a size into one keeping the minimum of every measurement
+            (the least disturbed by other load of the machine) """
+
+        size_run = dict(runs[0])
+        for name, value in runs[0].items():
+            if name == 'stages':
+                size_run['stages'] = {stage: min(run['stages'][stage] for run in runs) for stage in value}
+            elif isinstance(value, (int, float)):
+                size_run[name] = min(run[name] for run in runs)
+        size_run['repeats'] = len(runs)
+        return size_run
+
+    @staticmethod
+    def _environment():
+        """ Private method which describes the machine the benchmark runs on, baselines are comparable only between
+            runs on the same one """
+
+        return {
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'ffmpeg': shutil.which('ffmpeg'),
+            'ffprobe': shutil.which('ffprobe'),
+        }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark generating and packing xenial dummy guides.')
+    parser.add_argument('--sizes', nargs='+', type=int, default=list(BENCHMARK_SIZES),
+                        help='numbers of articles of the benchmarked guides')
+    parser.add_argument('--seed', type=int, default=BENCHMARK_SEED, help='seed of the benchmarked guides')
+    parser.add_argument('--repeats', type=int, default=BENCHMARK_REPEATS, help='runs of every size')
+    parser.add_argument('--text-backend', choices=['numpy', 'faker'], default=TEXT_BACKEND,
+                        help='synthesizer of the guides texts')
+    parser.add_argument('--streaming', action='store_true',
+                        help='generate articles as they are consumed and pack them in the streaming mode')
+    parser.add_argument('--output', help='path of a JSON file to write the report into')
+    parser.add_argument('--baseline', help='path of a JSON report of a previous run to compare the report with')
+    parser.add_argument('--threshold', type=float, default=BENCHMARK_REGRESSION_THRESHOLD,
+                        help='ratio to the baseline above which a measurement is a regression')
+    args = parser.parse_args()
+
+    missing_binaries = [binary for binary in ('ffmpeg', 'ffprobe') if shutil.which(binary) is None]
+    if missing_binaries:
+        print(f'Benchmark needs {" and ".join(missing_binaries)} installed.')
+        sys.exit(2)
+
+    def print_run(size_run):
+        stages = ', '.join(f'{stage} {stage_time:.2f} s' for stage, stage_time in size_run['stages'].items())
+        print(f"{size_run['num_articles']} articles: generated in {size_run['generate_time']:.2f} s, "
+              f"packed in {size_run['pack_time']:.2f} s ({stages}), peak RSS {size_run['peak_rss_kib']} KiB, "
+              f"archive {size_run['archive_size']} bytes, guide.db {size_run['db_size']} bytes", flush=True)
+
+    benchmark_report = PipelineBenchmark.run(args.sizes, args.seed, args.repeats, args.text_backend, print_run,
+                                             args.streaming)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(benchmark_report, f, indent=4)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline_report = json.load(f)
+        found_regressions = PipelineBenchmark.compare(benchmark_report, baseline_report, args.threshold)
+        for size, measurement, baseline_value, value in found_regressions:
+            print(f'REGRESSION {size} articles: {measurement} {baseline_value:.6g} -> {value:.6g}')
+        print(f'{len(found_regressions)} regressions against {args.baseline}.')
+        sys.exit(1 if found_regressions else 0)
@@ -0,0 +1,324 @@
+"""
+Xenial guide archive reader
+===========================
+
+This module contains class for reading guide archives without extracting them: the guide description is parsed from
+guide.json and guide.db is loaded from the archive bytes into an in-memory sqlite database, which can be queried right
+away. Consistency checks of the archives (media and icons sources present in the archive, article refs resolved, link
+graph matching the refs, full-text index rows matching the articles and their blocks, guide content articles present)
+run for many archives in parallel on a process pool. Query plans of the app's reference queries show whether guide.db
+indexes serve them: a plan scanning a whole table or sorting in a temporary b-tree is a regression. Run as a script to
+check archives (or all guide archives in directories), or to print query plans of their reference queries, e.g.:
+
+    python guide_archive.py dist/dummy --workers 8
+    python guide_archive.py dist/dummy/dummy.zip --query-plans
+
+Modules API and guide format is experimental and highly unstable.
+"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import json
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+from zipfile import ZipFile
+
+from guide_packager import DIST_PATH
+
+ARCHIVE_CHECK_MAX_WORKERS = None  # None means the number of CPUs
+ARCHIVE_DELTA_SUFFIX = '.delta.zip'  # delta packages (see guide_delta.py) beside the archives are not guide archives
+
+SEARCH_TABLE_NAME = 'article_block_search'
+REF_PATTERN = re.compile(r'\[ref=(.*?)\]')
+
+# the app's reference queries, their plans are checked by GuideArchive.explain_query_plans()
+QUERY_PLAN_QUERIES = {
+    'blocks of article': """ SELECT block_id, block_type FROM articles_blocks
+                             WHERE article_id=1 ORDER BY block_order; """,
+    'articles with tag': """ SELECT a.id, a.name, a.title FROM tags_articles AS ta
+                             JOIN articles AS a ON a.id=ta.article_id
+                             WHERE ta.tag_id=1; """,
+    'tags of article': """ SELECT t.id, t.name FROM tags_articles AS ta
+                           JOIN tags AS t ON t.id=ta.tag_id
+                           WHERE ta.article_id=1; """,
+    'tags of category': """ SELECT t.id, t.name FROM tags_categories AS tc
+                            JOIN tags AS t ON t.id=tc.tag_id
+                            WHERE tc.category_id=1; """,
+    'articles linking to article': """ SELECT a.id, a.name, a.title FROM article_links AS al
+                                       JOIN articles AS a ON a.id=al.source_article_id
+                                       WHERE al.target_article_id=1 GROUP BY al.source_article_id; """,
+    'articles linked from article': """ SELECT a.id, a.name, a.title FROM article_links AS al
+                                        JOIN articles AS a ON a.id=al.target_article_id
+                                        WHERE al.source_article_id=1 GROUP BY al.target_article_id; """,
+}
+
+
+class GuideArchive:
+    """ Guide archive opened for reading: guide holds the parsed guide.json, conn an in-memory sqlite connection to
+        guide.db; close it (or use it as a context manager) when done """
+
+    def __init__(self, archive_path):
+        self.archive_path = archive_path
+        self.zipf = ZipFile(archive_path, 'r')
+        try:
+            self.guide = json.loads(self.zipf.read('guide.json'))
+            self.conn = self._load_db(self.zipf.read('guide.db'))
+        except BaseException:
+            self.zipf.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """ Public method which closes the in-memory database and the archive """
+
+        self.conn.close()
+        self.zipf.close()
+
+    def members(self):
+        """ Public method which returns set of names of the archive members """
+
+        return set(self.zipf.NameToInfo)
+
+    def read(self, member):
+        """ Public method which returns (uncompressed) data of the archive member """
+
+        return self.zipf.read(member)
+
+    def member_of_source(self, source):
+        """ Public method which returns name of the archive member a guide.db source path refers to, or None when
+            the path is outside of the guide """
+
+        guide_source_path = f"guides/{self.guide['guide_name']}/"
+        if source is None or not source.replace(os.sep, '/').startswith(guide_source_path):
+            return None
+        return source.replace(os.sep, '/')[len(guide_source_path):]
+
+    def check(self):
+        """ Public method which runs the consistency checks of the archive and returns list of found issues """
+
+        return self._check_sources() + self._check_refs() + self._check_article_links() + self._check_search_index() \
+            + self._check_guide_content()
+
+    def explain_query_plans(self):
+        """ Public method which returns EXPLAIN QUERY PLAN details of the app's reference queries on guide.db keyed by
+            the query name """
+
+        cur = self.conn.cursor()
+        plans = {}
+        for query_name, query in QUERY_PLAN_QUERIES.items():
+            cur.execute(""" EXPLAIN QUERY PLAN {query} """.format(query=query))
+            plans[query_name] = [row[-1] for row in cur.fetchall()]
+        return plans
+
+    @staticmethod
+    def query_plan_regression(plan):
+        """ Public method which returns whether the query plan (its details) scans a whole table or sorts in
+            a temporary b-tree """
+
+        return any(detail.startswith('SCAN') or 'TEMP B-TREE' in detail for detail in plan)
+
+    @classmethod
+    def check_archives(cls, archive_paths, max_workers=ARCHIVE_CHECK_MAX_WORKERS):
+        """ Public method which checks archives in parallel on a process pool and returns lists of their issues keyed
+            by the archive path, in the given order; an archive which cannot be opened has the error as its issue """
+
+        archive_paths = list(archive_paths)
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            return dict(zip(archive_paths, executor.map(cls._check_archive, archive_paths, chunksize=4)))
+
+    @staticmethod
+    def archives_paths(paths):
+        """ Public method which returns paths of the guide archives given by paths of archives or directories, whose
+            zip archives are listed (sorted; delta packages and empty placeholders, e.g. dist/dummy/empty.zip, are
+            left out) """
+
+        archive_paths = []
+        for path in paths:
+            if os.path.isdir(path):
+                archive_paths += [os.path.join(path, filename) for filename in sorted(os.listdir(path))
+                                  if filename.endswith('.zip') and not filename.endswith(ARCHIVE_DELTA_SUFFIX)
+                                  and os.path.getsize(os.path.join(path, filename)) > 0]
+            else:
+                archive_paths.append(path)
+        return archive_paths
+
+    @classmethod
+    def _check_archive(cls, archive_path):
+        try:
+            with cls(archive_path) as archive:
+                return archive.check()
+        except Exception as e:
+            return [f'cannot be read ({type(e).__name__}: {e})']
+
+    @staticmethod
+    def _load_db(db_data):
+        """ Private method which loads guide.db data into an in-memory database; sqlite3 without deserialize (Python
+            before 3.11) loads it through a temporary file """
+
+        conn = sqlite3.connect(':memory:')
+        if hasattr(conn, 'deserialize'):
+            conn.deserialize(db_data)
+            return conn
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with open(os.path.join(tmp_dir, 'guide.db'), 'wb') as f:
+                f.write(db_data)
+            file_conn = sqlite3.connect(os.path.join(tmp_dir, 'guide.db'))
+            file_conn.backup(conn)
+            file_conn.close()
+        return conn
+
+    def _content_tables_columns(self):
+        """ Private method which returns columns of the tables keyed by the table name; full-text tables and their
+            shadow tables are left out """
+
+        cur = self.conn.cursor()
+        cur.execute(""" SELECT name, sql FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%'; """)
+        tables = cur.fetchall()
+        virtual_names = [name for name, sql in tables if sql.upper().startswith('CREATE VIRTUAL TABLE')]
+        tables_columns = {}
+        for name, sql in tables:
+            if name in virtual_names or any(name.startswith(virtual_name + '_') for virtual_name in virtual_names):
+                continue
+            tables_columns[name] = [row[1] for row in cur.execute(""" PRAGMA table_info({table}); """.format(
+                table=name)).fetchall()]
+        return tables_columns
+
+    def _check_sources(self):
+        """ Private method which checks that every *_source (and icon) path of guide.db refers to a member of the
+            archive """
+
+        members = self.members()
+        issues = []
+        if self.guide.get('guide_icon') not in members:
+            issues.append(f"guide.json guide_icon: missing member {self.guide.get('guide_icon')}")
+        cur = self.conn.cursor()
+        for table_name, columns in self._content_tables_columns().items():
+            for column in columns:
+                if not column.endswith('_source') and column != 'icon':
+                    continue
+                cur.execute(""" SELECT id, {column} FROM {table} WHERE {column} IS NOT NULL; """.format(
+                    column=column, table=table_name))
+                for row_id, source in cur.fetchall():
+                    member = self.member_of_source(source)
+                    if member is None:
+                        issues.append(f'{table_name}.{column} {row_id}: path outside of the guide {source}')
+                    elif member not in members:
+                        issues.append(f'{table_name}.{column} {row_id}: missing member {member}')
+        return issues
+
+    def _check_refs(self):
+        """ Private method which checks that every [ref=N] markup of the texts refers to an article of the guide """
+
+        cur = self.conn.cursor()
+        articles_ids = {str(row[0]) for row in cur.execute(""" SELECT id FROM articles; """).fetchall()}
+        issues = []
+        for table_name, columns in self._content_tables_columns().items():
+            for column in columns:
+                if not column.endswith('_text'):
+                    continue
+                cur.execute(""" SELECT id, {column} FROM {table} WHERE {column} LIKE '%[ref=%'; """.format(
+                    column=column, table=table_name))
+                for row_id, text in cur.fetchall():
+                    for ref in REF_PATTERN.findall(text):
+                        if ref not in articles_ids:
+                            issues.append(f"{table_name}.{column} {row_id}: unresolved ref '{ref}'")
+        return issues
+
+    def _check_article_links(self):
+        """ Private method which checks that the article_links table holds a row of every block and article it
+            refers to by the [ref=N] markup of the block texts, and no other rows """
+
+        cur = self.conn.cursor()
+        cur.execute(""" SELECT count(*) FROM sqlite_master WHERE name='article_links'; """)
+        if cur.fetchone()[0] == 0:
+            return ['article_links: missing table']
+        articles_ids = {row[0] for row in cur.execute(""" SELECT id FROM articles; """).fetchall()}
+        blocks_articles = {(block_type, block_id): article_id for article_id, block_type, block_id in cur.execute(
+            """ SELECT article_id, block_type, block_id FROM articles_blocks; """).fetchall()}
+        expected_links = set()
+        for table_name, columns in self._content_tables_columns().items():
+            if not table_name.endswith('_blocks') or table_name == 'articles_blocks':
+                continue
+            block_type = table_name[:-len('_blocks')]
+            for column in columns:
+                if not column.endswith('_text'):
+                    continue
+                cur.execute(""" SELECT id, {column} FROM {table} WHERE {column} LIKE '%[ref=%'; """.format(
+                    column=column, table=table_name))
+                for block_id, text in cur.fetchall():
+                    for ref in REF_PATTERN.findall(text):
+                        if ref.isdigit() and int(ref) in articles_ids and (block_type, block_id) in blocks_articles:
+                            expected_links.add((blocks_articles[(block_type, block_id)], int(ref), block_type,
+                                                block_id))
+        links = set(cur.execute(""" SELECT source_article_id, target_article_id, block_type, block_id
+                                    FROM article_links; """).fetchall())
+        issues = [f'article_links: missing link of {block_type} block {block_id} to article {target_article_id}'
+                  for source_article_id, target_article_id, block_type, block_id in sorted(expected_links - links)]
+        issues += [f'article_links: stale link of {block_type} block {block_id} to article {target_article_id}'
+                   for source_article_id, target_article_id, block_type, block_id in sorted(links - expected_links)]
+        return issues
+
+    def _check_search_index(self):
+        """ Private method which checks that the full-text table holds a row of the title and the synopsis of every
+            article and a row of every content block, counted per block type """
+
+        cur = self.conn.cursor()
+        cur.execute(""" SELECT count(*) FROM sqlite_master WHERE name=?; """, (SEARCH_TABLE_NAME,))
+        if cur.fetchone()[0] == 0:
+            return [f'{SEARCH_TABLE_NAME}: missing table']
+        num_articles = cur.execute(""" SELECT count(*) FROM articles; """).fetchone()[0]
+        expected_counts = {'title': num_articles, 'synopsis': num_articles}
+        expected_counts.update(cur.execute(""" SELECT block_type, count(*) FROM articles_blocks
+                                               GROUP BY block_type; """).fetchall())
+        search_counts = dict(cur.execute(""" SELECT block_type, count(*) FROM {table}
+                                             GROUP BY block_type; """.format(table=SEARCH_TABLE_NAME)).fetchall())
+        return [f'{SEARCH_TABLE_NAME}: {search_counts.get(block_type, 0)} rows of {block_type} blocks, '
+                f'{expected_counts.get(block_type, 0)} expected'
+                for block_type in sorted(set(expected_counts) | set(search_counts))
+                if search_counts.get(block_type, 0) != expected_counts.get(block_type, 0)]
+
+    def _check_guide_content(self):
+        """ Private method which checks that every article listed in guide.json guide content is in guide.db """
+
+        cur = self.conn.cursor()
+        articles_names = {row[0] for row in cur.execute(""" SELECT name FROM articles; """).fetchall()}
+        return [f"guide.json guide_content: missing article '{article_item[0]}'"
+                for article_item in self.guide.get('guide_content', []) if article_item[0] not in articles_names]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check consistency of xenial guides archives.')
+    parser.add_argument('paths', nargs='*', default=[DIST_PATH], help='guide archives or directories of them')
+    parser.add_argument('--workers', type=int, default=ARCHIVE_CHECK_MAX_WORKERS, help='number of worker processes')
+    parser.add_argument('--query-plans', action='store_true',
+                        help='print query plans of the app\'s reference queries instead of the checks')
+    args = parser.parse_args()
+
+    if args.query_plans:
+        num_regressions = 0
+        for path in GuideArchive.archives_paths(args.paths):
+            with GuideArchive(path) as archive:
+                for query_name, query_plan in archive.explain_query_plans().items():
+                    query_regression = GuideArchive.query_plan_regression(query_plan)
+                    num_regressions += query_regression
+                    print(f'{path}: {query_name}{" (REGRESSION)" if query_regression else ""}')
+                    for detail in query_plan:
+                        print(f'    {detail}')
+        sys.exit(1 if num_regressions else 0)
+
+    archives_issues = GuideArchive.check_archives(GuideArchive.archives_paths(args.paths), args.workers)
+    for path, archive_issues in archives_issues.items():
+        print(f'{path}: {"OK" if not archive_issues else f"{len(archive_issues)} issues"}')
+        for issue in archive_issues:
+            print(f'    {issue}')
+    num_failed = sum(bool(archive_issues) for archive_issues in archives_issues.values())
+    print(f'{len(archives_issues) - num_failed} of {len(archives_issues)} archives passed the checks.')
+    sys.exit(1 if num_failed else 0)
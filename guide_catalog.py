@@ -0,0 +1,183 @@
+"""
+Xenial guides catalog
+=====================
+
+This module contains class maintaining the catalog of the guide archives in a dist directory: a compact JSON file
+(_catalog.json_ beside the archives) with an entry of every archive holding its guide.json fields (guide name, format
+version, title, language, from and to places) and the archive size, sha256 hash, number of members and mtime. Guides
+can be listed and searched by reading this one small file instead of opening every archive. GuidePackager.pack
+updates the catalog entry of every archive it publishes; updates are serialized by a lock file and the catalog is
+replaced atomically, so readers never see it half written. Run as a script to rebuild the catalog of a dist directory
+(entries of unchanged archives are kept) or to search it, e.g.:
+
+    python guide_catalog.py dist/dummy
+    python guide_catalog.py dist/dummy --lang en --to-place Spain
+
+Modules API and guide format is experimental and highly unstable.
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import tempfile
+from zipfile import ZipFile
+
+from media_cache import MediaCache
+
+try:
+    import fcntl
+except ImportError:  # no advisory locks (e.g. on Windows), concurrent updates of the catalog are not serialized
+    fcntl = None
+
+CATALOG_FILENAME = 'catalog.json'
+CATALOG_LOCK_FILENAME = '.catalog.lock'
+CATALOG_VERSION = 1
+CATALOG_GUIDE_FIELDS = ('guide_name', 'guide_format_version', 'guide_title', 'guide_lang', 'guide_from_place',
+                        'guide_to_place')
+CATALOG_SKIPPED_SUFFIXES = ('.delta.zip',)  # delta packages beside the archives are not guide archives
+
+
+class GuideCatalog:
+    @classmethod
+    def update(cls, archive_path):
+        """ Public method which adds (or replaces) the entry of the archive in the catalog of its directory and
+            returns the entry """
+
+        dist_path = os.path.dirname(archive_path)
+        with cls._locked(dist_path):
+            # read under the lock, so the entry is not of an archive replaced meanwhile by a concurrent packer
+            entry = cls._archive_entry(archive_path)
+            catalog = cls.load(dist_path)
+            catalog['archives'][os.path.basename(archive_path)] = entry
+            cls._save(dist_path, catalog)
+        return entry
+
+    @classmethod
+    def remove(cls, archive_path):
+        """ Public method which removes the entry of the archive from the catalog of its directory """
+
+        dist_path = os.path.dirname(archive_path)
+        with cls._locked(dist_path):
+            catalog = cls.load(dist_path)
+            if catalog['archives'].pop(os.path.basename(archive_path), None) is not None:
+                cls._save(dist_path, catalog)
+
+    @classmethod
+    def build(cls, dist_path):
+        """ Public method which rebuilds the catalog of the dist directory: entries of the archives whose size and
+            mtime did not change are kept, other archives are read again and entries of the removed archives are
+            dropped. Delta packages, kept base archives (.zip.base) and empty placeholders (e.g. dist/dummy/empty.zip)
+            are left out. Returns the catalog """
+
+        with cls._locked(dist_path):
+            previous_archives = cls.load(dist_path)['archives']
+            catalog = {'catalog_version': CATALOG_VERSION, 'archives': {}}
+            for filename in sorted(os.listdir(dist_path)):
+                archive_path = os.path.join(dist_path, filename)
+                if not filename.endswith('.zip') or filename.endswith(CATALOG_SKIPPED_SUFFIXES) \
+                        or not os.path.isfile(archive_path) or os.path.getsize(archive_path) == 0:
+                    continue
+                entry = previous_archives.get(filename)
+                stat = os.stat(archive_path)
+                if entry is None or entry['archive_size'] != stat.st_size or entry['archive_mtime'] != stat.st_mtime:
+                    entry = cls._archive_entry(archive_path)
+                catalog['archives'][filename] = entry
+            cls._save(dist_path, catalog)
+        return catalog
+
+    @staticmethod
+    def load(dist_path):
+        """ Public method which returns the catalog of the dist directory (empty if there is none yet) """
+
+        try:
+            with open(os.path.join(dist_path, CATALOG_FILENAME)) as f:
+                catalog = json.load(f)
+        except FileNotFoundError:
+            return {'catalog_version': CATALOG_VERSION, 'archives': {}}
+        if catalog.get('catalog_version') != CATALOG_VERSION:
+            raise ValueError('Provided a catalog of unsupported version.')
+        return catalog
+
+    @staticmethod
+    def search(catalog, guide_lang=None, guide_from_place=None, guide_to_place=None, title=None):
+        """ Public method which returns catalog entries of the guides in the language (name or code), from and to
+            the places (case insensitive) and with titles containing title (case insensitive), sorted by guide name """
+
+        entries = []
+        for entry in catalog['archives'].values():
+            if guide_lang is not None \
+                    and guide_lang.lower() not in [str(lang).lower() for lang in entry['guide_lang'] or ()]:
+                continue
+            if guide_from_place is not None and guide_from_place.lower() != str(entry['guide_from_place']).lower():
+                continue
+            if guide_to_place is not None and guide_to_place.lower() != str(entry['guide_to_place']).lower():
+                continue
+            if title is not None and title.lower() not in str(entry['guide_title']).lower():
+                continue
+            entries.append(entry)
+        return sorted(entries, key=lambda entry: entry['guide_name'])
+
+    @staticmethod
+    def _archive_entry(archive_path):
+        """ Private method which returns catalog entry of the archive: its guide.json fields, size, sha256 hash, number
+            of members and mtime """
+
+        stat = os.stat(archive_path)
+        archive_sha256 = MediaCache.hash_file(archive_path)
+        with ZipFile(archive_path, 'r') as zipf:
+            guide = json.loads(zipf.read('guide.json'))
+            num_members = len(zipf.infolist())
+        entry = {field: guide.get(field) for field in CATALOG_GUIDE_FIELDS}
+        entry.update(archive_name=os.path.basename(archive_path),
+                     archive_size=stat.st_size,
+                     archive_sha256=archive_sha256,
+                     archive_members=num_members,
+                     archive_mtime=stat.st_mtime)
+        return entry
+
+    @staticmethod
+    def _save(dist_path, catalog):
+        """ Private method which writes the catalog into a temporary file and replaces the catalog by it """
+
+        catalog_fd, catalog_tmp_path = tempfile.mkstemp(suffix='.json.part', dir=dist_path)
+        try:
+            with os.fdopen(catalog_fd, 'w') as f:
+                json.dump(catalog, f, separators=(',', ':'), sort_keys=True)
+            os.chmod(catalog_tmp_path, 0o644)  # mkstemp creates files readable only by the owner
+            os.replace(catalog_tmp_path, os.path.join(dist_path, CATALOG_FILENAME))
+        except BaseException:
+            os.remove(catalog_tmp_path)
+            raise
+
+    @staticmethod
+    @contextlib.contextmanager
+    def _locked(dist_path):
+        """ Private method (context manager) which holds the exclusive lock of the dist directory catalog """
+
+        with open(os.path.join(dist_path, CATALOG_LOCK_FILENAME), 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield  # closing the lock file releases the lock
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Rebuild or search catalog of xenial guides archives.')
+    parser.add_argument('dist_path', nargs='?', default=os.path.join('dist', 'dummy'), help='dist directory')
+    parser.add_argument('--lang', help='search guides in the language (name or code)')
+    parser.add_argument('--from-place', help='search guides from the place')
+    parser.add_argument('--to-place', help='search guides to the place')
+    parser.add_argument('--title', help='search guides with titles containing the text')
+    args = parser.parse_args()
+
+    if any(value is not None for value in (args.lang, args.from_place, args.to_place, args.title)):
+        found_entries = GuideCatalog.search(GuideCatalog.load(args.dist_path), args.lang, args.from_place,
+                                            args.to_place, args.title)
+        for found_entry in found_entries:
+            found_lang_code = found_entry['guide_lang'][1] if found_entry['guide_lang'] else None
+            print(f"{found_entry['archive_name']}: {found_entry['guide_title']} ({found_lang_code}, "
+                  f"{found_entry['guide_from_place']} -> {found_entry['guide_to_place']})")
+        print(f'{len(found_entries)} guides found.')
+    else:
+        built_catalog = GuideCatalog.build(args.dist_path)
+        print(f"{len(built_catalog['archives'])} archives in {os.path.join(args.dist_path, CATALOG_FILENAME)}.")
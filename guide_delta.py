@@ -0,0 +1,321 @@
+"""
+Xenial guides delta packages
+============================
+
+This module contains class for creating delta packages between two versions of a guide archive and for applying them
+to a guide extracted from the older archive (as the xenial app does). A delta package is a zip archive containing:
+- the delta manifest (_delta.json_) with sha256 hashes of the base and target archives and of every added, modified
+  and removed archive member, a list of the changed media and the way guide.db is updated,
+- the added and modified archive members (e.g. changed media) under their archive paths,
+- either SQL patch (_guide.sql_) updating guide.db of the base archive into guide.db of the target archive, or
+  the replacement guide.db, whichever is smaller compressed.
+Databases are compared by their content digest (sha256 of the schema and of all rows, see GuideDelta.db_digest), as
+a patched database has the same content as the target one, but not the same bytes. Run as a script, e.g.:
+
+    python guide_delta.py create dist/dummy/dummy.zip.base dist/dummy/dummy.zip
+    python guide_delta.py apply dist/dummy/dummy.0123456789ab.delta.zip guides/dummy
+
+Modules API and guide format is experimental and highly unstable.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import zlib
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED
+
+from media_cache import MediaCache, HASH_CHUNK_SIZE
+
+DELTA_FORMAT_VERSION = 1
+DELTA_MANIFEST_FILENAME = 'delta.json'
+DELTA_SQL_PATCH_FILENAME = 'guide.sql'
+DELTA_GUIDE_DB = 'auto'  # 'auto' (the smaller of the two), 'patch' or 'replace'; schema changes are always replaced
+
+
+class GuideDelta:
+    @classmethod
+    def create(cls, base_archive_path, archive_path, delta_path=None, guide_db=DELTA_GUIDE_DB):
+        """ Public method which writes delta package updating the guide of the base archive into the guide of
+            the archive; the package is written beside the archive and named after the guide and the base archive hash
+            unless delta_path is provided. Returns report with path and size of the package, number of the changed
+            members and the way guide.db is updated ('patch' or 'replace') """
+
+        if guide_db not in ('auto', 'patch', 'replace'):
+            raise ValueError('Provided a guide db update of unknown type.')
+        base_archive_sha256 = MediaCache.hash_file(base_archive_path)
+        if delta_path is None:
+            delta_path = f'{os.path.splitext(archive_path)[0]}.{base_archive_sha256[:12]}.delta.zip'
+
+        with ZipFile(base_archive_path, 'r') as base_zipf, ZipFile(archive_path, 'r') as zipf, \
+                tempfile.TemporaryDirectory() as tmp_dir:
+            base_members = cls._hash_members(base_zipf)
+            members = cls._hash_members(zipf)
+            added = {name: members[name] for name in sorted(set(members) - set(base_members))}
+            modified = {name: {'base_sha256': base_members[name], 'sha256': members[name]}
+                        for name in sorted(set(members) & set(base_members)) if members[name] != base_members[name]}
+            removed = {name: base_members[name] for name in sorted(set(base_members) - set(members))}
+
+            base_db_path = os.path.join(tmp_dir, 'base', 'guide.db')
+            db_path = os.path.join(tmp_dir, 'guide.db')
+            base_zipf.extract('guide.db', os.path.dirname(base_db_path))
+            zipf.extract('guide.db', tmp_dir)
+            db_update = cls._guide_db_update(base_db_path, db_path, guide_db)
+
+            manifest = {'version': DELTA_FORMAT_VERSION,
+                        'guide_name': json.loads(zipf.read('guide.json'))['guide_name'],
+                        'base_archive_sha256': base_archive_sha256,
+                        'archive_sha256': MediaCache.hash_file(archive_path),
+                        'files': {'added': added, 'modified': modified, 'removed': removed},
+                        'changed_media': sorted(name for name in list(added) + list(modified) + list(removed)
+                                                if name.startswith('media/')),
+                        'guide_db': {'mode': db_update['mode'],
+                                     'member': db_update['member'],
+                                     'sha256': hashlib.sha256(db_update['data']).hexdigest(),
+                                     'base_digest': cls.db_digest(base_db_path),
+                                     'digest': cls.db_digest(db_path)}}
+
+            delta_tmp_path = delta_path + '.part'
+            with ZipFile(delta_tmp_path, 'w') as delta_zipf:
+                delta_zipf.writestr(DELTA_MANIFEST_FILENAME, json.dumps(manifest, indent=4),
+                                    compress_type=ZIP_DEFLATED)
+                delta_zipf.writestr(db_update['member'], db_update['data'], compress_type=ZIP_DEFLATED)
+                for name in list(added) + list(modified):
+                    cls._copy_member(delta_zipf, zipf, name)
+            os.replace(delta_tmp_path, delta_path)
+        return {'delta_path': delta_path,
+                'delta_size': os.path.getsize(delta_path),
+                'delta_changed_members': len(added) + len(modified) + len(removed),
+                'delta_guide_db': db_update['mode']}
+
+    @classmethod
+    def apply(cls, delta_path, guide_path):
+        """ Public method which applies delta package to the guide extracted from the base archive into guide_path;
+            the guide is verified against the base hashes before it is updated and against the target hashes after,
+            a guide which does not match raises ValueError """
+
+        with ZipFile(delta_path, 'r') as delta_zipf:
+            manifest = json.loads(delta_zipf.read(DELTA_MANIFEST_FILENAME))
+            if manifest['version'] != DELTA_FORMAT_VERSION:
+                raise ValueError('Provided a delta of unsupported version.')
+            files = manifest['files']
+            db_path = os.path.join(guide_path, 'guide.db')
+            base_hashes = dict(files['removed'], **{name: hashes['base_sha256']
+                                                    for name, hashes in files['modified'].items()})
+            for name, base_sha256 in base_hashes.items():
+                if MediaCache.hash_file(os.path.join(guide_path, name)) != base_sha256:
+                    raise ValueError(f'Provided guide does not match the delta base ({name}).')
+            if cls.db_digest(db_path) != manifest['guide_db']['base_digest']:
+                raise ValueError('Provided guide does not match the delta base (guide.db).')
+
+            db_update = delta_zipf.read(manifest['guide_db']['member'])
+            if hashlib.sha256(db_update).hexdigest() != manifest['guide_db']['sha256']:
+                raise ValueError('Provided delta is corrupted (guide.db).')
+            db_tmp_path = db_path + '.part'
+            if manifest['guide_db']['mode'] == 'replace':
+                with open(db_tmp_path, 'wb') as f:
+                    f.write(db_update)
+            else:
+                shutil.copy(db_path, db_tmp_path)
+                conn = sqlite3.connect(db_tmp_path)
+                conn.executescript(db_update.decode('utf8'))
+                conn.close()
+            if cls.db_digest(db_tmp_path) != manifest['guide_db']['digest']:
+                os.remove(db_tmp_path)
+                raise ValueError('Provided delta does not produce the target guide.db.')
+
+            target_hashes = dict(files['added'], **{name: hashes['sha256']
+                                                    for name, hashes in files['modified'].items()})
+            for name, sha256 in target_hashes.items():
+                member_path = os.path.join(guide_path, name)
+                os.makedirs(os.path.dirname(member_path), exist_ok=True)
+                with delta_zipf.open(name) as member, open(member_path + '.part', 'wb') as f:
+                    shutil.copyfileobj(member, f, HASH_CHUNK_SIZE)
+                if MediaCache.hash_file(member_path + '.part') != sha256:
+                    os.remove(member_path + '.part')
+                    raise ValueError(f'Provided delta is corrupted ({name}).')
+                os.replace(member_path + '.part', member_path)
+            for name in files['removed']:
+                os.remove(os.path.join(guide_path, name))
+            os.replace(db_tmp_path, db_path)
+
+    @classmethod
+    def db_digest(cls, db_path):
+        """ Public method which returns sha256 hex digest of the database content: schema of its tables and indexes and
+            all rows (with rowids) of its tables in a defined order; sqlite internal tables (planner statistics
+            included) and shadow tables of the full-text tables are left out, as they are rebuilt by sqlite """
+
+        conn = sqlite3.connect(db_path)
+        sha256 = hashlib.sha256()
+        for name, sql in cls._fetchall_schema(conn):
+            sha256.update(f'{name}\n{sql}\n'.encode())
+        for table_name, is_rowid_table in cls._fetchall_content_tables(conn):
+            sha256.update(f'{table_name}\n'.encode())
+            for row in cls._fetchall_rows(conn, table_name, is_rowid_table):
+                sha256.update(f'{cls._sql_values(row)}\n'.encode())
+        conn.close()
+        return sha256.hexdigest()
+
+    @classmethod
+    def _guide_db_update(cls, base_db_path, db_path, guide_db):
+        """ Private method which returns the guide.db update: the SQL patch or the replacement database, whichever
+            is requested (by guide_db) or smaller compressed; a database of changed schema is always replaced """
+
+        with open(db_path, 'rb') as f:
+            replacement = {'mode': 'replace', 'member': 'guide.db', 'data': f.read()}
+        if guide_db == 'replace':
+            return replacement
+        patch_sql = cls._sql_patch(base_db_path, db_path)
+        if patch_sql is None:
+            return replacement
+        patch = {'mode': 'patch', 'member': DELTA_SQL_PATCH_FILENAME, 'data': patch_sql.encode('utf8')}
+        if guide_db == 'patch' or len(zlib.compress(patch['data'], 9)) <= len(zlib.compress(replacement['data'], 9)):
+            return patch
+        return replacement
+
+    @classmethod
+    def _sql_patch(cls, base_db_path, db_path):
+        """ Private method which returns SQL script updating rows of the base database into rows of the database
+            (deleting rows missing in the database and inserting rows missing in the base one), or None when their
+            schemas differ; full-text tables are updated through their rows (so their indexes are updated by sqlite),
+            optimized and planner statistics are gathered again at the end """
+
+        base_conn = sqlite3.connect(base_db_path)
+        conn = sqlite3.connect(db_path)
+        try:
+            if cls._fetchall_schema(base_conn) != cls._fetchall_schema(conn):
+                return None
+            deletes = []
+            inserts = []
+            fulltext_tables = []
+            for table_name, is_rowid_table in cls._fetchall_content_tables(conn):
+                columns = (['rowid'] if is_rowid_table else []) + cls._fetchall_columns(conn, table_name)
+                base_rows = set(cls._fetchall_rows(base_conn, table_name, is_rowid_table))
+                rows = cls._fetchall_rows(conn, table_name, is_rowid_table)
+                new_rows = [row for row in rows if row not in base_rows]
+                rows = set(rows)
+                for row in sorted(base_rows - rows, key=repr):
+                    if is_rowid_table:
+                        deletes.append(f'DELETE FROM {table_name} WHERE rowid={row[0]};')
+                    else:
+                        deletes.append(f'DELETE FROM {table_name} WHERE ' + ' AND '.join(
+                            f'{column} IS {cls._sql_value(value)}' for column, value in zip(columns, row)) + ';')
+                for row in new_rows:
+                    inserts.append(f'INSERT INTO {table_name} ({", ".join(columns)}) VALUES {cls._sql_values(row)};')
+                if cls._is_fulltext_table(conn, table_name):
+                    fulltext_tables.append(table_name)
+        finally:
+            base_conn.close()
+            conn.close()
+        statements = ['BEGIN;'] + deletes + inserts
+        statements += [f"INSERT INTO {table_name} ({table_name}) VALUES ('optimize');"
+                       for table_name in fulltext_tables]
+        statements += ['COMMIT;', 'ANALYZE;']
+        return '\n'.join(statements) + '\n'
+
+    @staticmethod
+    def _fetchall_schema(conn):
+        cur = conn.cursor()
+        cur.execute(""" SELECT name, sql FROM sqlite_master
+                        WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%'
+                        ORDER BY name; """)
+        return cur.fetchall()
+
+    @classmethod
+    def _fetchall_content_tables(cls, conn):
+        """ Private method which returns names of the tables holding the database content (without sqlite internal
+            tables and shadow tables of the full-text tables) together with flags whether they have rowid """
+
+        cur = conn.cursor()
+        cur.execute(""" SELECT name, sql FROM sqlite_master
+                        WHERE type='table' AND name NOT LIKE 'sqlite_%'
+                        ORDER BY name; """)
+        tables = cur.fetchall()
+        virtual_tables = [name for name, sql in tables if sql.upper().startswith('CREATE VIRTUAL TABLE')]
+        return [(name, 'WITHOUT ROWID' not in sql.upper()) for name, sql in tables
+                if not any(name.startswith(virtual_table + '_') for virtual_table in virtual_tables)]
+
+    @staticmethod
+    def _fetchall_columns(conn, table_name):
+        cur = conn.cursor()
+        cur.execute(""" SELECT * FROM {table} LIMIT 0; """.format(table=table_name))
+        return [description[0] for description in cur.description]
+
+    @staticmethod
+    def _fetchall_rows(conn, table_name, is_rowid_table):
+        cur = conn.cursor()
+        if is_rowid_table:
+            cur.execute(""" SELECT rowid, * FROM {table} ORDER BY rowid; """.format(table=table_name))
+        else:  # rows of a table without rowid are read in the order of its primary key
+            cur.execute(""" SELECT * FROM {table}; """.format(table=table_name))
+        return cur.fetchall()
+
+    @staticmethod
+    def _is_fulltext_table(conn, table_name):
+        cur = conn.cursor()
+        cur.execute(""" SELECT sql FROM sqlite_master WHERE name=?; """, (table_name,))
+        sql = cur.fetchone()[0].upper()
+        return sql.startswith('CREATE VIRTUAL TABLE') and ('USING FTS4' in sql or 'USING FTS5' in sql)
+
+    @classmethod
+    def _sql_values(cls, row):
+        return '(' + ', '.join(cls._sql_value(value) for value in row) + ')'
+
+    @staticmethod
+    def _sql_value(value):
+        """ Private method which returns SQL literal of the value """
+
+        if value is None:
+            return 'NULL'
+        elif isinstance(value, bytes):
+            return f"X'{value.hex()}'"
+        elif isinstance(value, str):
+            return "'" + value.replace("'", "''") + "'"
+        return repr(value)
+
+    @staticmethod
+    def _hash_members(zipf):
+        """ Private method which returns sha256 hex digests of the archive members (but guide.db) keyed by name """
+
+        members_hashes = {}
+        for zinfo in zipf.infolist():
+            if zinfo.filename == 'guide.db' or zinfo.is_dir():
+                continue
+            with zipf.open(zinfo) as member:
+                members_hashes[zinfo.filename] = MediaCache.hash_stream(member).hexdigest()
+        return members_hashes
+
+    @staticmethod
+    def _copy_member(delta_zipf, zipf, name):
+        """ Private method which copies the archive member into the delta package with the same compression """
+
+        zinfo = zipf.getinfo(name)
+        delta_zinfo = ZipInfo(name, zinfo.date_time)
+        delta_zinfo.compress_type = zinfo.compress_type
+        delta_zinfo.external_attr = zinfo.external_attr
+        with zipf.open(zinfo) as member, delta_zipf.open(delta_zinfo, 'w') as delta_member:
+            shutil.copyfileobj(member, delta_member, HASH_CHUNK_SIZE)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Create or apply xenial guides delta packages.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    create_parser = subparsers.add_parser('create', help='create delta package between two guide archives')
+    create_parser.add_argument('base_archive', help='archive of the guide version the delta updates')
+    create_parser.add_argument('archive', help='archive of the guide version the delta updates to')
+    create_parser.add_argument('--output', help='path of the delta package')
+    create_parser.add_argument('--guide-db', choices=['auto', 'patch', 'replace'], default=DELTA_GUIDE_DB)
+    apply_parser = subparsers.add_parser('apply', help='apply delta package to an extracted guide')
+    apply_parser.add_argument('delta', help='delta package')
+    apply_parser.add_argument('guide_path', help='directory of the guide extracted from the base archive')
+    args = parser.parse_args()
+
+    if args.command == 'create':
+        report = GuideDelta.create(args.base_archive, args.archive, args.output, args.guide_db)
+        print(f"{report['delta_path']}: {report['delta_size']} bytes, {report['delta_changed_members']} changed "
+              f"members, guide.db {report['delta_guide_db']}")
+    else:
+        GuideDelta.apply(args.delta, args.guide_path)
@@ -2,25 +2,32 @@
 Xenial dummy guides generator
 =============================
 
-This module contains class for generating xenial dummy guides content.
+This module contains class for generating xenial dummy guides content. Media of the guides are taken from the media
+pool (see media_pool.py module); a guide can be sized by its archive size or by byte budgets of its media types.
 
 Modules API and guide format is experimental and highly unstable.
 """
 
+from dataclasses import dataclass, replace
 from faker import Faker
-import json
+import functools
+import math
 import os
 import random
 import shutil
 
+from guide_model import Article, Bookmark, Category, Guide
+from media_cache import MediaCache
+from media_pool import MediaPicker, MediaPool, MEDIA_POOL_TYPES
+from pack_metrics import PackMetrics
+from text_backend import TextBackend, PARAGRAPH_NUM_SENTENCES, TEXT_BACKEND
+
 fake = Faker()
 
 FORMAT_VERSION = '0.1'
 
 TMP_PATH = 'tmp'
 
-ARTICLES_PATH = 'articles'
-
 MEDIA_PATH = 'media'
 IMAGE_PATH = os.path.join(MEDIA_PATH, 'image')
 AUDIO_PATH = os.path.join(MEDIA_PATH, 'audio')
@@ -61,6 +68,10 @@ MAX_NUM_ARTICLE_CONTENT_ITEMS = 20
 MAX_ARTICLE_PARAGRAPH_LENGTH = 5
 MAX_ARTICLE_MEDIA_CAPTION_LENGTH = 4
 
+ARCHIVE_ARTICLE_SIZE = 2 * 1024  # estimated bytes an article (its rows of the compressed guide.db) adds to the archive
+ARCHIVE_SIZE_ARTICLES_MARGIN = 1.25  # guides sized by the archive get this many times the articles needed for media
+MEDIA_ITEMS_SHARE = 1 / 9  # expected share of the article content items of every media type
+
 MIN_NUM_BOOKMARKS = 3
 MAX_NUM_BOOKMARKS = MIN_NUM_ARTICLES
 
@@ -77,43 +88,166 @@ LANGUAGES = [('Arabic', 'ar'),
              ('Turkish', 'tr')]
 
 
+@dataclass
+class GuideSize:
+    """ Size parameters of a generated dummy guide, defaults are taken from the module constants; e.g.
+        GuideSize(min_num_articles=100000, max_num_articles=100000) describes a guide for load-testing the app.
+        media_budgets are bytes the distinct media of the types add to the guide archive (e.g. {'video': 50 * 1024 **
+        2}), archive_size sets budgets of the other media types from what remains of the archive bytes after the
+        icons and the articles and raises the number of articles, if needed to hold the media, e.g.
+        GuideSize(archive_size=100 * 1024 ** 2) describes a guide of about 100 MiB archive. max_num_bookmarks None
+        means that any number of the articles can be bookmarked """
+
+    min_num_tags: int = MIN_NUM_TAGS
+    max_num_tags: int = MAX_NUM_TAGS
+    min_num_categories: int = MIN_NUM_CATEGORIES
+    max_num_categories: int = MAX_NUM_CATEGORIES
+    min_num_articles: int = MIN_NUM_ARTICLES
+    max_num_articles: int = MAX_NUM_ARTICLES
+    min_num_article_content_items: int = 1
+    max_num_article_content_items: int = MAX_NUM_ARTICLE_CONTENT_ITEMS
+    min_num_bookmarks: int = MIN_NUM_BOOKMARKS
+    max_num_bookmarks: int = None
+    archive_size: int = None
+    media_budgets: dict = None
+
+    def __post_init__(self):
+        for name in ('tags', 'categories', 'articles', 'article_content_items', 'bookmarks'):
+            min_value, max_value = getattr(self, f'min_num_{name}'), getattr(self, f'max_num_{name}')
+            if min_value < 0 or (max_value is not None and max_value < min_value):
+                raise ValueError(f'Provided a guide size with invalid range of num_{name} ({min_value}, {max_value}).')
+        if self.archive_size is not None and self.archive_size < 0:
+            raise ValueError('Provided a guide size with negative archive_size.')
+        if any(media_budget < 0 for media_budget in (self.media_budgets or {}).values()):
+            raise ValueError('Provided a guide size with negative media budgets.')
+
+
 class GuideGenerator:
     @classmethod
-    def generate(cls, guide_name):
-        """ Public method for generating dummy guide """
+    def generate(cls, guide_name, guide_size=None, text_backend=TEXT_BACKEND):
+        """ Public method for generating dummy guide; the guide content is written as JSON files into the guide tmp
+            directory, whose path is returned. Articles are generated and written one by one, so memory use does
+            not grow with the number of articles (beyond their names and titles) """
+
+        guide_path, guide = cls.generate_guide(guide_name, guide_size, stream=True, text_backend=text_backend)
+        guide.export_json(guide_path)
+        return guide_path
 
+    @classmethod
+    def generate_guide(cls, guide_name, guide_size=None, stream=False, text_backend=TEXT_BACKEND, metrics=None):
+        """ Public method for generating dummy guide model; only icons and media files are written into the guide tmp
+            directory, the returned guide tmp directory path and guide model are meant to be passed to GuidePackager.
+            With stream, articles of the model are an iterator generating the articles one by one as it is consumed
+            (once), otherwise they are generated up front into a list. Texts are synthesized by the text backend
+            ('numpy' or 'faker'), which is seeded from the random module. The media pool index (ffprobe of every new
+            pool file) is loaded only for guides sized by the archive or media budgets. Times of the texts synthesis
+            and of the icons and media files copies are summed into the text_generation and file_copies stages of
+            metrics (a PackMetrics), if provided; with stream, articles are timed as they are consumed """
+
+        guide_size = guide_size or GuideSize()
+        metrics = metrics or PackMetrics(guide_name)
+        if guide_size.archive_size is not None or guide_size.media_budgets:
+            media_pool = MediaPool.load()
+        else:  # media are picked at random, a listing of the pool is enough
+            media_pool = MediaPool.list_files()
+        guide_size = cls._fit_guide_size(guide_size, media_pool)
+        text = TextBackend.create(text_backend, fake, seed=random.getrandbits(64))
         cls._reset_tmp_dir(guide_name)
 
         guide_icon = random.choice(os.listdir(GUIDE_ICON_PATH))
         from_country, to_country = random.sample(COUNTRIES, 2)
         description_length = random.randint(1, MAX_GUIDE_DESCRIPTION_LENGTH)
-        num_tags = random.randint(MIN_NUM_TAGS, MAX_NUM_TAGS)
-        tags = fake.words(num_tags)
-
-        cls._generate_dummy_guide_categories(guide_name, tags)
-        cls._generate_dummy_guide_articles(guide_name, tags)
-
-        guide = {
-            'guide_name': guide_name,  # is the guide file name without the zip extension
-            'guide_format_version': FORMAT_VERSION,
-            'guide_icon': os.path.join(GUIDE_ICON_PATH, guide_icon),
-            'guide_title': fake.sentence(nb_words=random.randint(1, MAX_GUIDE_TITLE_LENGTH))[:-1],
-            'guide_description': fake.paragraph(description_length),
-            'guide_lang': random.choice(LANGUAGES),
-            'guide_from_place': from_country,
-            'guide_to_place': to_country,
-            # 'tags': tags  # commented out because it will be generated from articles and categories during import
-            'guide_content': cls._generate_dummy_guide_content_list(guide_name)
-        }
-        os.remove(os.path.join(TMP_PATH, guide_name, 'articles.json'))  # all articles in the intended order are already listed in the guide['content']
-
-        shutil.copy(os.path.join(GUIDE_ICON_PATH, guide_icon),
-                    os.path.join(TMP_PATH, guide_name, GUIDE_ICON_PATH))
-
-        with open(os.path.join(TMP_PATH, guide_name, 'guide.json'), 'w') as f:
-            json.dump(guide, f, indent=4)
-
-        return os.path.join(TMP_PATH, guide_name)
+        num_tags = random.randint(guide_size.min_num_tags, guide_size.max_num_tags)
+        with metrics.stage('text_generation'):
+            tags = text.words(num_tags)
+
+        categories = cls._generate_dummy_guide_categories(guide_name, tags, guide_size, text, metrics)
+        with metrics.stage('text_generation'):
+            articles_names, articles_titles = cls._generate_dummy_guide_articles_names_titles(guide_size, text)
+            bookmarks = cls._generate_dummy_guide_bookmarks(articles_names, articles_titles, guide_size)
+            guide_title = text.sentence(random.randint(1, MAX_GUIDE_TITLE_LENGTH))[:-1]
+            guide_description = text.paragraph(description_length)
+
+        guide = Guide(
+            guide_name=guide_name,
+            guide_format_version=FORMAT_VERSION,
+            guide_icon=os.path.join(GUIDE_ICON_PATH, guide_icon),
+            guide_title=guide_title,
+            guide_description=guide_description,
+            guide_lang=random.choice(LANGUAGES),
+            guide_from_place=from_country,
+            guide_to_place=to_country,
+            # tags are not listed because they will be generated from articles and categories during import
+            guide_content=cls._generate_dummy_guide_content_list(articles_names, articles_titles),
+            categories=categories,
+            bookmarks=bookmarks
+        )
+        with metrics.stage('file_copies'):
+            shutil.copy(os.path.join(GUIDE_ICON_PATH, guide_icon),
+                        os.path.join(TMP_PATH, guide_name, GUIDE_ICON_PATH))
+
+        # articles are generated last, so the generated content does not depend on when they are consumed, and in the
+        # guide content order, the order their ids are assigned in by the packagers
+        guide.articles = cls._generate_dummy_guide_articles(guide_name, tags,
+                                                            [article_item[0] for article_item in guide.guide_content],
+                                                            [article_item[1] for article_item in guide.guide_content],
+                                                            guide_size, text, media_pool, metrics)
+        if not stream:
+            guide.articles = list(guide.articles)
+
+        return os.path.join(TMP_PATH, guide_name), guide
+
+    @classmethod
+    def _fit_guide_size(cls, guide_size, media_pool):
+        """ Private method which returns the guide size with the number of articles raised, when the articles are
+            not expected to have enough media blocks to fill the media budgets (given by the guide archive size) """
+
+        if guide_size.archive_size is None:
+            return guide_size
+        media_items_per_article = cls._expected_media_items(guide_size)
+        num_articles = 0
+        for media_type, media_budget in cls._media_budgets(guide_size, media_pool, 0).items():
+            media_size = cls._mean_archived_size(media_pool, media_type)
+            if media_size:
+                num_articles = max(num_articles, math.ceil(media_budget / media_size / media_items_per_article
+                                                           * ARCHIVE_SIZE_ARTICLES_MARGIN))
+        if num_articles <= guide_size.min_num_articles:
+            return guide_size
+        return replace(guide_size, min_num_articles=num_articles,
+                       max_num_articles=max(num_articles, guide_size.max_num_articles))
+
+    @classmethod
+    def _media_budgets(cls, guide_size, media_pool, other_size):
+        """ Private method which returns byte budgets of the media types: the given ones, and when the guide is
+            sized by its archive, the archive size less other_size (bytes of the icons and articles) and the given
+            budgets is divided among the other media types (those with pool files) by their mean size """
+
+        media_budgets = dict(guide_size.media_budgets or {})
+        if guide_size.archive_size is None:
+            return media_budgets
+        rest_types_sizes = {media_type: cls._mean_archived_size(media_pool, media_type)
+                            for media_type in MEDIA_POOL_TYPES
+                            if media_type not in media_budgets and media_pool['media'].get(media_type)}
+        rest_budget = max(0, guide_size.archive_size - other_size - sum(media_budgets.values()))
+        for media_type, media_size in rest_types_sizes.items():
+            media_budgets[media_type] = int(rest_budget * media_size / (sum(rest_types_sizes.values()) or 1))
+        return media_budgets
+
+    @staticmethod
+    def _mean_archived_size(media_pool, media_type):
+        """ Private method which returns mean bytes a pool file of the media type adds to the archive """
+
+        entries = media_pool['media'][media_type]
+        return sum(MediaPool.archived_size(media_type, entry) for entry in entries) / len(entries) if entries else 0
+
+    @staticmethod
+    def _expected_media_items(guide_size):
+        """ Private method which returns expected number of content items of every media type in an article; items
+            following a paragraph are of a random type (paragraph too), the other items are paragraphs, so 5/9 of
+            the items are paragraphs and 1/9 are of every other type """
+
+        return (guide_size.min_num_article_content_items + guide_size.max_num_article_content_items) / 2 \
+            * MEDIA_ITEMS_SHARE
 
     @staticmethod
     def _reset_tmp_dir(guide_name):
@@ -123,91 +257,135 @@ class GuideGenerator:
         guide_tmp_dir = os.path.join(TMP_PATH, guide_name)
         if os.path.isdir(guide_tmp_dir):
             shutil.rmtree(guide_tmp_dir)
-        os.mkdir(guide_tmp_dir)
+        os.makedirs(guide_tmp_dir)
         os.mkdir(os.path.join(guide_tmp_dir, ICONS_PATH))
         os.mkdir(os.path.join(guide_tmp_dir, GUIDE_ICON_PATH))
         os.mkdir(os.path.join(guide_tmp_dir, CATEGORIES_ICONS_PATH))
         os.mkdir(os.path.join(guide_tmp_dir, ARTICLES_ICONS_PATH))
+        os.mkdir(os.path.join(guide_tmp_dir, MEDIA_PATH))
+        os.mkdir(os.path.join(guide_tmp_dir, IMAGE_PATH))
+        os.mkdir(os.path.join(guide_tmp_dir, AUDIO_PATH))
+        os.mkdir(os.path.join(guide_tmp_dir, VIDEO_PATH))
 
-    @staticmethod
-    def _generate_dummy_guide_categories(guide_name, tags):
+    @classmethod
+    def _generate_dummy_guide_categories(cls, guide_name, tags, guide_size, text, metrics):
         """Private method used for generating the dummy guide's categories """
 
         categories = []
-        num_categories = random.randint(MIN_NUM_CATEGORIES, MAX_NUM_CATEGORIES)
+        num_categories = random.randint(guide_size.min_num_categories, guide_size.max_num_categories)
         description_length = random.randint(1, MAX_CATEGORY_DESCRIPTION_LENGTH)
-        category_icon_files = random.sample(os.listdir(CATEGORIES_ICONS_PATH), num_categories)
+        category_icon_files = cls._sample_icon_files(CATEGORIES_ICONS_PATH, num_categories)
         for category_idx in range(num_categories):
             category_icon = category_icon_files[category_idx]
             num_category_tags = random.randint(MIN_NUM_CATEGORY_TAGS, MAX_NUM_CATEGORY_TAGS)
-            categories.append({
-                'icon': os.path.join(CATEGORIES_ICONS_PATH, category_icon),
-                'name': fake.sentence(nb_words=random.randint(1, MAX_CATEGORY_NAME_LENGTH))[:-1],
-                'description': fake.paragraph(description_length),
-                'tags': random.sample(tags, num_category_tags)
-            })
-            shutil.copy(os.path.join(CATEGORIES_ICONS_PATH, category_icon),
-                        os.path.join(TMP_PATH, guide_name, CATEGORIES_ICONS_PATH))
-        with open(os.path.join(TMP_PATH, guide_name, 'categories.json'), 'w') as f:
-            json.dump(categories, f, indent=4)
+            with metrics.stage('text_generation'):
+                category_name = text.sentence(random.randint(1, MAX_CATEGORY_NAME_LENGTH))[:-1]
+                category_description = text.paragraph(description_length)
+            categories.append(Category(
+                icon=os.path.join(CATEGORIES_ICONS_PATH, category_icon),
+                name=category_name,
+                description=category_description,
+                tags=random.sample(tags, min(num_category_tags, len(tags)))
+            ))
+            with metrics.stage('file_copies'):
+                cls._copy_icon_file(guide_name, CATEGORIES_ICONS_PATH, category_icon)
+        return categories
 
-    @classmethod
-    def _generate_dummy_guide_articles(cls, guide_name, tags):
-        """ Private method fro generating a dummy guide articles """
-
-        os.mkdir(os.path.join(TMP_PATH, guide_name, ARTICLES_PATH))
-        os.mkdir(os.path.join(TMP_PATH, guide_name, MEDIA_PATH))
-        os.mkdir(os.path.join(TMP_PATH, guide_name, IMAGE_PATH))
-        os.mkdir(os.path.join(TMP_PATH, guide_name, AUDIO_PATH))
-        os.mkdir(os.path.join(TMP_PATH, guide_name, VIDEO_PATH))
-        articles_heads = []
-        num_articles = random.randint(MIN_NUM_ARTICLES, MAX_NUM_ARTICLES)
-        article_icon_files = random.sample(os.listdir(ARTICLES_ICONS_PATH), num_articles)
+    @staticmethod
+    def _generate_dummy_guide_articles_names_titles(guide_size, text):
+        """ Private method for generating (unique) names and titles of all the dummy guide articles up front, they
+            are the targets of the articles ref markups, the guide content list and the bookmarks """
+
+        articles_names = []
+        articles_titles = []
+        used_names = set()
+        num_articles = random.randint(guide_size.min_num_articles, guide_size.max_num_articles)
         for article_idx in range(num_articles):
+            name = text.sentence(random.randint(1, MAX_ARTICLE_NAME_LENGTH))[:-1]
+            if name in used_names:
+                name = f'{name} {article_idx}'  # articles names are unique within a guide
+            used_names.add(name)
+            articles_names.append(name)
+            articles_titles.append(text.sentence(random.randint(1, MAX_ARTICLE_TITLE_LENGTH))[:-1])
+        return articles_names, articles_titles
+
+    @classmethod
+    def _generate_dummy_guide_articles(cls, guide_name, tags, articles_names, articles_titles, guide_size, text,
+                                       media_pool, metrics):
+        """ Private method (generator) fro generating a dummy guide articles one by one """
+
+        article_icon_files = cls._sample_icon_files(ARTICLES_ICONS_PATH, len(articles_names))
+        media_picker = cls._media_picker(guide_name, len(articles_names), article_icon_files, guide_size, media_pool)
+        for article_idx, article_name in enumerate(articles_names):
             num_article_tags = random.randint(MIN_NUM_ARTICLE_TAGS, MAX_NUM_ARTICLE_TAGS)
             synopsis_length = random.randint(MIN_ARTICLE_SYNOPSIS_LENGTH, MAX_ARTICLE_SYNOPSIS_LENGTH)
             article_icon = article_icon_files[article_idx]
-            articles_heads.append({
-                'icon': os.path.join(ARTICLES_ICONS_PATH, article_icon),
-                'name': fake.sentence(nb_words=random.randint(1, MAX_ARTICLE_NAME_LENGTH))[:-1],
-                'title': fake.sentence(nb_words=random.randint(1, MAX_ARTICLE_TITLE_LENGTH))[:-1],
-                'synopsis': fake.paragraph(synopsis_length),
-                'tags': random.sample(tags, num_article_tags),
-            })
-            shutil.copy(os.path.join(ARTICLES_ICONS_PATH, article_icon),
-                        os.path.join(TMP_PATH, guide_name, ARTICLES_ICONS_PATH))
+            with metrics.stage('text_generation'):
+                synopsis = text.paragraph(synopsis_length)
+            article = Article(
+                name=article_name,
+                icon=os.path.join(ARTICLES_ICONS_PATH, article_icon),
+                title=articles_titles[article_idx],
+                synopsis=synopsis,
+                tags=random.sample(tags, min(num_article_tags, len(tags))),
+            )
+            with metrics.stage('file_copies'):
+                cls._copy_icon_file(guide_name, ARTICLES_ICONS_PATH, article_icon)
+            article.content = cls._generate_dummy_guide_article_content(guide_name, articles_names, media_picker,
+                                                                        guide_size, text, metrics)
+            yield article
 
-        for article_head in articles_heads:
-            cls._generate_dummy_guide_article_content(guide_name, article_head, articles_heads)
+    @classmethod
+    def _media_picker(cls, guide_name, num_articles, article_icon_files, guide_size, media_pool):
+        """ Private method which returns picker of the guide media; budgets given by the guide archive size are left
+            after the icons (the guide and categories icons already copied, the distinct articles icons) and the
+            estimated articles bytes """
+
+        other_size = num_articles * ARCHIVE_ARTICLE_SIZE
+        other_size += sum(os.path.getsize(os.path.join(ARTICLES_ICONS_PATH, icon_file))
+                          for icon_file in set(article_icon_files))
+        for dir_path, dir_names, filenames in os.walk(os.path.join(TMP_PATH, guide_name, ICONS_PATH)):
+            other_size += sum(os.path.getsize(os.path.join(dir_path, filename)) for filename in filenames)
+        media_budgets = cls._media_budgets(guide_size, media_pool, other_size)
+        # blocks are expected less than the articles hold (the margin), so the budgets are spent sooner than later
+        expected_blocks = {media_type: num_articles * cls._expected_media_items(guide_size)
+                           / ARCHIVE_SIZE_ARTICLES_MARGIN for media_type in media_budgets}
+        spill_types = set(media_budgets) - set(guide_size.media_budgets or {})  # those given by the archive size
+        return MediaPicker(media_pool, media_budgets, expected_blocks, spill_types)
 
-        cls._generate_dummy_guide_bookmarks(guide_name, articles_heads)
+    @staticmethod
+    def _sample_icon_files(icons_path, num_icons):
+        """ Private method which samples icons from the icons pool, icons are repeated only if there are more icons
+            needed than the pool provides """
 
-        with open(os.path.join(TMP_PATH, guide_name, 'articles.json'), 'w') as f:
-            json.dump(articles_heads, f, indent=4)
+        icon_files = os.listdir(icons_path)
+        if num_icons <= len(icon_files):
+            return random.sample(icon_files, num_icons)
+        return random.choices(icon_files, k=num_icons)
 
     @staticmethod
-    def _generate_dummy_guide_content_list(guide_name):
+    def _copy_icon_file(guide_name, icons_path, icon_file):
+        guide_icon_path = os.path.join(TMP_PATH, guide_name, icons_path, icon_file)
+        if not os.path.exists(guide_icon_path):
+            shutil.copy(os.path.join(icons_path, icon_file), guide_icon_path)
+
+    @staticmethod
+    def _generate_dummy_guide_content_list(articles_names, articles_titles):
         """ Private method for generating list of articles identifiers in an arbitrary order """
-        with open(os.path.join(TMP_PATH, guide_name, 'articles.json'), 'r') as f:
-            articles = json.load(f)
-        articles_names_titles = random.sample([(article['name'], article['title']) for article in articles],
-                                              len(articles))
+        articles_names_titles = list(zip(articles_names, articles_titles))
+        random.shuffle(articles_names_titles)
         return articles_names_titles
 
     @classmethod
-    def _generate_dummy_guide_article_content(cls, guide_name, article_head, articles):
-        """ Private method for generating a dummy guide article content """
-
-        article = {
-            'name': article_head['name'],
-            'icon': article_head['icon'],
-            'title': article_head['title'],
-            'synopsis': article_head['synopsis'],
-            'tags': article_head['tags'],
-        }
-        content_items = []
+    def _generate_dummy_guide_article_content(cls, guide_name, articles_names, media_picker, guide_size, text,
+                                              metrics):
+        """ Private method for generating a dummy guide article content; texts of all the content items are
+            synthesized by the text backend in one batch, then the media items are picked and linked """
+
         content_types = ['subtitle', 'paragraph', 'image', 'audio', 'video']
-        num_content_items = random.randint(1, MAX_NUM_ARTICLE_CONTENT_ITEMS)
+        num_content_items = random.randint(guide_size.min_num_article_content_items,
+                                           guide_size.max_num_article_content_items)
+        items_types = []
         last_item_type = None
         for item_idx in range(num_content_items):
             if last_item_type != 'paragraph':
@@ -217,79 +395,110 @@ class GuideGenerator:
                 if current_item_type == 'subtitle' and item_idx == (num_content_items - 1):
                     current_item_type = 'paragraph'
 
-            content_items.append(cls._generate_dummy_guide_article_content_item(guide_name, current_item_type, articles))
+            items_types.append(current_item_type)
             last_item_type = current_item_type
-        article['content'] = content_items
-        with open(os.path.join(TMP_PATH, guide_name, ARTICLES_PATH, article['name'] + '.json'), 'w') as f:
-            json.dump(article, f, indent=4)
+
+        # subtitles are the only texts without markups
+        items_texts_lengths = [cls._content_item_text_length(item_type) for item_type in items_types]
+        with metrics.stage('text_generation'):
+            items_texts = text.paragraphs(items_texts_lengths, [item_type != 'subtitle' for item_type in items_types],
+                                          articles_names)
+        with metrics.stage('file_copies'):
+            return [cls._generate_dummy_guide_article_content_item(guide_name, item_type, item_text, media_picker)
+                    for item_type, item_text in zip(items_types, items_texts)]
+
+    @staticmethod
+    def _content_item_text_length(item_type):
+        """ Private method returning (around) how many sentences has the text of a content item of given type """
+
+        if item_type == 'subtitle':
+            return PARAGRAPH_NUM_SENTENCES
+        elif item_type == 'paragraph':
+            return random.randint(1, MAX_ARTICLE_PARAGRAPH_LENGTH)
+        elif item_type in ('image', 'audio', 'video'):
+            return random.randint(1, MAX_ARTICLE_MEDIA_CAPTION_LENGTH)
+        else:
+            raise ValueError('Provided a content item of unknown type.')
 
     @classmethod
-    def _generate_dummy_guide_article_content_item(cls, guide_name, current_item_type, articles):
-        """ Private method for generating a dummy guide article content item """
+    def _generate_dummy_guide_article_content_item(cls, guide_name, current_item_type, item_text, media_picker):
+        """ Private method for generating a dummy guide article content item, media items take the media picked
+            from the pool """
 
         item = {'type': current_item_type}
         if current_item_type == 'subtitle':
-            text = fake.paragraph()
-            item['text'] = text
+            item['text'] = item_text
         elif current_item_type == 'paragraph':
-            text = fake.paragraph(random.randint(1, MAX_ARTICLE_PARAGRAPH_LENGTH))
-            item['text'] = cls._markup_text(text, articles)
+            item['text'] = item_text
         elif current_item_type == 'image':
-            image_filename = random.choice(os.listdir(IMAGE_PATH))
-            item['source'] = os.path.join(IMAGE_PATH, image_filename)
-            shutil.copy(os.path.join(item['source']), os.path.join(TMP_PATH, guide_name, item['source']))
-            caption = fake.paragraph(random.randint(1, MAX_ARTICLE_MEDIA_CAPTION_LENGTH))
-            item['caption'] = cls._markup_text(caption, articles)
+            image_entry, image_variant = media_picker.pick('image')
+            item['source'] = cls._link_media_file(guide_name, media_picker.index, 'image', image_entry, image_variant)
+            item['caption'] = item_text
         elif current_item_type == 'audio':
-            audio_filename = random.choice(os.listdir(AUDIO_PATH))
-            item['source'] = os.path.join(AUDIO_PATH, audio_filename)
-            shutil.copy(os.path.join(item['source']), os.path.join(TMP_PATH, guide_name, item['source']))
-            caption = fake.paragraph(random.randint(1, MAX_ARTICLE_MEDIA_CAPTION_LENGTH))
-            item['caption'] = cls._markup_text(caption, articles)
+            audio_entry, audio_variant = media_picker.pick('audio')
+            item['source'] = cls._link_media_file(guide_name, media_picker.index, 'audio', audio_entry, audio_variant)
+            item['caption'] = item_text
         elif current_item_type == 'video':
-            video_filename = random.choice(os.listdir(VIDEO_PATH))
-            item['source'] = os.path.join(VIDEO_PATH, video_filename)
-            shutil.copy(os.path.join(item['source']), os.path.join(TMP_PATH, guide_name, item['source']))
-            caption = fake.paragraph(random.randint(1, MAX_ARTICLE_MEDIA_CAPTION_LENGTH))
-            item['caption'] = cls._markup_text(caption, articles)
+            video_entry, video_variant = media_picker.pick('video')
+            item['source'] = cls._link_media_file(guide_name, media_picker.index, 'video', video_entry, video_variant)
+            item['caption'] = item_text
         else:
             raise ValueError('Provided a content item of unknown type.')
         return item
 
+    @classmethod
+    def _link_media_file(cls, guide_name, media_pool, media_type, entry, variant):
+        """ Private method which places a pool media file (or its variant) into the guide tmp directory under its
+            content hash (pool files hardlinked when possible, copied otherwise), so every distinct payload is stored
+            once, and returns its source path """
+
+        media_path = MediaPool.media_path(media_pool, media_type, entry)
+        if variant == 0 and entry['hash'] is not None:
+            media_hash = entry['hash']
+        elif variant == 0:  # entry of the pool listing
+            media_hash = cls._hash_media_file(media_path, entry['size'], entry['mtime_ns'])
+        else:
+            media_hash = cls._hash_media_variant(media_path, entry['size'], entry['mtime_ns'], variant)
+        source = os.path.join(MEDIA_PATH, media_type, media_hash + os.path.splitext(media_path)[1])
+        guide_media_path = os.path.join(TMP_PATH, guide_name, source)
+        if os.path.exists(guide_media_path):
+            return source
+        if variant == 0:
+            try:
+                os.link(media_path, guide_media_path)
+            except OSError:
+                shutil.copy(media_path, guide_media_path)
+        else:
+            shutil.copy(media_path, guide_media_path)
+            with open(guide_media_path, 'ab') as f:
+                f.write(MediaPool.variant_padding(media_path, variant))
+        return source
+
     @staticmethod
-    def _markup_text(text, articles):
-        """ Private method (naively) inserting kivy markups to the provided text """
-
-        markup_types = ['bold', 'italic', 'ref']
-        words = text.split()
-        markup_ratio = 1 / 8
-        for markup_idx in range(round(len(words) * markup_ratio)):
-            markup_type = random.choice(markup_types)
-            markup_start = random.randint(0, len(words) - 1)
-            markup_end = random.randint(markup_start, len(words) - 1)
-            if markup_type == 'bold':
-                words[markup_start] = '[b]' + words[markup_start]
-                words[markup_end] = words[markup_end] + '[/b]'
-            elif markup_type == 'italic':
-                words[markup_start] = '[i]' + words[markup_start]
-                words[markup_end] = words[markup_end] + '[/i]'
-            elif markup_type == 'ref':
-                article_ref = random.choice(articles)['name']
-                words[markup_start] = f'[u][ref={article_ref}]' + words[markup_start]
-                words[markup_end] = words[markup_end] + '[/ref][/u]'
-        markupped_text = ' '.join(words)
-        return markupped_text
+    @functools.lru_cache(maxsize=None)
+    def _hash_media_file(media_path, media_size, media_mtime_ns):
+        """ Private method which hashes every media file of the pool only once (size and mtime invalidate the memo) """
+
+        return MediaCache.hash_file(media_path)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def _hash_media_variant(media_path, media_size, media_mtime_ns, variant):
+        """ Private method which hashes every variant of the pool media files only once (size and mtime invalidate
+            the memo) """
+
+        return MediaPool.variant_hash(media_path, variant)
 
     @staticmethod
-    def _generate_dummy_guide_bookmarks(guide_name, articles_heads):
+    def _generate_dummy_guide_bookmarks(articles_names, articles_titles, guide_size):
         bookmarks = []
-        num_bookmarks = random.randint(MIN_NUM_BOOKMARKS, len(articles_heads))
-        bookmarked_article = random.sample(articles_heads, num_bookmarks)
-        for article in bookmarked_article:
-            bookmarks.append({
-                'article_name': article['name'],
-                'article_title': article['title'],
-                'created_at': str(fake.date_between(start_date="-30y", end_date="today"))
-            })
-        with open(os.path.join(TMP_PATH, guide_name, 'bookmarks.json'), 'w') as f:
-            json.dump(bookmarks, f, indent=4)
+        max_num_bookmarks = len(articles_names) if guide_size.max_num_bookmarks is None \
+            else min(guide_size.max_num_bookmarks, len(articles_names))
+        num_bookmarks = random.randint(min(guide_size.min_num_bookmarks, len(articles_names)), max_num_bookmarks)
+        for article_idx in random.sample(range(len(articles_names)), num_bookmarks):
+            bookmarks.append(Bookmark(
+                article_name=articles_names[article_idx],
+                article_title=articles_titles[article_idx],
+                created_at=str(fake.date_between(start_date="-30y", end_date="today"))
+            ))
+        return bookmarks
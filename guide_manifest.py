@@ -0,0 +1,97 @@
+"""
+Xenial guides packaging manifest
+================================
+
+This module contains class for recording hashes of a guide's packaging inputs (guide.json, categories.json,
+bookmarks.json, articles JSON files, icons and media files) so that a following packaging run can find out what has
+changed since the last one.
+
+Modules API and guide format is experimental and highly unstable.
+"""
+
+import json
+import os
+import re
+
+from media_cache import MediaCache
+
+MANIFEST_FILENAME = '.pack_manifest.json'
+MANIFEST_VERSION = 3  # guide.db built for a manifest of another version is rebuilt from scratch
+
+# files in a guide directory which are never recorded in the manifest as they are outputs of the packaging
+MANIFEST_EXCLUDED_FILENAMES = (MANIFEST_FILENAME, 'guide.db')
+
+
+class GuideManifest:
+    @staticmethod
+    def load(guide_path):
+        """ Public method which returns manifest of the last packaging run of the guide or None if there is none """
+
+        try:
+            with open(os.path.join(guide_path, MANIFEST_FILENAME), 'r') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if manifest.get('version') != MANIFEST_VERSION:
+            return None
+        return manifest
+
+    @staticmethod
+    def save(guide_path, manifest):
+        manifest_path = os.path.join(guide_path, MANIFEST_FILENAME)
+        with open(manifest_path + '.part', 'w') as f:
+            json.dump(dict(manifest, version=MANIFEST_VERSION), f)
+        os.replace(manifest_path + '.part', manifest_path)
+
+    @staticmethod
+    def remove(guide_path):
+        manifest_path = os.path.join(guide_path, MANIFEST_FILENAME)
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+
+    @staticmethod
+    def hash_files(guide_path, previous_files=None):
+        """ Public method which returns size, mtime and sha256 hash of every file in the guide directory keyed by its
+            path relative to the guide directory; files whose size and mtime match previous_files are not rehashed """
+
+        previous_files = previous_files or {}
+        files = {}
+        for root, directories, filenames in os.walk(guide_path):
+            for filename in filenames:
+                if filename in MANIFEST_EXCLUDED_FILENAMES or filename.endswith('.part'):
+                    continue
+                file_path = os.path.join(root, filename)
+                relative_path = os.path.relpath(file_path, guide_path)
+                file_stat = os.stat(file_path)
+                previous_file = previous_files.get(relative_path)
+                if previous_file is not None and previous_file['size'] == file_stat.st_size \
+                        and previous_file['mtime_ns'] == file_stat.st_mtime_ns:
+                    files[relative_path] = previous_file
+                else:
+                    files[relative_path] = {'size': file_stat.st_size,
+                                            'mtime_ns': file_stat.st_mtime_ns,
+                                            'sha256': MediaCache.hash_file(file_path)}
+        return files
+
+    @staticmethod
+    def changed_files(previous_files, files):
+        """ Public method which returns set of paths of the files added, modified or removed since previous_files """
+
+        return {path for path in set(previous_files) | set(files)
+                if path not in previous_files or path not in files
+                or previous_files[path]['sha256'] != files[path]['sha256']}
+
+    @staticmethod
+    def article_record(article):
+        """ Public method which returns the article data recorded in the manifest: its name, names of the articles
+            it refers to and media sources it uses """
+
+        refs = set()
+        media = set()
+        for block in article['content']:
+            for text in (block.get('text'), block.get('caption')):
+                if text:
+                    refs.update(name.strip() for name in re.findall(r'\[ref=(.*?)\]', text) if name.strip())
+            if 'source' in block:
+                media.add(block['source'])
+        return {'name': article['name'], 'refs': sorted(refs), 'media': sorted(media)}
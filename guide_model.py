@@ -0,0 +1,93 @@
+"""
+Xenial guide model
+==================
+
+This module contains in-memory representation of a guide's content, which can be handed over from GuideGenerator to
+GuidePackager directly, or exported into the JSON files layout the packager reads from a guide directory.
+
+Articles content blocks are kept as dicts in the same shape as in the article JSON files, e.g.
+{'type': 'image', 'source': 'media/image/...', 'caption': '...'}.
+
+Modules API and guide format is experimental and highly unstable.
+"""
+
+from dataclasses import dataclass, field
+import json
+import os
+
+ARTICLES_PATH = 'articles'
+
+
+@dataclass
+class Category:
+    icon: str
+    name: str
+    description: str
+    tags: list
+
+    def to_dict(self):
+        return dict(vars(self))
+
+
+@dataclass
+class Article:
+    name: str
+    icon: str
+    title: str
+    synopsis: str
+    tags: list
+    content: list = field(default_factory=list)
+
+    def to_dict(self):
+        return dict(vars(self))
+
+
+@dataclass
+class Bookmark:
+    article_name: str
+    article_title: str
+    created_at: str
+
+    def to_dict(self):
+        return dict(vars(self))
+
+
+@dataclass
+class Guide:
+    guide_name: str  # is the guide file name without the zip extension
+    guide_format_version: str
+    guide_icon: str
+    guide_title: str
+    guide_description: str
+    guide_lang: tuple
+    guide_from_place: str
+    guide_to_place: str
+    guide_content: list  # names and titles of all articles in the intended order
+    categories: list = field(default_factory=list)
+    articles: list = field(default_factory=list)  # or an iterator generating the articles, which is consumed once
+    bookmarks: list = field(default_factory=list)
+
+    def to_dict(self):
+        """ Public method which returns the guide description stored in guide.json """
+
+        guide = dict(vars(self))
+        del guide['categories'], guide['articles'], guide['bookmarks']
+        return guide
+
+    def export_json(self, guide_path, with_sources=True):
+        """ Public method which writes guide.json into the guide directory and, with sources, also categories.json,
+            bookmarks.json and articles JSON files (the layout GuidePackager reads when no model is provided) """
+
+        with open(os.path.join(guide_path, 'guide.json'), 'w') as f:
+            json.dump(self.to_dict(), f, indent=4)
+        if not with_sources:
+            return
+
+        with open(os.path.join(guide_path, 'categories.json'), 'w') as f:
+            json.dump([category.to_dict() for category in self.categories], f, indent=4)
+        os.makedirs(os.path.join(guide_path, ARTICLES_PATH), exist_ok=True)
+        for article in self.articles:
+            with open(os.path.join(guide_path, ARTICLES_PATH, article.name + '.json'), 'w') as f:
+                json.dump(article.to_dict(), f, indent=4)
+        with open(os.path.join(guide_path, 'bookmarks.json'), 'w') as f:
+            json.dump([bookmark.to_dict() for bookmark in self.bookmarks], f, indent=4)
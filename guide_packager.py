@@ -2,67 +2,952 @@
 Xenial guides packager
 ======================
 
-This module contains class for packaging xenial guides content.
+This module contains class for packaging xenial guides content. Query plans of the app's reference queries on packed
+guides are checked by guide_archive.py script.
 
 Modules API and guide format is experimental and highly unstable.
 """
 
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import ffmpeg
+import io
 import json
 import os
 import shutil
 import sqlite3
 import re
-from zipfile import ZipFile
+import tempfile
+import time
+import zlib
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED, ZIP_LZMA, ZIP_STORED
+
+from archive_writer import ArchiveWriter
+from guide_catalog import GuideCatalog
+from guide_delta import GuideDelta
+from guide_manifest import GuideManifest, MANIFEST_FILENAME
+from media_cache import MediaCache, MEDIA_CACHE_PATH, MEDIA_CACHE_MAX_ENTRIES
+from media_transcoder import MediaTranscoder, TRANSCODE_PROFILE, VIDEO_COVER_THUMBNAIL_WIDTHS
+from pack_metrics import PackMetrics, PACK_PROFILER
 
 DIST_PATH = os.path.join('dist', 'dummy')
 
+PROBE_EXECUTOR = 'thread'  # 'thread' or 'process'; every probe spawns ffprobe subprocess, so threads are usually enough
+PROBE_MAX_WORKERS = None  # None lets the executor pick the number of workers based on the number of CPUs
+
+VIDEO_COVER_SEEK_FRACTION = 0.1  # covers are taken at this fraction of the video duration, first frames are often black
+
+ARCHIVE_STORED_EXTENSIONS = ('.m4a', '.mp4', '.jpeg', '.jpg', '.png', '.webp')  # already compressed, stored as they are
+ARCHIVE_COMPRESSION = ZIP_DEFLATED  # ZIP_DEFLATED or ZIP_LZMA, used for all other files (guide.db, guide.json)
+ARCHIVE_COMPRESSLEVEL = 9  # zlib level (0-9) for ZIP_DEFLATED, preset (0-9) for ZIP_LZMA
+ARCHIVE_MAX_WORKERS = None
+ARCHIVE_CHUNK_SIZE = 1024 * 1024
+ARCHIVE_SPOOL_MAX_SIZE = 4 * 1024 * 1024  # compressed members bigger than this are spooled into temporary files
+ARCHIVE_LAYOUT = 'walk'  # 'walk' (members in directory walk order) or 'random_access' (see _order_archive_members)
+ARCHIVE_ALIGNED_FILENAMES = ('guide.json', 'guide.db')  # stored uncompressed and aligned in random access layout
+ARCHIVE_ALIGNMENT = 4096  # data of the aligned members start at multiples of this (memory page) size, so can be mmapped
+ARCHIVE_INDEX_FILENAME = 'index.json'  # first member of random access layout archives, locates the members data
+ARCHIVE_INDEX_VERSION = 1
+ARCHIVE_COMPRESSION_NAMES = {ZIP_STORED: 'stored', ZIP_DEFLATED: 'deflated', ZIP_LZMA: 'lzma'}
+
+GUIDE_SOURCES_PATHS = ('categories.json', 'articles', 'bookmarks.json')  # guide sources which are not archived
+
+DELTA = False  # write a delta package from the replaced archive (if any) to the new one beside the archive
+CATALOG = True  # update the catalog entry of the published archive (see guide_catalog.py)
+
+SEARCH_INDEX = 'fts4'  # 'fts4' or 'fts5' module of the article_block_search full-text table
+SEARCH_INDEX_PREFIXES = (2, 3)  # lengths of the prefix indexes of the fts5 table (speed up prefix queries)
+SEARCH_INDEX_OPTIMIZE = True  # merge the full-text index b-trees into one after the table is filled
+
+DB_PAGE_SIZE = 4096  # page size (a power of two between 512 and 65536) guide.db is rebuilt with when finalized
+
+# indexes serving the app's lookups which the primary keys of the pivot tables (leading with tag_id) do not serve,
+# plans of the app's reference queries using them are checked by guide_archive.py
+QUERY_INDEXES = {
+    'tags_articles_by_article': 'tags_articles (article_id, tag_id)',
+    'tags_categories_by_category': 'tags_categories (category_id, tag_id)',
+    'article_links_by_source': 'article_links (source_article_id, target_article_id)',
+}
+
+MARKUP_SPANS = False  # store the parsed markup spans of every block text in the article_block_spans table
+MARKUP_TAG_PATTERN = re.compile(r'\[(/?)([a-z]+)(?:=([^\]]*))?\]')  # kivy markup tags, e.g. [b], [/b] or [ref=name]
+MARKUP_ESCAPES = (('&bl;', '['), ('&br;', ']'), ('&amp;', '&'))  # kivy escapes of literal brackets and ampersand
+
+BULK_LOAD = True  # build guide.db with executemany in a single transaction instead of row by row inserts
+BULK_LOAD_CACHE_SIZE_KIB = 64 * 1024
+STREAMING = False  # store articles in two passes over their JSON files, holding a single article in memory
+STREAMING_CACHE_SIZE_KIB = 8 * 1024  # page cache of guide.db stored in streaming mode, so it does not grow to the bulk one
+BULK_LOAD_TABLES_COLUMNS = {
+    'categories': ('id', 'name', 'icon', 'description'),
+    'tags': ('id', 'name'),
+    'tags_categories': ('tag_id', 'category_id'),
+    'articles': ('id', 'name', 'icon', 'title', 'synopsis'),
+    'tags_articles': ('tag_id', 'article_id'),
+    'subtitle_blocks': ('id', 'subtitle_text'),
+    'paragraph_blocks': ('id', 'paragraph_text'),
+    'image_blocks': ('id', 'image_source', 'image_width', 'image_height', 'caption_text'),
+    'audio_blocks': ('id', 'audio_source', 'audio_length', 'caption_text'),
+    'video_blocks': ('id', 'video_source', 'video_length', 'video_aspect_ratio', 'video_width', 'video_height',
+                     'video_cover_source', 'caption_text'),
+    'articles_blocks': ('article_id', 'block_id', 'block_order', 'block_type'),
+    'article_links': ('source_article_id', 'target_article_id', 'block_type', 'block_id'),
+    'article_block_spans': ('block_type', 'block_id', 'spans'),
+    'bookmarks': ('id', 'article_id', 'created_at'),
+    'article_block_search': ('article_id', 'block_order', 'block_type', 'block_id', 'block_text'),
+}
+
 
 class GuidePackager:
     @classmethod
-    def pack(cls, guide_name, guide_path):
+    def pack(cls, guide_name, guide_path, probe_executor=PROBE_EXECUTOR, probe_max_workers=PROBE_MAX_WORKERS,
+             media_cache_path=MEDIA_CACHE_PATH, bulk_load=BULK_LOAD, archive_compression=ARCHIVE_COMPRESSION,
+             archive_compresslevel=ARCHIVE_COMPRESSLEVEL, incremental=False, guide=None, search_index=SEARCH_INDEX,
+             db_page_size=DB_PAGE_SIZE, transcode_profile=TRANSCODE_PROFILE, delta=DELTA,
+             archive_layout=ARCHIVE_LAYOUT, progress=None, profiler=PACK_PROFILER, catalog=CATALOG,
+             streaming=STREAMING, markup_spans=MARKUP_SPANS):
         """ Public method which stores guide content into sqlite database and packs it together with multimedia assets
-            into a single zip archive file """
+            into a single zip archive file; media metadata are cached in media_cache_path (None disables the cache).
+            The guide content is taken from the guide model when provided (see GuideGenerator.generate_guide),
+            otherwise from the JSON files in the guide directory. In incremental mode the guide sources are kept and
+            only the parts affected by inputs changed since the last incremental packaging run are rebuilt.
+            The search_index ('fts4' or 'fts5') selects the full-text module of the article_block_search table.
+            Markup of the block texts is parsed once: refs between articles are stored in the article_links table
+            and, with markup_spans, the parsed spans of every block text in the article_block_spans table; names of
+            the referred articles which are missing in the guide are returned in the report under unresolved_refs
+            key with the number of articles referring to them (their refs are stored as [ref=]).
+            In streaming mode (ignored in incremental mode) the articles are stored one at a time from their JSON
+            files (the guide model articles are exported first), so memory use does not grow with their content.
+            With a transcode_profile (name of a profile in TRANSCODE_PROFILES or TranscodeProfile) media are
+            transcoded for the target devices and archived instead of their sources.
+            Before archiving, guide.db is finalized (rebuilt with db_page_size by VACUUM); the returned report holds
+            guide.db size in bytes before and after the finalization, errors of the videos whose covers failed to
+            be extracted keyed by the video source (their blocks have no cover), errors of the media which failed to
+            be transcoded keyed by the media source (their sources are archived instead) and the transcoded media
+            sources keyed by the media source. With delta, a delta package updating the replaced archive of the guide
+            into the new one is written beside it (see GuideDelta.create, its report is added to the returned one).
+            The archive_layout ('walk' or 'random_access') sets order and compression of the archive members.
+            Metrics of the run (stages times and counters, see PackMetrics) are returned in the report under metrics
+            key, stage events are passed to progress as they happen and the run is profiled by profiler (None,
+            'cprofile' or 'tracemalloc'), which dumps its results into PACK_PROFILES_PATH. With catalog, the entry of
+            the published archive in the dist directory catalog is updated (see GuideCatalog.update). """
+
+        if search_index not in ('fts4', 'fts5'):
+            raise ValueError('Provided a search index of unknown type.')
+        if db_page_size not in [2 ** exponent for exponent in range(9, 17)]:
+            raise ValueError('Provided a page size of unsupported value.')
+        if archive_layout not in ('walk', 'random_access'):
+            raise ValueError('Provided an archive layout of unknown type.')
+        if profiler not in (None, 'cprofile', 'tracemalloc'):
+            raise ValueError('Provided a profiler of unknown type.')
+        profile = MediaTranscoder.profile(transcode_profile)
+        metrics = PackMetrics(guide_name, progress)
 
-        cls._store_guide_content_in_db(guide_name, guide_path)
-        cls._pack_guide_content_to_archive(guide_name, guide_path)
+        if guide is not None:
+            # incremental packaging diffs the sources on disk and streaming reads them, otherwise only guide.json is
+            # needed in the archive
+            guide.export_json(guide_path, with_sources=incremental or streaming)
+
+        archive_path = os.path.join(DIST_PATH, f'{guide_name}.zip')
+        base_archive_path = cls._keep_base_archive(archive_path) if delta else None
+        try:
+            with metrics.profiled(profiler), metrics.stage('pack'):
+                if incremental:
+                    report = cls._pack_incrementally(guide_name, guide_path, probe_executor, probe_max_workers,
+                                                     media_cache_path, archive_compression, archive_compresslevel,
+                                                     search_index, db_page_size, profile, archive_layout,
+                                                     markup_spans, metrics)
+                else:
+                    with metrics.stage('store_db'):
+                        if streaming:
+                            report = cls._stream_guide_content_to_db(guide_name, guide_path, probe_executor,
+                                                                     probe_max_workers, media_cache_path,
+                                                                     search_index, profile, markup_spans, metrics)
+                        elif bulk_load:
+                            report = cls._bulk_store_guide_content_in_db(guide_name, guide_path, probe_executor,
+                                                                         probe_max_workers, media_cache_path, guide,
+                                                                         search_index, profile, markup_spans,
+                                                                         metrics)
+                        else:
+                            report = cls._store_guide_content_in_db(guide_name, guide_path, probe_executor,
+                                                                    probe_max_workers, media_cache_path, guide,
+                                                                    search_index, profile, markup_spans, metrics)
+                    with metrics.stage('finalize_db'):
+                        report.update(cls._finalize_guide_db(guide_path, db_page_size))
+                    with metrics.stage('archive'):
+                        cls._pack_guide_content_to_archive(guide_name, guide_path, archive_compression,
+                                                           archive_compresslevel, archive_layout, metrics)
+                    shutil.rmtree(guide_path)  # Delete temporary guide directory when finished
+                metrics.count('refs', 'unresolved', sum(report['unresolved_refs'].values()))
+                if catalog:
+                    with metrics.stage('catalog'):
+                        GuideCatalog.update(archive_path)
+                if base_archive_path is not None:
+                    with metrics.stage('delta'):
+                        report.update(GuideDelta.create(base_archive_path, archive_path))
+        finally:
+            if base_archive_path is not None:
+                os.remove(base_archive_path)
+        report['metrics'] = metrics.to_dict()
+        return report
+
+    @staticmethod
+    def _keep_base_archive(archive_path):
+        """ Private method which keeps the archive about to be replaced (hard linked, or copied where hard links are
+            not supported) as the base of the delta package and returns its path, or None if there is no archive """
+
+        if not os.path.exists(archive_path):
+            return None
+        base_archive_path = archive_path + '.base'
+        if os.path.exists(base_archive_path):
+            os.remove(base_archive_path)
+        try:
+            os.link(archive_path, base_archive_path)
+        except OSError:
+            shutil.copy2(archive_path, base_archive_path)
+        return base_archive_path
 
     @classmethod
-    def _store_guide_content_in_db(cls, guide_name, guide_path):
+    def _pack_incrementally(cls, guide_name, guide_path, probe_executor, probe_max_workers, media_cache_path,
+                            archive_compression, archive_compresslevel, search_index, db_page_size, profile,
+                            archive_layout, markup_spans, metrics):
+        """ Private method which packs the guide keeping its sources; guide.db rows, search index entries and archive
+            members are rebuilt only for the inputs changed since the last run recorded in the guide manifest.
+            Transcoded media are kept beside their sources and archived instead of them. """
+
+        archive_path = os.path.join(DIST_PATH, f'{guide_name}.zip')
+        db_path = os.path.join(guide_path, 'guide.db')
+        transcode_variant = MediaTranscoder.variant(profile) if profile is not None else None
+        manifest = GuideManifest.load(guide_path)
+        previous_transcoded_sources = manifest['transcoded_sources'] if manifest is not None else {}
+        if manifest is None or manifest.get('search_index') != search_index \
+                or manifest.get('markup_spans') != markup_spans \
+                or manifest.get('transcode_variant') != transcode_variant \
+                or not os.path.exists(db_path) or not os.path.exists(archive_path):
+            manifest = {'files': {}, 'articles': {}, 'media_sources': {}, 'transcoded_sources': {}}
+            if os.path.exists(db_path):
+                os.remove(db_path)
+        GuideManifest.remove(guide_path)  # a failed run leaves no manifest behind, so the next one rebuilds everything
+
+        with metrics.stage('hash_sources'):
+            files = GuideManifest.hash_files(guide_path, manifest['files'])
+        changed_files = GuideManifest.changed_files(manifest['files'], files)
+        metrics.count('source_files', 'hashed', len(files))
+        metrics.count('source_files', 'changed', len(changed_files))
+
+        articles_records = {}
+        changed_articles = {}
+        for path in sorted(files):
+            if os.path.dirname(path) != 'articles':
+                continue
+            article_json = os.path.basename(path)
+            if path in changed_files or article_json not in manifest['articles']:
+                changed_articles[article_json] = cls._load_article_json(guide_path, article_json)
+                articles_records[article_json] = GuideManifest.article_record(changed_articles[article_json])
+            else:
+                articles_records[article_json] = manifest['articles'][article_json]
+
+        media_hashes = {source: files[source]['sha256']
+                        for article_record in articles_records.values() for source in article_record['media']}
+        deduplicated_sources = cls._deduplicate_media_sources(media_hashes)
+        changed_media = {source for source in media_hashes if source in changed_files
+                         or deduplicated_sources[source] != manifest['media_sources'].get(source)}
+        removed_derived_files = set()  # derived again in this run, so they are not reused from the previous archive
+        for source in changed_media & changed_files:
+            for cover_filename in cls._video_covers_filenames(deduplicated_sources[source]):
+                if os.path.exists(os.path.join(guide_path, cover_filename)):
+                    os.remove(os.path.join(guide_path, cover_filename))  # covers of a changed video are extracted again
+                    removed_derived_files.add(cover_filename)
+        transcoded_sources = {}
+        for source, transcoded_source in previous_transcoded_sources.items():
+            if source in manifest['transcoded_sources'] and source in deduplicated_sources.values() \
+                    and source not in changed_files and transcoded_source in files:
+                transcoded_sources[source] = transcoded_source
+                media_hashes[transcoded_source] = files[transcoded_source]['sha256']
+            elif os.path.exists(os.path.join(guide_path, transcoded_source)):
+                os.remove(os.path.join(guide_path, transcoded_source))  # stale or transcoded for another profile
+                removed_derived_files.add(transcoded_source)
+        previous_names = {article_record['name'] for article_record in manifest['articles'].values()}
+        names = {article_record['name'] for article_record in articles_records.values()}
+        for article_json, article_record in articles_records.items():
+            if article_json in changed_articles:
+                continue
+            if changed_media.intersection(article_record['media']) \
+                    or (previous_names ^ names).intersection(article_record['refs']):
+                changed_articles[article_json] = cls._load_article_json(guide_path, article_json)
+
+        metrics.count('articles', 'changed', len(changed_articles))
+        metrics.count('articles', 'removed', len(previous_names - names))
+        articles_order_key = cls._articles_order_key(guide_path)  # new articles get ids in the guide content order
+        changed_articles = sorted(changed_articles.values(), key=lambda article: articles_order_key(article['name']))
+        with metrics.stage('store_db'):
+            report = cls._update_guide_content_in_db(guide_name, guide_path, changed_articles,
+                                                     previous_names - names, media_hashes, deduplicated_sources,
+                                                     probe_executor, probe_max_workers, media_cache_path,
+                                                     search_index, profile, markup_spans, metrics)
+        # unchanged articles are not parsed again, refs of all the articles are recorded in the manifest
+        report['unresolved_refs'] = cls._count_unresolved_refs(
+            [set(article_record['refs']) - names for article_record in articles_records.values()])
+        with metrics.stage('finalize_db'):
+            report.update(cls._finalize_guide_db(guide_path, db_page_size))
+        transcoded_sources.update(report['media_transcoded_sources'])
+
+        duplicate_sources = {source for source, deduplicated_source in deduplicated_sources.items()
+                             if source != deduplicated_source}
+        unchanged_paths = {path for path in files if path not in changed_files and path not in removed_derived_files}
+        with metrics.stage('archive'):
+            cls._pack_guide_content_to_archive(guide_name, guide_path, archive_compression, archive_compresslevel,
+                                               archive_layout, metrics,
+                                               excluded_paths=set(GUIDE_SOURCES_PATHS) | duplicate_sources
+                                               | set(transcoded_sources),
+                                               previous_archive_path=archive_path, reused_paths=unchanged_paths)
+
+        GuideManifest.save(guide_path, {'files': GuideManifest.hash_files(guide_path, files),
+                                        'articles': articles_records,
+                                        'media_sources': deduplicated_sources,
+                                        'search_index': search_index,
+                                        'markup_spans': markup_spans,
+                                        'transcode_variant': transcode_variant,
+                                        'transcoded_sources': transcoded_sources})
+        return report
+
+    @classmethod
+    def _store_guide_content_in_db(cls, guide_name, guide_path, probe_executor, probe_max_workers, media_cache_path,
+                                   guide, search_index, profile, markup_spans, metrics):
         """ Private method which stores guide content into sqlite database """
 
         conn = sqlite3.connect(os.path.join(guide_path, 'guide.db'))
 
-        cls._store_guide_categories_in_db(conn, guide_name, guide_path)
-        cls._store_guide_articles_in_db(conn, guide_name, guide_path)
-        cls._store_guide_bookmarks_in_db(conn, guide_path)
+        cls._store_guide_categories_in_db(conn, guide_name, guide_path, guide)
+        report = cls._store_guide_articles_in_db(conn, guide_name, guide_path, probe_executor, probe_max_workers,
+                                                 media_cache_path, guide, search_index, profile, markup_spans,
+                                                 metrics)
+        cls._store_guide_bookmarks_in_db(conn, guide_path, guide)
 
         conn.commit()
+        with metrics.stage('index_and_analyze'):
+            cls._create_query_indexes_and_analyze(conn)
+        cur = conn.cursor()
+        for table_name in BULK_LOAD_TABLES_COLUMNS:  # rows are inserted one by one into the new database
+            if table_name == 'article_block_spans' and not markup_spans:
+                continue
+            cur.execute(""" SELECT count(*) FROM {table}; """.format(table=table_name))
+            metrics.count('rows_inserted', table_name, cur.fetchone()[0])
+        conn.close()
+        return report
+
+    @classmethod
+    def _bulk_store_guide_content_in_db(cls, guide_name, guide_path, probe_executor, probe_max_workers,
+                                        media_cache_path, guide, search_index, profile, markup_spans, metrics):
+        """ Private method which stores guide content into sqlite database in bulk-load mode: tags and articles ids are
+            resolved in memory, rows are grouped per table (search index rows included) and written with executemany
+            in a single transaction """
+
+        conn = sqlite3.connect(os.path.join(guide_path, 'guide.db'))
+        cls._set_bulk_load_pragmas(conn)
+        cls._create_guide_tables(conn, search_index, markup_spans)
+
+        tables_rows = cls._empty_tables_rows(markup_spans)
+        tags_ids = {}
+        unresolved_refs = {}
+
+        cls._append_categories_rows(tables_rows, tags_ids, guide_name, cls._read_guide_categories(guide_path, guide))
+
+        articles_dicts = {}
+        for article_id, article in enumerate(cls._read_guide_articles(guide_path, guide), start=1):
+            cls._append_article_rows(tables_rows, tags_ids, guide_name, article_id, article)
+            articles_dicts[article['name']] = [article_id, article['content']]
+
+        media = cls._open_articles_media(guide_path, cls._articles_media_types(articles_dicts.values()),
+                                         probe_executor, probe_max_workers, media_cache_path, profile, metrics)
+        cls._append_articles_blocks_rows(tables_rows, dict.fromkeys(BULK_LOAD_TABLES_COLUMNS, 1), guide_name,
+                                         guide_path, articles_dicts, articles_dicts.values(), media, markup_spans,
+                                         unresolved_refs)
+        report = cls._close_articles_media(media)
+        report['unresolved_refs'] = unresolved_refs
+
+        cls._append_bookmarks_rows(tables_rows, articles_dicts, cls._read_guide_bookmarks(guide_path, guide))
+
+        with metrics.stage('db_inserts'):
+            for table_name, rows in tables_rows.items():
+                if table_name != 'article_block_search':
+                    cls._insert_many_into(conn, table_name, rows)
+                metrics.count('rows_inserted', table_name, len(rows))
+        with metrics.stage('search_index'):
+            cls._fill_article_block_search_table_with_rows(conn, tables_rows['article_block_search'])
+            conn.commit()
+            cls._optimize_article_block_search_table(conn)
+        with metrics.stage('index_and_analyze'):
+            cls._create_query_indexes_and_analyze(conn)
+
+        conn.close()
+        return report
+
+    @classmethod
+    def _stream_guide_content_to_db(cls, guide_name, guide_path, probe_executor, probe_max_workers, media_cache_path,
+                                    search_index, profile, markup_spans, metrics):
+        """ Private method which stores guide content into sqlite database in streaming mode, holding a single
+            article in memory: the first pass over the articles JSON files (in the guide content order) resolves the
+            articles names to ids (and stores the articles and their tags rows) and collects their media, the second
+            pass reads the articles one at a time again and stores their content blocks and search index rows. Only
+            the articles names and the media are kept for the whole run. The guide JSON files are deleted
+            afterwards. """
+
+        conn = sqlite3.connect(os.path.join(guide_path, 'guide.db'))
+        cls._set_bulk_load_pragmas(conn)
+        conn.execute(""" PRAGMA cache_size=-{cache_size}; """.format(cache_size=STREAMING_CACHE_SIZE_KIB))
+        cls._create_guide_tables(conn, search_index, markup_spans)
+
+        tables_rows = cls._empty_tables_rows(markup_spans)
+        tags_ids = {}
+        cls._append_categories_rows(tables_rows, tags_ids, guide_name, cls._read_guide_categories(guide_path, None))
+        cls._insert_tables_rows(conn, tables_rows, metrics)
+
+        articles_order_key = cls._articles_order_key(guide_path)
+        articles_jsons = sorted(os.listdir(os.path.join(guide_path, 'articles')),
+                                key=lambda article_json: articles_order_key(os.path.splitext(article_json)[0]))
+        articles_dicts = {}
+        media_sources_types = {}
+        with metrics.stage('resolve_articles'):
+            for article_id, article_json in enumerate(articles_jsons, start=1):
+                article = cls._load_article_json(guide_path, article_json)
+                tables_rows = cls._empty_tables_rows(markup_spans)
+                cls._append_article_rows(tables_rows, tags_ids, guide_name, article_id, article)
+                tables_rows['article_block_search'] = []  # stored together with the article blocks in the second pass
+                cls._insert_tables_rows(conn, tables_rows, metrics)
+                articles_dicts[article['name']] = [article_id, None]
+                media_sources_types.update(cls._articles_media_types([(article_id, article['content'])]))
+
+        media = cls._open_articles_media(guide_path, media_sources_types, probe_executor, probe_max_workers,
+                                         media_cache_path, profile, metrics)
+        tables_first_ids = dict.fromkeys(BULK_LOAD_TABLES_COLUMNS, 1)
+        unresolved_refs = {}
+        with metrics.stage('db_inserts'):
+            for article_id, article_json in enumerate(articles_jsons, start=1):
+                article = cls._load_article_json(guide_path, article_json)
+                tables_rows = cls._empty_tables_rows(markup_spans)
+                cls._append_article_search_rows(tables_rows, article_id, article)
+                cls._append_articles_blocks_rows(tables_rows, tables_first_ids, guide_name, guide_path,
+                                                 articles_dicts, [(article_id, article['content'])], media,
+                                                 markup_spans, unresolved_refs)
+                for table_name, rows in tables_rows.items():
+                    tables_first_ids[table_name] += len(rows)
+                cls._insert_tables_rows(conn, tables_rows, metrics)
+        report = cls._close_articles_media(media)
+        report['unresolved_refs'] = unresolved_refs
+        shutil.rmtree(os.path.join(guide_path, 'articles'))
+
+        tables_rows = cls._empty_tables_rows(markup_spans)
+        cls._append_bookmarks_rows(tables_rows, articles_dicts, cls._read_guide_bookmarks(guide_path, None))
+        cls._insert_tables_rows(conn, tables_rows, metrics)
+        with metrics.stage('search_index'):
+            conn.commit()
+            cls._optimize_article_block_search_table(conn)
+        with metrics.stage('index_and_analyze'):
+            cls._create_query_indexes_and_analyze(conn)
+
+        conn.close()
+        return report
+
+    @classmethod
+    def _update_guide_content_in_db(cls, guide_name, guide_path, changed_articles, removed_articles_names,
+                                    media_hashes, deduplicated_sources, probe_executor, probe_max_workers,
+                                    media_cache_path, search_index, profile, markup_spans, metrics):
+        """ Private method which updates guide content stored in sqlite database (creating the database if missing):
+            rows of the changed articles are rebuilt and rows of the removed articles deleted, while categories and
+            bookmarks, which are small, are always rebuilt """
+
+        db_path = os.path.join(guide_path, 'guide.db')
+        is_new_db = not os.path.exists(db_path)
+        conn = sqlite3.connect(db_path)
+        try:
+            cls._set_bulk_load_pragmas(conn)
+            if is_new_db:
+                cls._create_guide_tables(conn, search_index, markup_spans)
+
+            cur = conn.cursor()
+            tables_rows = cls._empty_tables_rows(markup_spans)
+            tables_first_ids = {table_name: cls._fetchone_max_id_from(conn, table_name) + 1
+                                for table_name, columns in BULK_LOAD_TABLES_COLUMNS.items() if 'id' in columns}
+            tags_ids = dict(cur.execute(""" SELECT name, id FROM tags ORDER BY id; """).fetchall())
+
+            cur.execute(""" DELETE FROM categories; """)
+            cur.execute(""" DELETE FROM tags_categories; """)
+            with open(os.path.join(guide_path, 'categories.json'), 'r') as f:
+                categories = json.load(f)
+            cls._append_categories_rows(tables_rows, tags_ids, guide_name, categories)
+
+            articles_ids = dict(cur.execute(""" SELECT name, id FROM articles; """).fetchall())
+            changed_articles_ids = [articles_ids.pop(name) for name in removed_articles_names]
+            next_article_id = tables_first_ids['articles']
+            articles_dicts = {name: [article_id, None] for name, article_id in articles_ids.items()}
+            for article in changed_articles:
+                if article['name'] in articles_ids:
+                    article_id = articles_ids[article['name']]
+                else:
+                    article_id = next_article_id
+                    next_article_id += 1
+                changed_articles_ids.append(article_id)
+                cls._append_article_rows(tables_rows, tags_ids, guide_name, article_id, article)
+                articles_dicts[article['name']] = [article_id, article['content']]
+            cls._delete_articles_rows(conn, changed_articles_ids, markup_spans)
+
+            media = cls._open_articles_media(guide_path,
+                                             cls._articles_media_types([articles_dicts[article['name']]
+                                                                        for article in changed_articles]),
+                                             probe_executor, probe_max_workers, media_cache_path, profile, metrics,
+                                             media_hashes, deduplicated_sources)
+            cls._append_articles_blocks_rows(tables_rows, tables_first_ids, guide_name, guide_path, articles_dicts,
+                                             [articles_dicts[article['name']] for article in changed_articles], media,
+                                             markup_spans, {})
+            report = cls._close_articles_media(media)
+
+            cur.execute(""" DELETE FROM bookmarks; """)
+            with open(os.path.join(guide_path, 'bookmarks.json'), 'r') as f:
+                bookmarks = json.load(f)
+            cls._append_bookmarks_rows(tables_rows, articles_dicts, bookmarks)
+
+            with metrics.stage('db_inserts'):
+                for table_name, rows in tables_rows.items():
+                    if table_name != 'article_block_search':
+                        cls._insert_many_into(conn, table_name, rows)
+                    metrics.count('rows_inserted', table_name, len(rows))
+                cur.execute(""" DELETE FROM tags WHERE id NOT IN (
+                                    SELECT tag_id FROM tags_articles UNION SELECT tag_id FROM tags_categories
+                                ); """)
+            with metrics.stage('search_index'):
+                cls._fill_article_block_search_table_with_rows(conn, tables_rows['article_block_search'])
+                conn.commit()
+                cls._optimize_article_block_search_table(conn)
+            with metrics.stage('index_and_analyze'):
+                cls._create_query_indexes_and_analyze(conn)
+            conn.close()
+            return report
+        except BaseException:
+            conn.close()
+            os.remove(db_path)  # the database is built without journal, so it is rebuilt from scratch next time
+            raise
+
+    @staticmethod
+    def _read_guide_categories(guide_path, guide):
+        """ Private method which returns the guide categories as dicts, taken from the guide model if provided,
+            otherwise read from categories.json, which is deleted afterwards """
+
+        if guide is not None:
+            return [category.to_dict() for category in guide.categories]
+        with open(os.path.join(guide_path, 'categories.json'), 'r') as f:
+            categories = json.load(f)
+        os.remove(os.path.join(guide_path, 'categories.json'))
+        return categories
+
+    @classmethod
+    def _read_guide_articles(cls, guide_path, guide):
+        """ Private method which returns the guide articles as dicts in the guide content order, taken from the guide
+            model if provided, otherwise read from the articles JSON files, which are deleted afterwards """
+
+        articles_order_key = cls._articles_order_key(guide_path, guide)
+        if guide is not None:
+            articles = [article.to_dict() for article in guide.articles]
+        else:
+            articles = [cls._load_article_json(guide_path, article_json)
+                        for article_json in os.listdir(os.path.join(guide_path, 'articles'))]
+            shutil.rmtree(os.path.join(guide_path, 'articles'))
+        return sorted(articles, key=lambda article: articles_order_key(article['name']))
+
+    @staticmethod
+    def _articles_order_key(guide_path, guide=None):
+        """ Private method which returns sort key of the article name: articles are stored (and their ids assigned)
+            in the guide content order, taken from the guide model if provided, otherwise from guide.json, so all the
+            packaging modes give the same guide.db; articles outside of the guide content come last by their names """
+
+        if guide is not None:
+            guide_content = guide.guide_content
+        else:
+            with open(os.path.join(guide_path, 'guide.json'), 'r') as f:
+                guide_content = json.load(f)['guide_content']
+        articles_orders = {article_item[0]: article_order for article_order, article_item in enumerate(guide_content)}
+        return lambda article_name: (articles_orders.get(article_name, len(articles_orders)), article_name)
+
+    @staticmethod
+    def _read_guide_bookmarks(guide_path, guide):
+        """ Private method which returns the guide bookmarks as dicts, taken from the guide model if provided,
+            otherwise read from bookmarks.json, which is deleted afterwards """
+
+        if guide is not None:
+            return [bookmark.to_dict() for bookmark in guide.bookmarks]
+        with open(os.path.join(guide_path, 'bookmarks.json'), 'r') as f:
+            bookmarks = json.load(f)
+        os.remove(os.path.join(guide_path, 'bookmarks.json'))
+        return bookmarks
+
+    @staticmethod
+    def _load_article_json(guide_path, article_json):
+        with open(os.path.join(guide_path, 'articles', article_json), 'r') as f:
+            return json.load(f)
+
+    @classmethod
+    def _append_categories_rows(cls, tables_rows, tags_ids, guide_name, categories):
+        for category_id, category in enumerate(categories, start=1):
+            tables_rows['categories'].append((category_id,
+                                              category['name'],
+                                              os.path.join('guides', guide_name, category['icon']),
+                                              category['description']))
+            for tag_name in dict.fromkeys(category['tags']):  # ids of new tags follow their order
+                tag_id = cls._resolve_tag_id(tables_rows, tags_ids, tag_name)
+                tables_rows['tags_categories'].append((tag_id, category_id))
+
+    @classmethod
+    def _append_article_rows(cls, tables_rows, tags_ids, guide_name, article_id, article):
+        tables_rows['articles'].append((article_id,
+                                        article['name'],
+                                        os.path.join('guides', guide_name, article['icon']),
+                                        article['title'],
+                                        article['synopsis']))
+        cls._append_article_search_rows(tables_rows, article_id, article)
+        for tag_name in dict.fromkeys(article['tags']):
+            tag_id = cls._resolve_tag_id(tables_rows, tags_ids, tag_name)
+            tables_rows['tags_articles'].append((tag_id, article_id))
+
+    @staticmethod
+    def _append_article_search_rows(tables_rows, article_id, article):
+        tables_rows['article_block_search'].append((article_id, -2, 'title', None, article['title']))
+        tables_rows['article_block_search'].append((article_id, -1, 'synopsis', None, article['synopsis']))
+
+    @classmethod
+    def _append_articles_blocks_rows(cls, tables_rows, tables_first_ids, guide_name, guide_path, articles_dicts,
+                                     articles_ids_contents, media, markup_spans, unresolved_refs):
+        """ Private method which appends content blocks rows (and their search index, links and, with markup_spans,
+            spans rows) of the articles given as pairs of article id and content; ids of the blocks of each type are
+            assigned consecutively from tables_first_ids. Names of the missing articles the blocks refer to are
+            counted (once per article) in unresolved_refs """
+
+        for article_id, article_content in articles_ids_contents:
+            block_order = 0
+            article_unresolved_refs = set()
+            for block in article_content:
+                block_values = cls._article_block_values(block, guide_name, guide_path, media)
+                if block_values is None:
+                    continue
+                # text (or caption) is the last column of every block table
+                text, spans, targets_ids, block_unresolved_refs = cls._parse_markup(block_values[-1], articles_dicts)
+                block_values = block_values[:-1] + (text,)
+                block_table_name = block['type'] + '_blocks'
+                block_id = tables_first_ids[block_table_name] + len(tables_rows[block_table_name])
+                tables_rows[block_table_name].append((block_id,) + block_values)
+                tables_rows['articles_blocks'].append((article_id, block_id, block_order, block['type']))
+                tables_rows['article_block_search'].append((article_id, block_order, block['type'], block_id, text))
+                tables_rows['article_links'] += [(article_id, target_id, block['type'], block_id)
+                                                 for target_id in targets_ids]
+                if markup_spans:
+                    tables_rows['article_block_spans'].append((block['type'], block_id, json.dumps(spans)))
+                article_unresolved_refs.update(block_unresolved_refs)
+                block_order += 1
+            cls._count_unresolved_refs([article_unresolved_refs], unresolved_refs)
+
+    @staticmethod
+    def _count_unresolved_refs(articles_unresolved_refs, unresolved_refs=None):
+        """ Private method which counts names of the unresolved refs (given as sets of the names, one per article)
+            into unresolved_refs dict keyed by the name and returns it """
+
+        unresolved_refs = {} if unresolved_refs is None else unresolved_refs
+        for article_unresolved_refs in articles_unresolved_refs:
+            for name in article_unresolved_refs:
+                unresolved_refs[name] = unresolved_refs.get(name, 0) + 1
+        return unresolved_refs
+
+    @staticmethod
+    def _append_bookmarks_rows(tables_rows, articles_dicts, bookmarks):
+        for bookmark_id, bookmark in enumerate(bookmarks, start=1):
+            article_id = articles_dicts[bookmark['article_name']][0]
+            tables_rows['bookmarks'].append((bookmark_id, article_id, bookmark['created_at']))
+
+    @staticmethod
+    def _delete_articles_rows(conn, articles_ids, markup_spans):
+        """ Private method which deletes rows of the articles together with their tags, content blocks (and their
+            spans, if stored), links to other articles and search index entries """
+
+        cur = conn.cursor()
+        cur.execute(""" CREATE TEMP TABLE deleted_articles (id integer PRIMARY KEY); """)
+        cur.executemany(""" INSERT INTO deleted_articles (id) VALUES (?); """,
+                        [(article_id,) for article_id in articles_ids])
+        for block_type in ('subtitle', 'paragraph', 'image', 'audio', 'video'):
+            cur.execute(""" DELETE FROM {block_type}_blocks WHERE id IN (
+                                SELECT block_id FROM articles_blocks
+                                WHERE block_type=? AND article_id IN deleted_articles
+                            ); """.format(block_type=block_type), (block_type,))
+        if markup_spans:
+            cur.execute(""" DELETE FROM article_block_spans WHERE (block_type, block_id) IN (
+                                SELECT block_type, block_id FROM articles_blocks
+                                WHERE article_id IN deleted_articles
+                            ); """)
+        cur.execute(""" DELETE FROM articles_blocks WHERE article_id IN deleted_articles; """)
+        cur.execute(""" DELETE FROM article_links WHERE source_article_id IN deleted_articles; """)
+        cur.execute(""" DELETE FROM tags_articles WHERE article_id IN deleted_articles; """)
+        cur.execute(""" DELETE FROM article_block_search WHERE article_id IN deleted_articles; """)
+        cur.execute(""" DELETE FROM articles WHERE id IN deleted_articles; """)
+        cur.execute(""" DROP TABLE deleted_articles; """)
+
+    @staticmethod
+    def _fetchone_max_id_from(conn, table_name):
+        cur = conn.cursor()
+        cur.execute(""" SELECT max(id) FROM {table}; """.format(table=table_name))
+        return cur.fetchone()[0] or 0
+
+    @staticmethod
+    def _finalize_guide_db(guide_path, db_page_size):
+        """ Private method which rebuilds the finished guide.db by VACUUM with given page size, so the shipped
+            database has no free pages and its tables and indexes are stored contiguously """
+
+        db_path = os.path.join(guide_path, 'guide.db')
+        report = {'db_size_before': os.path.getsize(db_path)}
+        conn = sqlite3.connect(db_path)
+        cur = conn.cursor()
+        cur.execute(""" PRAGMA page_size={page_size}; """.format(page_size=db_page_size))
+        cur.execute(""" VACUUM; """)
         conn.close()
+        report['db_size_after'] = os.path.getsize(db_path)
+        return report
 
     @staticmethod
-    def _pack_guide_content_to_archive(guide_name, guide_path):
+    def _create_query_indexes_and_analyze(conn):
+        """ Private method which creates indexes for the app's queries (when missing) after the tables are filled and
+            gathers planner statistics, which are shipped in the sqlite_stat1 table of guide.db """
+
+        cur = conn.cursor()
+        for index_name, index_on in QUERY_INDEXES.items():
+            cur.execute(""" CREATE INDEX IF NOT EXISTS {index} ON {on}; """.format(index=index_name, on=index_on))
+        cur.execute(""" ANALYZE; """)
+        conn.commit()
+
+    @classmethod
+    def _pack_guide_content_to_archive(cls, guide_name, guide_path, archive_compression, archive_compresslevel,
+                                       archive_layout, metrics, excluded_paths=(), previous_archive_path=None,
+                                       reused_paths=()):
         """ Private method which packs guide stored in database together with its multimedia assets
-            into a single zip archive file """
+            into a single zip archive file; already compressed media are stored, other files are compressed
+            in parallel and the archive is streamed into the dist directory through a temporary file. Files in
+            reused_paths are copied from the previous archive as they are, without recompression. In random access
+            layout the archive starts with an index of its members data, followed by guide.json and guide.db stored
+            uncompressed and aligned, the icons and the media in articles order. """
 
-        file_paths = []
-        project_root = os.getcwd()
-        os.chdir(guide_path)
-        for root, directory, files in os.walk('.'):
+        if archive_compression not in (ZIP_DEFLATED, ZIP_LZMA):
+            raise ValueError('Provided an archive compression of unsupported type.')
+        if archive_layout == 'random_access' and not ArchiveWriter.supported():
+            raise ValueError('Provided random access archive layout, which zipfile of this Python version does not '
+                             'support.')
+        members = []
+        for root, directory, files in os.walk(guide_path):
             for filename in files:
-                filepath = os.path.join(root, filename)
-                file_paths.append(filepath)
-        with ZipFile(f'{guide_name}.zip', 'w') as zipf:
-            for file in file_paths:
-                zipf.write(file)
-        os.chdir(project_root)
-        os.rename(os.path.join(guide_path, f'{guide_name}.zip'), os.path.join(DIST_PATH, f'{guide_name}.zip'))
-        shutil.rmtree(guide_path)  # Delete temporary guide directory when finished
+                file_path = os.path.join(root, filename)
+                arcname = os.path.relpath(file_path, guide_path)
+                if filename == MANIFEST_FILENAME or arcname in excluded_paths \
+                        or arcname.split(os.sep)[0] in excluded_paths:
+                    continue
+                members.append((file_path, arcname))
+        aligned_arcnames = ()
+        if archive_layout == 'random_access':
+            members = cls._order_archive_members(guide_name, guide_path, members)
+            aligned_arcnames = ARCHIVE_ALIGNED_FILENAMES
+
+        # members are compressed in parallel and reused members copied only by the archive writer, with zipfile of
+        # a Python version it does not support, they are compressed one by one by zipfile
+        raw_write = ArchiveWriter.supported()
+        previous_archive_file = None
+        previous_zinfos = {}
+        reused_arcnames = set()
+        if raw_write and previous_archive_path is not None and reused_paths and os.path.exists(previous_archive_path):
+            previous_archive_file = open(previous_archive_path, 'rb')
+            with ZipFile(previous_archive_file, 'r') as previous_zipf:
+                previous_zinfos = {zinfo.filename: zinfo for zinfo in previous_zipf.infolist()}
+            reused_arcnames = {arcname for file_path, arcname in members
+                               if arcname in reused_paths and arcname not in aligned_arcnames
+                               and arcname.replace(os.sep, '/') in previous_zinfos}
+        archive_fd, archive_tmp_path = tempfile.mkstemp(suffix='.zip.part', dir=DIST_PATH)
+        try:
+            with os.fdopen(archive_fd, 'wb') as archive_file, ZipFile(archive_file, 'w') as zipf, \
+                    ThreadPoolExecutor(max_workers=ARCHIVE_MAX_WORKERS) as executor:
+                compressed_arcnames = {arcname for file_path, arcname in members
+                                       if arcname not in aligned_arcnames and arcname not in reused_arcnames
+                                       and os.path.splitext(arcname)[1].lower() not in ARCHIVE_STORED_EXTENSIONS}
+                compressed_members = {arcname: executor.submit(cls._compress_archive_member, file_path, arcname,
+                                                               archive_compression, archive_compresslevel)
+                                      for file_path, arcname in members if raw_write and arcname in compressed_arcnames}
+                index_zinfo = None
+                if archive_layout == 'random_access':
+                    index_zinfo = cls._reserve_archive_index(zipf, members)
+                index_members = {}
+                for file_path, arcname in members:
+                    if arcname in aligned_arcnames:
+                        cls._write_aligned_archive_member(zipf, file_path, arcname)
+                    elif arcname in reused_arcnames:
+                        ArchiveWriter.copy_member(zipf, previous_archive_file,
+                                                  previous_zinfos[arcname.replace(os.sep, '/')])
+                    elif arcname in compressed_members:
+                        cls._write_compressed_archive_member(zipf, *compressed_members.pop(arcname).result())
+                    elif arcname in compressed_arcnames:
+                        zipf.write(file_path, arcname, compress_type=archive_compression,
+                                   compresslevel=archive_compresslevel)
+                    else:
+                        zipf.write(file_path, arcname, compress_type=ZIP_STORED)
+                    zinfo = zipf.infolist()[-1]
+                    index_members[zinfo.filename] = {
+                        'offset': archive_file.tell() - zinfo.compress_size,  # the member data end with the archive
+                        'length': zinfo.compress_size,
+                        'size': zinfo.file_size,
+                        'compression': ARCHIVE_COMPRESSION_NAMES[zinfo.compress_type],
+                    }
+                if index_zinfo is not None:
+                    cls._write_archive_index(zipf, index_zinfo, index_members)
+                for zinfo in zipf.infolist():
+                    metrics.count('archive_bytes', ARCHIVE_COMPRESSION_NAMES[zinfo.compress_type], zinfo.compress_size)
+                    metrics.count('archive_members', ARCHIVE_COMPRESSION_NAMES[zinfo.compress_type])
+                metrics.count('archive_members', 'reused', len(reused_arcnames))
+            os.chmod(archive_tmp_path, 0o644)  # mkstemp creates files readable only by the owner
+            os.replace(archive_tmp_path, os.path.join(DIST_PATH, f'{guide_name}.zip'))
+        except BaseException:
+            os.remove(archive_tmp_path)
+            raise
+        finally:
+            if previous_archive_file is not None:
+                previous_archive_file.close()
 
     @classmethod
-    def _store_guide_categories_in_db(cls, conn, guide_name, guide_path):
-        with open(os.path.join(guide_path, 'categories.json'), 'r') as f:
-            categories = json.load(f)
+    def _order_archive_members(cls, guide_name, guide_path, members):
+        """ Private method which orders the archive members for random access layout: guide.json and guide.db first,
+            then the icons and the media in order of their first use by the articles in guide content order (video
+            followed by its cover and the cover thumbnails), other files last, each group in directory walk order """
+
+        with open(os.path.join(guide_path, 'guide.json')) as f:
+            content_names = [article_item[0] for article_item in json.load(f)['guide_content']]
+        articles_orders = {article_name: article_order for article_order, article_name in enumerate(content_names)}
+
+        conn = sqlite3.connect(os.path.join(guide_path, 'guide.db'))
+        cur = conn.cursor()
+        cur.execute(""" SELECT a.name, ib.image_source, aub.audio_source, vb.video_source, vb.video_cover_source
+                        FROM articles_blocks AS ab
+                        JOIN articles AS a ON a.id=ab.article_id
+                        LEFT JOIN image_blocks AS ib ON ib.id=ab.block_id AND ab.block_type='image'
+                        LEFT JOIN audio_blocks AS aub ON aub.id=ab.block_id AND ab.block_type='audio'
+                        LEFT JOIN video_blocks AS vb ON vb.id=ab.block_id AND ab.block_type='video'
+                        WHERE ab.block_type IN ('image', 'audio', 'video')
+                        ORDER BY ab.article_id, ab.block_order; """)
+        media_rows = cur.fetchall()
+        conn.close()
+        media_rows.sort(key=lambda row: articles_orders.get(row[0], len(articles_orders)))  # sort is stable
+
+        guide_source_path = os.path.join('guides', guide_name)
+        media_orders = {}
+        for article_name, *sources in media_rows:
+            video_cover_source = sources.pop()
+            if video_cover_source is not None:
+                cover_name = os.path.splitext(video_cover_source)[0]
+                sources.append(video_cover_source)
+                sources += [f'{cover_name}_{width}.png' for width in VIDEO_COVER_THUMBNAIL_WIDTHS]
+            for source in sources:
+                if source is not None:
+                    media_orders.setdefault(os.path.relpath(source, guide_source_path), len(media_orders))
+
+        def member_order(member):
+            arcname = member[1]
+            if arcname in ARCHIVE_ALIGNED_FILENAMES:
+                return 0, ARCHIVE_ALIGNED_FILENAMES.index(arcname)
+            if arcname.split(os.sep)[0] == 'icons':
+                return 1, 0
+            if arcname in media_orders:
+                return 2, media_orders[arcname]
+            return 3, 0
+
+        return sorted(members, key=member_order)  # sort is stable, so the walk order is kept within the groups
+
+    @classmethod
+    def _reserve_archive_index(cls, zipf, members):
+        """ Private method which writes the archive index member with its data reserved for the offsets of the members
+            written after it; offsets and lengths in the index are bounded by twice the size of the members files
+            (compressed members can grow a little), so the index is reserved with numbers of that many digits """
+
+        max_archive_size = 2 * (sum(os.path.getsize(file_path) + len(arcname) for file_path, arcname in members)
+                                + len(members) * 1024 + len(ARCHIVE_ALIGNED_FILENAMES) * ARCHIVE_ALIGNMENT)
+        max_number = 10 ** len(str(max_archive_size)) - 1
+        reserved_members = {arcname.replace(os.sep, '/'): {'offset': max_number, 'length': max_number,
+                                                           'size': max_number, 'compression': 'deflated'}
+                            for file_path, arcname in members}
+        reserved_data = b' ' * len(cls._archive_index_data(reserved_members))
+        zinfo = ZipInfo(ARCHIVE_INDEX_FILENAME, time.localtime()[:6])
+        zinfo.compress_type = ZIP_STORED
+        zinfo.external_attr = 0o644 << 16
+        zinfo.CRC = zlib.crc32(reserved_data)  # the index is not known yet, the member is rewritten together with it
+        zinfo.file_size = zinfo.compress_size = len(reserved_data)
+        ArchiveWriter.write_member(zipf, zinfo, io.BytesIO(reserved_data))
+        return zinfo
+
+    @classmethod
+    def _write_archive_index(cls, zipf, zinfo, index_members):
+        """ Private method which writes the index of the members data into its reserved member; the index is padded
+            with trailing whitespace to the reserved size """
+
+        index_data = cls._archive_index_data(index_members)
+        if len(index_data) > zinfo.file_size:
+            raise RuntimeError('Archive index exceeds its reserved size.')
+        index_data += b' ' * (zinfo.file_size - len(index_data))
+        ArchiveWriter.rewrite_member(zipf, zinfo, index_data)
+
+    @staticmethod
+    def _archive_index_data(index_members):
+        """ Private method which serializes the archive index: offsets (from the archive start), lengths, uncompressed
+            sizes and compression of the members data keyed by the member name, in the archive order """
+
+        return json.dumps({'version': ARCHIVE_INDEX_VERSION, 'alignment': ARCHIVE_ALIGNMENT, 'members': index_members},
+                          separators=(',', ':')).encode()
+
+    @staticmethod
+    def _write_aligned_archive_member(zipf, file_path, arcname):
+        """ Private method which stores a file uncompressed into the archive with its data aligned to the archive
+            alignment, so the member can be memory mapped right from the archive """
+
+        zinfo = ZipInfo.from_file(file_path, arcname)
+        zinfo.compress_type = ZIP_STORED
+        crc = 0
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(ARCHIVE_CHUNK_SIZE), b''):
+                crc = zlib.crc32(chunk, crc)
+        zinfo.CRC = crc
+        zinfo.compress_size = zinfo.file_size
+        with open(file_path, 'rb') as f:
+            ArchiveWriter.write_member(zipf, zinfo, f, alignment=ARCHIVE_ALIGNMENT)
+
+    @staticmethod
+    def _compress_archive_member(file_path, arcname, compression, compresslevel):
+        """ Private method which compresses a file into the zip member data (zlib and lzma release GIL, so members
+            are compressed in parallel threads) and returns the member info together with the compressed data file
+            (in memory, or spooled into a temporary file when bigger than ARCHIVE_SPOOL_MAX_SIZE) """
+
+        zinfo = ZipInfo.from_file(file_path, arcname)
+        zinfo.compress_type = compression
+        if compression == ZIP_LZMA:
+            zinfo.flag_bits |= 0x02  # end of stream marker is present
+        compressor, data_header = ArchiveWriter.compressor(compression, compresslevel)
+        compressed_file = tempfile.SpooledTemporaryFile(max_size=ARCHIVE_SPOOL_MAX_SIZE)
+        compressed_file.write(data_header)
+        crc = 0
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(ARCHIVE_CHUNK_SIZE), b''):
+                crc = zlib.crc32(chunk, crc)
+                compressed_file.write(compressor.compress(chunk))
+        compressed_file.write(compressor.flush())
+        zinfo.CRC = crc
+        zinfo.compress_size = compressed_file.tell()
+        compressed_file.seek(0)
+        return zinfo, compressed_file
+
+    @staticmethod
+    def _write_compressed_archive_member(zipf, zinfo, compressed_file):
+        """ Private method which appends already compressed member data (read from the compressed data file, which
+            is closed afterwards) to the archive """
+
+        with compressed_file:
+            ArchiveWriter.write_member(zipf, zinfo, compressed_file)
+
+    @classmethod
+    def _store_guide_categories_in_db(cls, conn, guide_name, guide_path, guide):
+        categories = cls._read_guide_categories(guide_path, guide)
         cls._create_categories_table(conn)
         cls._create_tags_table(conn)
         cls._create_tags_categories_table(conn)
@@ -71,21 +956,20 @@ class GuidePackager:
                 conn, (category['name'],
                        os.path.join('guides', guide_name, category['icon']),
                        category['description']))
-            for tag_name in set(category['tags']):
+            for tag_name in dict.fromkeys(category['tags']):
                 tag_row = cls._fetchone_from_tags_where_name(conn, tag_name)
                 if tag_row is not None:
                     tag_id = tag_row[0]
                 else:
                     tag_id = cls._insert_into_tags(conn, tag_name)
                 cls._insert_into_tags_categories(conn, (tag_id, category_id))
-        os.remove(os.path.join(guide_path, 'categories.json'))
 
     @classmethod
-    def _store_guide_articles_in_db(cls, conn, guide_name, guide_path):
+    def _store_guide_articles_in_db(cls, conn, guide_name, guide_path, probe_executor, probe_max_workers,
+                                    media_cache_path, guide, search_index, profile, markup_spans, metrics):
         cls._create_articles_table(conn)
         cls._create_tags_articles_table(conn)
-        cls._fill_articles_tags_articles_tables(conn, guide_name, guide_path)
-        shutil.rmtree(os.path.join(guide_path, 'articles'))
+        cls._fill_articles_tags_articles_tables(conn, guide_name, guide_path, guide)
 
         cls._create_articles_blocks_table(conn)
         cls._create_subtitle_blocks_table(conn)
@@ -93,19 +977,98 @@ class GuidePackager:
         cls._create_image_blocks_table(conn)
         cls._create_audio_blocks_table(conn)
         cls._create_video_blocks_table(conn)
+        cls._create_article_links_table(conn)
+        if markup_spans:
+            cls._create_article_block_spans_table(conn)
 
-        cls._fill_articles_content_block_tables(conn, guide_name, guide_path)
-        cls._create_and_fill_article_block_search_table(conn)
+        report = cls._fill_articles_content_block_tables(conn, guide_name, guide_path, probe_executor,
+                                                         probe_max_workers, media_cache_path, profile, markup_spans,
+                                                         metrics)
+        with metrics.stage('search_index'):
+            cls._create_and_fill_article_block_search_table(conn, search_index)
+        return report
 
     @classmethod
-    def _store_guide_bookmarks_in_db(cls, conn, guide_path):
-        with open(os.path.join(guide_path, 'bookmarks.json'), 'r') as f:
-            bookmarks = json.load(f)
+    def _store_guide_bookmarks_in_db(cls, conn, guide_path, guide):
+        bookmarks = cls._read_guide_bookmarks(guide_path, guide)
         cls._create_bookmarks_table(conn)
         for bookmark in bookmarks:
             article_id = cls._fetchone_from_articles_where_name(conn, bookmark['article_name'])[0]
             cls._insert_into_bookmarks(conn, (article_id, bookmark['created_at']))
-        os.remove(os.path.join(guide_path, 'bookmarks.json'))
+
+    @classmethod
+    def _create_guide_tables(cls, conn, search_index, markup_spans):
+        """ Private method which creates the guide.db tables filled in bulk (articles without content column,
+            the full-text table of search_index module and, with markup_spans, the block spans table) """
+
+        cls._create_categories_table(conn)
+        cls._create_tags_table(conn)
+        cls._create_tags_categories_table(conn)
+        cls._create_articles_table_without_content(conn)
+        cls._create_tags_articles_table(conn)
+        cls._create_articles_blocks_table(conn)
+        cls._create_subtitle_blocks_table(conn)
+        cls._create_paragraph_blocks_table(conn)
+        cls._create_image_blocks_table(conn)
+        cls._create_audio_blocks_table(conn)
+        cls._create_video_blocks_table(conn)
+        cls._create_article_links_table(conn)
+        if markup_spans:
+            cls._create_article_block_spans_table(conn)
+        cls._create_bookmarks_table(conn)
+        cls._create_article_block_search_table(conn, search_index)
+
+    @staticmethod
+    def _set_bulk_load_pragmas(conn):
+        """ Private method which trades durability of the database being built for insert speed; the database is
+            rebuilt from scratch on failure anyway """
+
+        cur = conn.cursor()
+        cur.execute(""" PRAGMA journal_mode=OFF; """)
+        cur.execute(""" PRAGMA synchronous=OFF; """)
+        cur.execute(""" PRAGMA temp_store=MEMORY; """)
+        cur.execute(""" PRAGMA cache_size=-{cache_size}; """.format(cache_size=BULK_LOAD_CACHE_SIZE_KIB))
+
+    @staticmethod
+    def _resolve_tag_id(tables_rows, tags_ids, tag_name):
+        """ Private method which returns id of the tag from in-memory tags map, adding a new tags row if missing; the
+            map is kept in ascending order of the ids, so the new id follows the last one """
+
+        if tag_name not in tags_ids:
+            tags_ids[tag_name] = next(reversed(tags_ids.values()), 0) + 1
+            tables_rows['tags'].append((tags_ids[tag_name], tag_name))
+        return tags_ids[tag_name]
+
+    @staticmethod
+    def _empty_tables_rows(markup_spans):
+        """ Private method which returns empty rows keyed by the name of every table created in the guide database,
+            so rows_inserted counter holds the same tables in every packaging mode """
+
+        return {table_name: [] for table_name in BULK_LOAD_TABLES_COLUMNS
+                if markup_spans or table_name != 'article_block_spans'}
+
+    @classmethod
+    def _insert_tables_rows(cls, conn, tables_rows, metrics):
+        """ Private method which inserts the rows of the tables keyed by the table name, the search index rows (in
+            order of article id and block order) included """
+
+        for table_name, rows in tables_rows.items():
+            if rows and table_name != 'article_block_search':
+                cls._insert_many_into(conn, table_name, rows)
+            metrics.count('rows_inserted', table_name, len(rows))
+        if tables_rows['article_block_search']:
+            cls._fill_article_block_search_table_with_rows(conn, tables_rows['article_block_search'])
+
+    @staticmethod
+    def _insert_many_into(conn, table_name, rows):
+        if not rows:
+            return
+        columns = BULK_LOAD_TABLES_COLUMNS[table_name]
+        cur = conn.cursor()
+        cur.executemany(""" INSERT INTO {table} ({columns})
+                            VALUES ({placeholders}); """.format(table=table_name,
+                                                                 columns=', '.join(columns),
+                                                                 placeholders=', '.join('?' * len(columns))), rows)
 
     @staticmethod
     def _create_categories_table(conn):
@@ -131,8 +1094,8 @@ class GuidePackager:
         cur.execute(""" CREATE TABLE tags_categories (
                             tag_id integer NOT NULL,
                             category_id integer NOT NULL,
-                            UNIQUE(tag_id, category_id)
-                        ); """)
+                            PRIMARY KEY(tag_id, category_id)
+                        ) WITHOUT ROWID; """)
 
     @staticmethod
     def _insert_into_categories(conn, values):
@@ -172,22 +1135,29 @@ class GuidePackager:
                             content text
                         ); """)
 
+    @staticmethod
+    def _create_articles_table_without_content(conn):
+        cur = conn.cursor()
+        cur.execute(""" CREATE TABLE articles (
+                            id integer PRIMARY KEY,
+                            name text UNIQUE NOT NULL,
+                            icon text,
+                            title text,
+                            synopsis text
+                        ); """)
+
     @staticmethod
     def _create_tags_articles_table(conn):
         cur = conn.cursor()
         cur.execute(""" CREATE TABLE tags_articles (
                             tag_id integer NOT NULL,
                             article_id integer NOT NULL,
-                            UNIQUE(tag_id, article_id)
-                        ); """)
+                            PRIMARY KEY(tag_id, article_id)
+                        ) WITHOUT ROWID; """)
 
     @classmethod
-    def _fill_articles_tags_articles_tables(cls, conn, guide_name, guide_path):
-        articles_jsons = [filename for filename in os.listdir(os.path.join(guide_path, 'articles'))]
-        for article_json in articles_jsons:
-            with open(os.path.join(guide_path, 'articles', article_json), 'r') as f:
-                article = json.load(f)
-
+    def _fill_articles_tags_articles_tables(cls, conn, guide_name, guide_path, guide):
+        for article in cls._read_guide_articles(guide_path, guide):
             article_id = cls._insert_into_articles(
                 conn, (article['name'],
                        os.path.join('guides', guide_name, article['icon']),
@@ -195,7 +1165,7 @@ class GuidePackager:
                        article['synopsis'],
                        json.dumps(article['content'])))
 
-            for tag_name in set(article['tags']):
+            for tag_name in dict.fromkeys(article['tags']):
                 tag_row = cls._fetchone_from_tags_where_name(conn, tag_name)
                 if tag_row is not None:
                     tag_id = tag_row[0]
@@ -211,8 +1181,34 @@ class GuidePackager:
                             block_id integer NOT NULL,
                             block_order integer NOT NULL,
                             block_type text NOT NULL,
-                            UNIQUE(article_id, block_id, block_order, block_type)
-                        ); """)
+                            PRIMARY KEY(article_id, block_order, block_type, block_id)
+                        ) WITHOUT ROWID; """)
+
+    @staticmethod
+    def _create_article_links_table(conn):
+        """ Private method which creates table of the refs between articles, a row per block and referred article;
+            its primary key leads with the referred article, so articles linking to an article are looked up by it """
+
+        cur = conn.cursor()
+        cur.execute(""" CREATE TABLE article_links (
+                            source_article_id integer NOT NULL,
+                            target_article_id integer NOT NULL,
+                            block_type text NOT NULL,
+                            block_id integer NOT NULL,
+                            PRIMARY KEY(target_article_id, source_article_id, block_type, block_id)
+                        ) WITHOUT ROWID; """)
+
+    @staticmethod
+    def _create_article_block_spans_table(conn):
+        """ Private method which creates table of the parsed markup spans of the block texts (see _parse_markup) """
+
+        cur = conn.cursor()
+        cur.execute(""" CREATE TABLE article_block_spans (
+                            block_type text NOT NULL,
+                            block_id integer NOT NULL,
+                            spans text NOT NULL,
+                            PRIMARY KEY(block_type, block_id)
+                        ) WITHOUT ROWID; """)
 
     @staticmethod
     def _create_subtitle_blocks_table(conn):
@@ -236,6 +1232,8 @@ class GuidePackager:
         cur.execute(""" CREATE TABLE image_blocks (
                             id integer PRIMARY KEY,
                             image_source text NOT NULL,
+                            image_width integer,
+                            image_height integer,
                             caption_text text
                         ); """)
 
@@ -258,107 +1256,423 @@ class GuidePackager:
                             video_source text NOT NULL,
                             video_length real,
                             video_aspect_ratio text,
+                            video_width integer,
+                            video_height integer,
                             video_cover_source text,
                             caption_text text
                         ); """)
 
     @classmethod
-    def _fill_articles_content_block_tables(cls, conn, guide_name, guide_path):
+    def _fill_articles_content_block_tables(cls, conn, guide_name, guide_path, probe_executor, probe_max_workers,
+                                            media_cache_path, profile, markup_spans, metrics):
         articles_rows = cls._fetchall_id_name_content_from_articles(conn)
-        articles_dicts = {row[1]: [row[0], row[2]] for row in articles_rows}
+        articles_dicts = {row[1]: [row[0], json.loads(row[2])] for row in articles_rows}
+        media = cls._open_articles_media(guide_path, cls._articles_media_types(articles_dicts.values()),
+                                         probe_executor, probe_max_workers, media_cache_path, profile, metrics)
+        articles_unresolved_refs = []
         for article_name in articles_dicts:
-            article_id = articles_dicts[article_name][0]
-            article_content = json.loads(articles_dicts[article_name][1])
+            article_id, article_content = articles_dicts[article_name]
             block_order = 0
+            articles_unresolved_refs.append(set())
             for block in article_content:
+                block_values = cls._article_block_values(block, guide_name, guide_path, media)
+                if block_values is None:
+                    continue
+                text, spans, targets_ids, block_unresolved_refs = cls._parse_markup(block_values[-1], articles_dicts)
+                block_values = block_values[:-1] + (text,)
                 if block['type'] == 'subtitle':
-                    updated_refs_paragraph = cls._update_text_refs(block['text'], articles_dicts)
-                    block_id = cls._insert_into_subtitle_blocks(conn, updated_refs_paragraph)
+                    block_id = cls._insert_into_subtitle_blocks(conn, *block_values)
                 elif block['type'] == 'paragraph':
-                    updated_refs_paragraph = cls._update_text_refs(block['text'], articles_dicts)
-                    block_id = cls._insert_into_paragraph_blocks(conn, updated_refs_paragraph)
+                    block_id = cls._insert_into_paragraph_blocks(conn, *block_values)
                 elif block['type'] == 'image':
-                    guide_block_source = os.path.join('guides', guide_name, block['source'])
-                    updated_refs_image_caption_text = cls._update_text_refs(block['caption'], articles_dicts)
-                    block_id = cls._insert_into_image_blocks(conn,
-                                                             (guide_block_source, updated_refs_image_caption_text))
+                    block_id = cls._insert_into_image_blocks(conn, block_values)
                 elif block['type'] == 'audio':
-                    guide_block_source = os.path.join('guides', guide_name, block['source'])
-                    probe = ffmpeg.probe(os.path.join(guide_path, block['source']))
-                    audio_length = probe['format']['duration']
-                    updated_refs_audio_caption_text = cls._update_text_refs(block['caption'], articles_dicts)
-                    block_id = cls._insert_into_audio_blocks(conn,
-                                                             (guide_block_source,
-                                                              audio_length,
-                                                              updated_refs_audio_caption_text))
-                elif block['type'] == 'video':
-                    guide_block_source = os.path.join('guides', guide_name, block['source'])
-                    in_videofile_path = os.path.join(guide_path, block['source'])
-                    probe = ffmpeg.probe(in_videofile_path)
-                    video_length = probe['format']['duration']
-                    video_aspect_ratio = next(stream['display_aspect_ratio'] for stream in probe['streams']
-                                              if stream['codec_type'] == 'video')
-                    cover_filename = os.path.splitext(block['source'])[0] + '.png'
-                    out_imagefile_path = os.path.join(guide_path, cover_filename)
-                    if not os.path.exists(out_imagefile_path):
-                        try:
-                            ffmpeg.input(in_videofile_path).output(out_imagefile_path, vframes=1).run()
-                        except ffmpeg.Error as e:
-                            print(e.stdout.decode('utf8'))
-                            print(e.stderr.decode('utf8'))
-                            exit(1)
-                    video_cover_source = os.path.join('guides', guide_name, cover_filename)
-                    updated_refs_video_caption_text = cls._update_text_refs(block['caption'], articles_dicts)
-                    block_id = cls._insert_into_video_blocks(conn,
-                                                             (guide_block_source,
-                                                              video_length,
-                                                              video_aspect_ratio,
-                                                              video_cover_source,
-                                                              updated_refs_video_caption_text))
+                    block_id = cls._insert_into_audio_blocks(conn, block_values)
                 else:
-                    continue
+                    block_id = cls._insert_into_video_blocks(conn, block_values)
                 cls._insert_into_articles_blocks(conn, (article_id, block_id, block_order, block['type']))
+                for target_id in targets_ids:
+                    cls._insert_into_article_links(conn, (article_id, target_id, block['type'], block_id))
+                if markup_spans:
+                    cls._insert_into_article_block_spans(conn, (block['type'], block_id, json.dumps(spans)))
+                articles_unresolved_refs[-1].update(block_unresolved_refs)
                 block_order += 1
 
+        report = cls._close_articles_media(media)
+        report['unresolved_refs'] = cls._count_unresolved_refs(articles_unresolved_refs)
         cls._alter_table_articles_drop_column_content(conn)
+        return report
+
+    @classmethod
+    def _open_articles_media(cls, guide_path, media_sources_types, probe_executor, probe_max_workers,
+                             media_cache_path, profile, metrics, media_hashes=None, deduplicated_sources=None):
+        """ Private method which transcodes all distinct media payloads of the articles (given as their media types
+            keyed by the media source, see _articles_media_types) for the profile (if any),
+            probes the archived media files, extracts the videos covers and returns the media context (deduplicated
+            and archived sources, probes, content hashes, failures and media cache connection) used while filling
+            the content block tables; unless the hashes and deduplicated sources are provided, all media sources of
+            the articles are hashed, a single file of every distinct media payload is kept in the guide directory and
+            sources of the transcoded media are removed from it """
+
+        is_kept_sources = media_hashes is not None  # the incremental packaging keeps the guide sources
+        cache_conn = MediaCache.connect(media_cache_path) if media_cache_path is not None else None
+        with cls._media_executor(probe_executor, probe_max_workers) as executor:
+            if media_hashes is None:
+                media_sources = sorted(media_sources_types)
+                media_paths = [os.path.join(guide_path, source) for source in media_sources]
+                with metrics.stage('hash_media'):
+                    media_hashes = dict(zip(media_sources, executor.map(MediaCache.hash_file, media_paths)))
+                deduplicated_sources = cls._deduplicate_media_sources(media_hashes)
+                for source, deduplicated_source in deduplicated_sources.items():
+                    if source != deduplicated_source:
+                        os.remove(os.path.join(guide_path, source))
+            media_types = {deduplicated_sources[source]: media_type
+                           for source, media_type in media_sources_types.items()}
+            metrics.count('media', 'distinct', len(media_types))
+            with metrics.stage('transcode_media'):
+                archived_sources, transcode_failures = cls._transcode_media_sources(
+                    guide_path, media_types, media_hashes, profile, executor, cache_conn, media_cache_path)
+            with metrics.stage('probe_media'):
+                media_probes = cls._probe_media_sources(guide_path, sorted(set(archived_sources.values())),
+                                                        media_hashes, executor, cache_conn, metrics)
+            video_sources = sorted(source for source, media_type in media_types.items() if media_type == 'video')
+            with metrics.stage('extract_video_covers'):
+                covers_failures = cls._extract_video_covers(guide_path, video_sources, media_hashes,
+                                                            {source: media_probes[archived_sources[source]]
+                                                             for source in video_sources},
+                                                            executor, cache_conn, media_cache_path)
+            metrics.count('media', 'transcoded', sum(source != archived_source
+                                                     for source, archived_source in archived_sources.items()))
+            metrics.count('media', 'transcode_failures', len(transcode_failures))
+            metrics.count('media', 'video_covers_failures', len(covers_failures))
+        if not is_kept_sources:
+            for source, archived_source in archived_sources.items():
+                if source != archived_source:
+                    os.remove(os.path.join(guide_path, source))
+        return {'sources': deduplicated_sources, 'archived_sources': archived_sources, 'probes': media_probes,
+                'hashes': media_hashes, 'covers_failures': covers_failures, 'transcode_failures': transcode_failures,
+                'cache_conn': cache_conn, 'cache_path': media_cache_path}
 
     @staticmethod
-    def _create_and_fill_article_block_search_table(conn):
+    def _articles_media_types(articles_ids_contents):
+        """ Private method which returns media types of the media blocks of the articles (given as pairs of article
+            id and content) keyed by the media source """
+
+        return {block['source']: block['type'] for article_id, article_content in articles_ids_contents
+                for block in article_content if block['type'] in ('image', 'audio', 'video')}
+
+    @staticmethod
+    def _media_executor(probe_executor, probe_max_workers):
+        if probe_executor == 'thread':
+            return ThreadPoolExecutor(max_workers=probe_max_workers)
+        elif probe_executor == 'process':
+            return ProcessPoolExecutor(max_workers=probe_max_workers)
+        raise ValueError('Provided a probe executor of unknown type.')
+
+    @staticmethod
+    def _deduplicate_media_sources(media_hashes):
+        """ Private method which maps every media source to the (alphabetically first) source with the same payload,
+            so that the archive holds each payload exactly once """
+
+        hashes_sources = {}
+        deduplicated_sources = {}
+        for source in sorted(media_hashes):
+            deduplicated_sources[source] = hashes_sources.setdefault(media_hashes[source], source)
+        return deduplicated_sources
+
+    @staticmethod
+    def _close_articles_media(media):
+        """ Private method which closes the media context and returns its report """
+
+        if media['cache_conn'] is not None:
+            MediaCache.evict(media['cache_conn'], MEDIA_CACHE_MAX_ENTRIES)
+            media['cache_conn'].close()
+        return {'video_covers_failures': media['covers_failures'],
+                'media_transcode_failures': media['transcode_failures'],
+                'media_transcoded_sources': {source: archived_source
+                                             for source, archived_source in media['archived_sources'].items()
+                                             if source != archived_source}}
+
+    @classmethod
+    def _article_block_values(cls, block, guide_name, guide_path, media):
+        """ Private method which returns values of an article content block row (without the block id) in the order of
+            the corresponding block table columns, or None for a block of unknown type; the text (or caption), which
+            is the last column, is returned with its markup as it is (see _parse_markup) """
+
+        if block['type'] == 'subtitle':
+            return (block['text'],)
+        elif block['type'] == 'paragraph':
+            return (block['text'],)
+        elif block['type'] == 'image':
+            archived_source = media['archived_sources'][media['sources'][block['source']]]
+            guide_block_source = os.path.join('guides', guide_name, archived_source)
+            image_stream = cls._probe_video_stream(media['probes'][archived_source])
+            return (guide_block_source,
+                    image_stream.get('width'),
+                    image_stream.get('height'),
+                    block['caption'])
+        elif block['type'] == 'audio':
+            archived_source = media['archived_sources'][media['sources'][block['source']]]
+            guide_block_source = os.path.join('guides', guide_name, archived_source)
+            probe = media['probes'][archived_source]
+            audio_length = probe['format']['duration']
+            return guide_block_source, audio_length, block['caption']
+        elif block['type'] == 'video':
+            source = media['sources'][block['source']]
+            archived_source = media['archived_sources'][source]
+            guide_block_source = os.path.join('guides', guide_name, archived_source)
+            probe = media['probes'][archived_source]
+            video_length = probe['format']['duration']
+            video_stream = cls._probe_video_stream(probe)
+            video_aspect_ratio = video_stream['display_aspect_ratio']
+            if source in media['covers_failures']:
+                video_cover_source = None
+            else:
+                video_cover_source = os.path.join('guides', guide_name, cls._video_covers_filenames(source)[0])
+            return (guide_block_source,
+                    video_length,
+                    video_aspect_ratio,
+                    video_stream.get('width'),
+                    video_stream.get('height'),
+                    video_cover_source,
+                    block['caption'])
+        return None
+
+    @staticmethod
+    def _probe_media_sources(guide_path, media_sources, media_hashes, executor, cache_conn, metrics):
+        """ Private method which probes media sources in parallel on a worker pool and returns the probes keyed by
+            the media source; when cache_conn is provided, only the media missing in the cache are probed """
+
+        if cache_conn is None:
+            media_paths = [os.path.join(guide_path, source) for source in media_sources]
+            metrics.count('probes', 'run', len(media_paths))
+            return dict(zip(media_sources, executor.map(ffmpeg.probe, media_paths)))
+
+        hashes_probes = MediaCache.fetch_probes(cache_conn, {media_hashes[source] for source in media_sources})
+        missed_sources = {media_hashes[source]: source for source in media_sources
+                          if media_hashes[source] not in hashes_probes}
+        missed_paths = [os.path.join(guide_path, source) for source in missed_sources.values()]
+        metrics.count('probes', 'run', len(missed_paths))
+        metrics.count('probes', 'cached', len(hashes_probes))
+        for media_hash, probe in zip(missed_sources, executor.map(ffmpeg.probe, missed_paths)):
+            MediaCache.store_probe(cache_conn, media_hash, probe)
+            hashes_probes[media_hash] = probe
+        return {source: hashes_probes[media_hashes[source]] for source in media_sources}
+
+    @staticmethod
+    def _probe_video_stream(probe):
+        """ Private method which returns the (first) video stream of the probe, images are probed as video streams """
+
+        return next(stream for stream in probe['streams'] if stream['codec_type'] == 'video')
+
+    @staticmethod
+    def _transcode_media_sources(guide_path, media_types, media_hashes, profile, executor, cache_conn,
+                                 media_cache_path):
+        """ Private method which transcodes the media (given with their types) missing their transcoded files in
+            the guide directory for the profile in parallel on a worker pool, or copies the files from the media
+            cache if present; returns the archived sources (the transcoded one, or the source itself when there is
+            no profile or the transcoding failed) and error messages of the failed transcodings keyed by the media
+            source. Hashes of the transcoded files are added to media_hashes. """
+
+        archived_sources = {source: source for source in media_types}
+        if profile is None:
+            return archived_sources, {}
+
+        transcode_variant = MediaTranscoder.variant(profile)
+        transcoded_media = {}
+        for source, media_type in sorted(media_types.items()):
+            transcoded_source = MediaTranscoder.transcoded_filename(source, media_type, profile)
+            transcoded_path = os.path.join(guide_path, transcoded_source)
+            if os.path.exists(transcoded_path):
+                archived_sources[source] = transcoded_source
+                if transcoded_source not in media_hashes:
+                    media_hashes[transcoded_source] = MediaCache.hash_file(transcoded_path)
+                continue
+            if cache_conn is not None:
+                cached_paths = MediaCache.fetch_derived(cache_conn, media_hashes[source], transcode_variant)
+                if cached_paths is not None:
+                    shutil.copy(cached_paths[0], transcoded_path)
+                    archived_sources[source] = transcoded_source
+                    media_hashes[transcoded_source] = MediaCache.hash_file(transcoded_path)
+                    continue
+            transcoded_media[source] = (transcoded_source, executor.submit(MediaTranscoder.transcode_file,
+                                                                           os.path.join(guide_path, source),
+                                                                           transcoded_path, media_type, profile))
+        transcode_failures = {}
+        for source, (transcoded_source, future) in transcoded_media.items():
+            transcoded_path = os.path.join(guide_path, transcoded_source)
+            error = future.result()
+            if error is not None:
+                transcode_failures[source] = error
+                if os.path.exists(transcoded_path):
+                    os.remove(transcoded_path)
+                continue
+            archived_sources[source] = transcoded_source
+            media_hashes[transcoded_source] = MediaCache.hash_file(transcoded_path)
+            if cache_conn is not None:
+                MediaCache.store_derived(cache_conn, media_cache_path, media_hashes[source], transcode_variant,
+                                         [transcoded_path])
+        return archived_sources, transcode_failures
+
+    @classmethod
+    def _extract_video_covers(cls, guide_path, video_sources, media_hashes, media_probes, executor, cache_conn,
+                              media_cache_path):
+        """ Private method which extracts covers (and cover thumbnails) of the videos missing them in the guide
+            directory in parallel on a worker pool, or copies them from the media cache if present; returns error
+            messages of the failed extractions keyed by the video source """
+
+        covers_variant = cls._video_covers_variant()
+        extracted_covers = {}
+        for source in video_sources:
+            covers_paths = [os.path.join(guide_path, cover_filename)
+                            for cover_filename in cls._video_covers_filenames(source)]
+            if all(os.path.exists(cover_path) for cover_path in covers_paths):
+                continue
+            if cache_conn is not None:
+                cached_covers_paths = MediaCache.fetch_derived(cache_conn, media_hashes[source], covers_variant)
+                if cached_covers_paths is not None:
+                    for cached_cover_path, cover_path in zip(cached_covers_paths, covers_paths):
+                        shutil.copy(cached_cover_path, cover_path)
+                    continue
+            seek_time = float(media_probes[source]['format'].get('duration', 0)) * VIDEO_COVER_SEEK_FRACTION
+            extracted_covers[source] = (covers_paths, executor.submit(cls._extract_video_cover_files,
+                                                                      os.path.join(guide_path, source),
+                                                                      covers_paths, seek_time))
+        covers_failures = {}
+        for source, (covers_paths, future) in extracted_covers.items():
+            error = future.result()
+            if error is not None:
+                covers_failures[source] = error
+                for cover_path in covers_paths:
+                    if os.path.exists(cover_path):
+                        os.remove(cover_path)
+            elif cache_conn is not None:
+                MediaCache.store_derived(cache_conn, media_cache_path, media_hashes[source], covers_variant,
+                                         covers_paths)
+        return covers_failures
+
+    @staticmethod
+    def _extract_video_cover_files(in_videofile_path, out_imagefiles_paths, seek_time):
+        """ Private method which extracts a frame of the video at seek_time into the cover image (first of the out
+            paths) and its thumbnails (the others, scaled down to VIDEO_COVER_THUMBNAIL_WIDTHS) in one ffmpeg run;
+            returns an error message on failure, None otherwise """
+
+        try:
+            GuidePackager._video_cover_outputs(in_videofile_path, out_imagefiles_paths, seek_time).run(
+                capture_stdout=True, capture_stderr=True)
+        except ffmpeg.Error as e:
+            stderr_lines = e.stderr.decode('utf8', 'replace').strip().splitlines()
+            return stderr_lines[-1] if stderr_lines else str(e)
+        except OSError as e:  # ffmpeg is not installed
+            return str(e)
+        return None
+
+    @staticmethod
+    def _video_cover_outputs(in_videofile_path, out_imagefiles_paths, seek_time):
+        """ Private method which returns ffmpeg outputs (overwritten) of the video cover and its thumbnails """
+
+        frames = ffmpeg.input(in_videofile_path, ss=seek_time).video.filter_multi_output('split',
+                                                                                          len(out_imagefiles_paths))
+        outputs = [frames.stream(0).output(out_imagefiles_paths[0], vframes=1)]
+        for frame_idx, (width, out_imagefile_path) in enumerate(zip(VIDEO_COVER_THUMBNAIL_WIDTHS,
+                                                                    out_imagefiles_paths[1:]), start=1):
+            thumbnail = frames.stream(frame_idx).filter('scale', f'min(iw,{width})', -2)
+            outputs.append(thumbnail.output(out_imagefile_path, vframes=1))
+        return ffmpeg.merge_outputs(*outputs).overwrite_output()
+
+    @staticmethod
+    def _video_covers_variant():
+        """ Private method which returns variant of the video covers in the media cache """
+
+        return 'covers:{seek_fraction}:{widths}'.format(
+            seek_fraction=VIDEO_COVER_SEEK_FRACTION, widths=','.join(map(str, VIDEO_COVER_THUMBNAIL_WIDTHS)))
+
+    @staticmethod
+    def _video_covers_filenames(video_source):
+        """ Private method which returns file names of the video cover and its thumbnails (the thumbnails are named
+            after the cover with their width appended) """
+
+        cover_name = os.path.splitext(video_source)[0]
+        return [cover_name + '.png'] + [f'{cover_name}_{width}.png' for width in VIDEO_COVER_THUMBNAIL_WIDTHS]
+
+    @classmethod
+    def _create_and_fill_article_block_search_table(cls, conn, search_index):
+        cls._create_article_block_search_table(conn, search_index)
+        cls._fill_article_block_search_table(conn)
+        cls._optimize_article_block_search_table(conn)
+
+    @staticmethod
+    def _create_article_block_search_table(conn, search_index):
+        """ Private method which creates the full-text search table; the fts5 table indexes only the block text
+            (other columns locate the block in the guide) and has prefix indexes """
+
+        cur = conn.cursor()
+        if search_index == 'fts4':
+            cur.execute(""" CREATE VIRTUAL TABLE article_block_search 
+                            USING fts4(article_id, block_order, block_type, block_id, block_text); """)
+        elif search_index == 'fts5':
+            cur.execute(""" CREATE VIRTUAL TABLE article_block_search
+                            USING fts5(article_id UNINDEXED, block_order UNINDEXED, block_type UNINDEXED,
+                                       block_id UNINDEXED, block_text, prefix='{prefixes}'); """.format(
+                prefixes=' '.join(str(prefix) for prefix in SEARCH_INDEX_PREFIXES)))
+        else:
+            raise ValueError('Provided a search index of unknown type.')
+
+    @staticmethod
+    def _optimize_article_block_search_table(conn):
+        if not SEARCH_INDEX_OPTIMIZE:
+            return
         cur = conn.cursor()
-        cur.execute(""" CREATE VIRTUAL TABLE article_block_search 
-                        USING fts4(article_id, block_order, block_type, block_id, block_text); """)
+        cur.execute(""" INSERT INTO article_block_search (article_block_search) VALUES ('optimize'); """)
+        conn.commit()
+
+    @classmethod
+    def _fill_article_block_search_table_with_rows(cls, conn, rows):
+        """ Private method which fills the full-text table with the collected rows of the blocks, inserted in order
+            of article id and block order """
 
+        rows.sort(key=lambda row: row[:2])
+        cls._insert_many_into(conn, 'article_block_search', rows)
+
+    @staticmethod
+    def _fill_article_block_search_table(conn):
+        """ Private method which fills the search table with titles, synopses and content blocks texts of all articles;
+            used by the row by row build, bulk-load and incremental builds insert the search rows with the blocks """
+
+        cur = conn.cursor()
         cur.execute(""" INSERT INTO article_block_search
-                        SELECT id AS article_id, -2 AS block_order, 'title' AS block_type, NULL AS block_id, title AS block_text 
-                        FROM articles
-                        UNION
-                        SELECT id AS article_id, -1 AS block_order, 'synopsis' AS block_type, NULL AS block_id, synopsis AS block_text 
-                        FROM articles
-                        UNION
-                        SELECT ab.article_id, ab.block_order, ab.block_type, ab.block_id, sub.subtitle_text AS block_text 
-                        FROM articles_blocks AS ab
-                        JOIN subtitle_blocks AS sub
-                        ON sub.id=ab.block_id AND ab.block_type='subtitle'
-                        UNION
-                        SELECT ab.article_id, ab.block_order, ab.block_type, ab.block_id, pab.paragraph_text AS block_text 
-                        FROM articles_blocks AS ab
-                        JOIN paragraph_blocks AS pab
-                        ON pab.id=ab.block_id AND ab.block_type='paragraph'
-                        UNION
-                        SELECT ab.article_id, ab.block_order, ab.block_type, ab.block_id, imb.caption_text AS block_text 
-                        FROM articles_blocks AS ab
-                        JOIN image_blocks AS imb
-                        ON imb.id=ab.block_id AND ab.block_type='image'
-                        UNION
-                        SELECT ab.article_id, ab.block_order, ab.block_type, ab.block_id, aub.caption_text AS block_text 
-                        FROM articles_blocks AS ab
-                        JOIN audio_blocks AS aub
-                        ON aub.id=ab.block_id AND ab.block_type='audio'
-                        UNION
-                        SELECT ab.article_id, ab.block_order, ab.block_type, ab.block_id, vib.caption_text as block_text 
-                        FROM articles_blocks as ab
-                        JOIN video_blocks AS vib
-                        ON vib.id=ab.block_id AND ab.block_type='video'
+                        SELECT * FROM (
+                            SELECT id AS article_id, -2 AS block_order, 'title' AS block_type, NULL AS block_id, title AS block_text 
+                            FROM articles
+                            UNION ALL
+                            SELECT id AS article_id, -1 AS block_order, 'synopsis' AS block_type, NULL AS block_id, synopsis AS block_text 
+                            FROM articles
+                            UNION ALL
+                            SELECT ab.article_id, ab.block_order, ab.block_type, ab.block_id, sub.subtitle_text AS block_text 
+                            FROM articles_blocks AS ab
+                            JOIN subtitle_blocks AS sub
+                            ON sub.id=ab.block_id AND ab.block_type='subtitle'
+                            UNION ALL
+                            SELECT ab.article_id, ab.block_order, ab.block_type, ab.block_id, pab.paragraph_text AS block_text 
+                            FROM articles_blocks AS ab
+                            JOIN paragraph_blocks AS pab
+                            ON pab.id=ab.block_id AND ab.block_type='paragraph'
+                            UNION ALL
+                            SELECT ab.article_id, ab.block_order, ab.block_type, ab.block_id, imb.caption_text AS block_text 
+                            FROM articles_blocks AS ab
+                            JOIN image_blocks AS imb
+                            ON imb.id=ab.block_id AND ab.block_type='image'
+                            UNION ALL
+                            SELECT ab.article_id, ab.block_order, ab.block_type, ab.block_id, aub.caption_text AS block_text 
+                            FROM articles_blocks AS ab
+                            JOIN audio_blocks AS aub
+                            ON aub.id=ab.block_id AND ab.block_type='audio'
+                            UNION ALL
+                            SELECT ab.article_id, ab.block_order, ab.block_type, ab.block_id, vib.caption_text as block_text 
+                            FROM articles_blocks as ab
+                            JOIN video_blocks AS vib
+                            ON vib.id=ab.block_id AND ab.block_type='video'
+                        )
                         ORDER BY article_id, block_order; """)
         conn.commit()
 
@@ -389,19 +1703,64 @@ class GuidePackager:
                         VALUES (?); """, (text,))
         return cur.lastrowid
 
+    @classmethod
+    def _parse_markup(cls, text, articles_dicts):
+        """ Private method which parses kivy markup of the text in a single pass and returns the text with its
+            [ref=name] markups rewritten to [ref=id] (or [ref=] when there is no such article), its spans, ids of
+            the referred articles and names of the missing ones (an empty [ref=] refers to no article and is not
+            reported as missing). Spans are lists of the span text (unescaped), tags open over it (in opening order,
+            e.g. ['b', 'u'] or ['color=#ff0000']) and id of the article it refers to (or None); adjacent spans with
+            the same tags and ref are merged, so the app renders the text without parsing it again """
+
+        text_parts = []
+        spans = []
+        tags = []
+        ref_id = None
+        targets_ids = []
+        unresolved_refs = set()
+        position = 0
+        for match in MARKUP_TAG_PATTERN.finditer(text):
+            text_parts.append(text[position:match.start()])
+            cls._append_markup_span(spans, text[position:match.start()], tags, ref_id)
+            position = match.end()
+            is_closing, tag, value = match.groups()
+            if tag == 'ref' and not is_closing and value is not None:
+                article_name = (value or '').strip()
+                ref_id = articles_dicts[article_name][0] if article_name in articles_dicts else None
+                if ref_id is None:
+                    if article_name:
+                        unresolved_refs.add(article_name)
+                elif ref_id not in targets_ids:
+                    targets_ids.append(ref_id)
+                text_parts.append('[ref={ref}]'.format(ref=ref_id if ref_id is not None else ''))
+                continue
+            text_parts.append(match.group(0))
+            if tag == 'ref':
+                ref_id = None
+            elif not is_closing:
+                tags.append(tag if value is None else f'{tag}={value}')
+            else:  # closes the last open tag of the name
+                for tag_idx in range(len(tags) - 1, -1, -1):
+                    if tags[tag_idx].split('=', 1)[0] == tag:
+                        del tags[tag_idx]
+                        break
+        text_parts.append(text[position:])
+        cls._append_markup_span(spans, text[position:], tags, ref_id)
+        return ''.join(text_parts), spans, targets_ids, unresolved_refs
+
     @staticmethod
-    def _update_text_refs(text, articles_dicts):
-        def replace_name_ref(matchobj):
-            article_name = matchobj.group(1).strip()
-            if article_name not in articles_dicts:
-                replacement = '[ref=]'
-            else:
-                article_id = articles_dicts[article_name][0]
-                replacement = '[ref={ref}]'.format(ref=article_id)
-            return replacement
+    def _append_markup_span(spans, span_text, tags, ref_id):
+        """ Private method which appends the (unescaped) span text to the spans, merged into the last span if it has
+            the same tags and ref """
 
-        result = re.sub(r'\[ref=(.*?)\]', replace_name_ref, text)
-        return result
+        if not span_text:
+            return
+        for escape, character in MARKUP_ESCAPES:
+            span_text = span_text.replace(escape, character)
+        if spans and spans[-1][1] == tags and spans[-1][2] == ref_id:
+            spans[-1][0] += span_text
+        else:
+            spans.append([span_text, list(tags), ref_id])
 
     @staticmethod
     def _insert_into_paragraph_blocks(conn, text):
@@ -413,8 +1772,8 @@ class GuidePackager:
     @staticmethod
     def _insert_into_image_blocks(conn, values):
         cur = conn.cursor()
-        cur.execute(""" INSERT INTO image_blocks (image_source, caption_text)
-                        VALUES (?, ?); """, values)
+        cur.execute(""" INSERT INTO image_blocks (image_source, image_width, image_height, caption_text)
+                        VALUES (?, ?, ?, ?); """, values)
         return cur.lastrowid
 
     @staticmethod
@@ -427,8 +1786,9 @@ class GuidePackager:
     @staticmethod
     def _insert_into_video_blocks(conn, values):
         cur = conn.cursor()
-        cur.execute(""" INSERT INTO video_blocks (video_source, video_length, video_aspect_ratio, video_cover_source, caption_text)
-                        VALUES (?, ?, ?, ?, ?); """, values)
+        cur.execute(""" INSERT INTO video_blocks (video_source, video_length, video_aspect_ratio, video_width,
+                                                  video_height, video_cover_source, caption_text)
+                        VALUES (?, ?, ?, ?, ?, ?, ?); """, values)
         return cur.lastrowid
 
     @staticmethod
@@ -437,6 +1797,18 @@ class GuidePackager:
         cur.execute(""" INSERT INTO articles_blocks (article_id, block_id, block_order, block_type)
                         VALUES (?, ?, ?, ?); """, values)
 
+    @staticmethod
+    def _insert_into_article_links(conn, values):
+        cur = conn.cursor()
+        cur.execute(""" INSERT INTO article_links (source_article_id, target_article_id, block_type, block_id)
+                        VALUES (?, ?, ?, ?); """, values)
+
+    @staticmethod
+    def _insert_into_article_block_spans(conn, values):
+        cur = conn.cursor()
+        cur.execute(""" INSERT INTO article_block_spans (block_type, block_id, spans)
+                        VALUES (?, ?, ?); """, values)
+
     @staticmethod
     def _alter_table_articles_drop_column_content(conn):
         cur = conn.cursor()
@@ -473,3 +1845,4 @@ class GuidePackager:
         cur = conn.cursor()
         cur.execute(""" INSERT INTO bookmarks (article_id, created_at) VALUES (?, ?); """, values)
         return cur.lastrowid
+
@@ -6,5 +6,6 @@ if __name__ == '__main__':
     if not guide_name:
         guide_name = 'dummy'
 
-    guide_path = GuideGenerator.generate(guide_name)
-    GuidePackager.pack(guide_name, guide_path)
+    guide_path, guide = GuideGenerator.generate_guide(guide_name)
+    report = GuidePackager.pack(guide_name, guide_path, guide=guide)
+    print(f"guide.db finalized from {report['db_size_before']} to {report['db_size_after']} bytes")
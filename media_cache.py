@@ -0,0 +1,186 @@
+"""
+Xenial media metadata cache
+===========================
+
+This module contains class for caching media metadata (ffprobe results) and files derived from media (e.g. video
+covers) between guide packaging runs. Cached entries are keyed by a hash of the media file content (derived files also
+by a variant describing how they were derived), so the cache stays valid for copies of the same file in different
+guides. Run as a script to invalidate or prune the cache:
+
+    python media_cache.py clear
+    python media_cache.py prune --max-entries 500
+
+Modules API and guide format is experimental and highly unstable.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import time
+
+MEDIA_CACHE_PATH = os.path.join('cache', 'media.db')
+MEDIA_CACHE_MAX_ENTRIES = 10000  # least recently used entries above this bound are evicted (with derived files)
+MEDIA_CACHE_VERSION = 2  # cache of another version is cleared when connected
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+class MediaCache:
+    @classmethod
+    def connect(cls, cache_path=MEDIA_CACHE_PATH):
+        """ Public method which opens (and creates if missing) the media cache database """
+
+        os.makedirs(os.path.dirname(cache_path) or '.', exist_ok=True)
+        conn = sqlite3.connect(cache_path, timeout=30)
+        cur = conn.cursor()
+        cur.execute(""" BEGIN IMMEDIATE; """)  # concurrent packers wait until the cache is set up
+        if cur.execute(""" PRAGMA user_version; """).fetchone()[0] != MEDIA_CACHE_VERSION:
+            cur.execute(""" DROP TABLE IF EXISTS media; """)
+            cur.execute(""" DROP TABLE IF EXISTS derived; """)
+            cls._remove_files(cache_path)
+            cur.execute(""" CREATE TABLE media (
+                                hash text PRIMARY KEY,
+                                probe text,
+                                last_used real NOT NULL
+                            ); """)
+            cur.execute(""" CREATE TABLE derived (
+                                hash text NOT NULL,
+                                variant text NOT NULL,
+                                paths text NOT NULL,
+                                PRIMARY KEY(hash, variant)
+                            ); """)
+            cur.execute(""" PRAGMA user_version={version}; """.format(version=MEDIA_CACHE_VERSION))
+        conn.commit()
+        os.makedirs(cls._files_dir(cache_path), exist_ok=True)
+        return conn
+
+    @classmethod
+    def hash_file(cls, file_path):
+        """ Public method which returns sha256 hex digest of the file content """
+
+        with open(file_path, 'rb') as f:
+            return cls.hash_stream(f).hexdigest()
+
+    @staticmethod
+    def hash_stream(stream, sha256=None):
+        """ Public method which updates the sha256 hash object (a new one if None) by the content of the binary
+            stream, read in chunks, and returns it """
+
+        sha256 = hashlib.sha256() if sha256 is None else sha256
+        for chunk in iter(lambda: stream.read(HASH_CHUNK_SIZE), b''):
+            sha256.update(chunk)
+        return sha256
+
+    @staticmethod
+    def fetch_probes(conn, media_hashes):
+        """ Public method which returns cached probes of the media with given hashes keyed by the hash """
+
+        cur = conn.cursor()
+        probes = {}
+        for media_hash in media_hashes:
+            cur.execute(""" SELECT probe FROM media WHERE hash=? AND probe IS NOT NULL; """, (media_hash,))
+            row = cur.fetchone()
+            if row is not None:
+                probes[media_hash] = json.loads(row[0])
+                cur.execute(""" UPDATE media SET last_used=? WHERE hash=?; """, (time.time(), media_hash))
+        conn.commit()
+        return probes
+
+    @staticmethod
+    def store_probe(conn, media_hash, probe):
+        cur = conn.cursor()
+        cur.execute(""" INSERT INTO media (hash, probe, last_used) VALUES (?, ?, ?)
+                        ON CONFLICT(hash) DO UPDATE SET probe=excluded.probe, last_used=excluded.last_used; """,
+                    (media_hash, json.dumps(probe), time.time()))
+        conn.commit()
+
+    @staticmethod
+    def fetch_derived(conn, media_hash, variant):
+        """ Public method which returns paths to the cached files derived from the media with given hash in given
+            variant, or None when they are not cached (or some of them is missing) """
+
+        cur = conn.cursor()
+        cur.execute(""" SELECT paths FROM derived WHERE hash=? AND variant=?; """, (media_hash, variant))
+        row = cur.fetchone()
+        if row is None:
+            return None
+        derived_paths = json.loads(row[0])
+        if not all(os.path.exists(derived_path) for derived_path in derived_paths):
+            return None
+        cur.execute(""" UPDATE media SET last_used=? WHERE hash=?; """, (time.time(), media_hash))
+        conn.commit()
+        return derived_paths
+
+    @classmethod
+    def store_derived(cls, conn, cache_path, media_hash, variant, derived_paths):
+        """ Public method which copies the files derived from the media with given hash in given variant into
+            the cache directory and records them """
+
+        variant_hash = hashlib.sha256(variant.encode()).hexdigest()[:16]
+        cached_paths = []
+        for derived_idx, derived_path in enumerate(derived_paths):
+            cached_path = os.path.join(cls._files_dir(cache_path), f'{media_hash}.{variant_hash}.{derived_idx}'
+                                                                   f'{os.path.splitext(derived_path)[1]}')
+            part_path = f'{cached_path}.{os.getpid()}.part'
+            shutil.copy(derived_path, part_path)
+            os.replace(part_path, cached_path)  # concurrent packers never see (or write) a partial file
+            cached_paths.append(cached_path)
+        cur = conn.cursor()
+        cur.execute(""" INSERT INTO media (hash, last_used) VALUES (?, ?)
+                        ON CONFLICT(hash) DO UPDATE SET last_used=excluded.last_used; """, (media_hash, time.time()))
+        cur.execute(""" INSERT OR REPLACE INTO derived (hash, variant, paths) VALUES (?, ?, ?); """,
+                    (media_hash, variant, json.dumps(cached_paths)))
+        conn.commit()
+        return cached_paths
+
+    @staticmethod
+    def evict(conn, max_entries=MEDIA_CACHE_MAX_ENTRIES):
+        """ Public method which evicts the least recently used entries above the cache size bound """
+
+        cur = conn.cursor()
+        cur.execute(""" SELECT hash FROM media ORDER BY last_used DESC LIMIT -1 OFFSET ?; """, (max_entries,))
+        evicted_hashes = [row[0] for row in cur.fetchall()]
+        for media_hash in evicted_hashes:
+            for row in cur.execute(""" SELECT paths FROM derived WHERE hash=?; """, (media_hash,)).fetchall():
+                for derived_path in json.loads(row[0]):
+                    if os.path.exists(derived_path):
+                        os.remove(derived_path)
+            cur.execute(""" DELETE FROM derived WHERE hash=?; """, (media_hash,))
+            cur.execute(""" DELETE FROM media WHERE hash=?; """, (media_hash,))
+        conn.commit()
+        return len(evicted_hashes)
+
+    @classmethod
+    def clear(cls, cache_path=MEDIA_CACHE_PATH):
+        """ Public method which invalidates the whole cache by deleting its database and cached files """
+
+        if os.path.exists(cache_path):
+            os.remove(cache_path)
+        cls._remove_files(cache_path)
+
+    @classmethod
+    def _remove_files(cls, cache_path):
+        shutil.rmtree(cls._files_dir(cache_path), ignore_errors=True)
+        shutil.rmtree(os.path.join(os.path.dirname(cache_path), 'covers'), ignore_errors=True)  # of version 1 cache
+
+    @staticmethod
+    def _files_dir(cache_path):
+        return os.path.join(os.path.dirname(cache_path), 'files')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Manage xenial guides media metadata cache.')
+    parser.add_argument('command', choices=['clear', 'prune'])
+    parser.add_argument('--cache-path', default=MEDIA_CACHE_PATH)
+    parser.add_argument('--max-entries', type=int, default=MEDIA_CACHE_MAX_ENTRIES)
+    args = parser.parse_args()
+
+    if args.command == 'clear':
+        MediaCache.clear(args.cache_path)
+    elif args.command == 'prune':
+        cache_conn = MediaCache.connect(args.cache_path)
+        print(f'Evicted {MediaCache.evict(cache_conn, args.max_entries)} entries.')
+        cache_conn.close()
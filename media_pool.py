@@ -0,0 +1,256 @@
+"""
+Xenial media pool index
+=======================
+
+This module contains classes for indexing the media pool, from which the dummy guides generator takes media files
+(_media/image_, _media/audio_ and _media/video_ directories), and for picking media of a generated guide. The index
+(_cache/media_pool.json_) holds an entry of every pool file with its size, mtime, sha256 hash, duration and dimensions
+(probed by ffprobe); it is built once and reused by the following runs, only new and changed files are hashed and
+probed again. The media picker chooses media so that their distinct payloads fill given byte budgets of the media
+types, which makes size of the generated guide archive predictable. Budgets bigger than the pool are filled by
+variants of the pool files: a pool file with a padding appended (a free box of ISO base media files, trailing bytes
+of other files), which decoders skip, so every variant is a distinct payload. Guides generated without budgets take
+media at random from a plain listing of the pool, so the index is not built for them. Run as a script to (re)build
+the index and print its summary, e.g.:
+
+    python media_pool.py --rebuild
+
+Modules API and guide format is experimental and highly unstable.
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import random
+import struct
+import tempfile
+
+import ffmpeg
+
+from media_cache import MediaCache
+from media_transcoder import VIDEO_COVER_THUMBNAIL_WIDTHS
+
+MEDIA_POOL_PATH = 'media'
+MEDIA_POOL_TYPES = ('image', 'audio', 'video')  # subdirectories of the pool
+MEDIA_POOL_INDEX_PATH = os.path.join('cache', 'media_pool.json')
+MEDIA_POOL_INDEX_VERSION = 1  # index of another version is built again
+MEDIA_POOL_MAX_WORKERS = 4  # files hashed and probed (ffprobe subprocesses) at once while the index is built
+
+MEDIA_VARIANT_BOX_EXTENSIONS = ('.mp4', '.m4a', '.m4v', '.mov')  # ISO base media files, padded by a free box
+MEDIA_PICK_CANDIDATES = 3  # the picked payload is one of this many closest to the wanted size
+VIDEO_COVER_BYTES_PER_PIXEL = 1.5  # estimated size of the video cover and thumbnails PNG files per pixel
+
+
+class MediaPool:
+    @classmethod
+    def load(cls, pool_path=MEDIA_POOL_PATH, index_path=MEDIA_POOL_INDEX_PATH, rebuild=False):
+        """ Public method which returns the media pool index, entries of every media type are sorted by the file name;
+            entries of the files whose size and mtime did not change are reused (unless rebuild), other files are
+            hashed and probed, and the index is saved when it changed """
+
+        index = None if rebuild else cls._read_index(pool_path, index_path)
+        previous_media = index['media'] if index is not None else {}
+        media = {}
+        missing_entries = []
+        for media_type in MEDIA_POOL_TYPES:
+            previous_entries = {entry['filename']: entry for entry in previous_media.get(media_type, [])}
+            media[media_type] = []
+            for filename in sorted(os.listdir(os.path.join(pool_path, media_type))):
+                stat = os.stat(os.path.join(pool_path, media_type, filename))
+                entry = previous_entries.get(filename)
+                if entry is None or entry['size'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns:
+                    entry = None
+                    missing_entries.append((media_type, len(media[media_type]), filename))
+                media[media_type].append(entry)
+        if missing_entries:
+            media_types, entries_idxs, filenames = zip(*missing_entries)
+            with ThreadPoolExecutor(max_workers=MEDIA_POOL_MAX_WORKERS) as executor:
+                entries = executor.map(cls._index_entry, [pool_path] * len(filenames), media_types, filenames)
+                for media_type, entry_idx, entry in zip(media_types, entries_idxs, entries):
+                    media[media_type][entry_idx] = entry
+        if index is None or missing_entries or media != previous_media:
+            index = {'index_version': MEDIA_POOL_INDEX_VERSION, 'pool_path': pool_path, 'media': media}
+            cls._save(index_path, index)
+        return index
+
+    @staticmethod
+    def list_files(pool_path=MEDIA_POOL_PATH):
+        """ Public method which returns index of the media pool whose entries hold only the file names, sizes and
+            mtimes (the files are neither hashed nor probed, their hash, duration and dimensions are None), enough
+            for picking media without a budget; the saved index is neither read nor updated """
+
+        media = {}
+        for media_type in MEDIA_POOL_TYPES:
+            media[media_type] = []
+            for filename in sorted(os.listdir(os.path.join(pool_path, media_type))):
+                stat = os.stat(os.path.join(pool_path, media_type, filename))
+                media[media_type].append({'filename': filename, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                                          'hash': None, 'duration': None, 'width': None, 'height': None})
+        return {'index_version': MEDIA_POOL_INDEX_VERSION, 'pool_path': pool_path, 'media': media}
+
+    @staticmethod
+    def media_path(index, media_type, entry):
+        """ Public method which returns path of the pool file of the index entry """
+
+        return os.path.join(index['pool_path'], media_type, entry['filename'])
+
+    @staticmethod
+    def archived_size(media_type, entry):
+        """ Public method which returns (estimated) bytes the media file adds to a guide archive: its size, and the
+            cover and thumbnails extracted from a video """
+
+        if media_type != 'video' or not entry['width'] or not entry['height']:
+            return entry['size']
+        cover_pixels = entry['width'] * entry['height'] * (1 + sum((thumbnail_width / entry['width']) ** 2
+                                                                   for thumbnail_width in VIDEO_COVER_THUMBNAIL_WIDTHS))
+        return entry['size'] + int(cover_pixels * VIDEO_COVER_BYTES_PER_PIXEL)
+
+    @staticmethod
+    def variant_padding(media_path, variant):
+        """ Public method which returns the padding appended to the media file to make its variant (a distinct
+            payload decoded as the file itself) """
+
+        payload = f'xenial media variant {variant}'.encode()
+        if os.path.splitext(media_path)[1].lower() in MEDIA_VARIANT_BOX_EXTENSIONS:
+            return struct.pack('>I4s', 8 + len(payload), b'free') + payload
+        return payload
+
+    @classmethod
+    def variant_hash(cls, media_path, variant):
+        """ Public method which returns sha256 hex digest of the media file variant content """
+
+        with open(media_path, 'rb') as f:
+            sha256 = MediaCache.hash_stream(f)
+        sha256.update(cls.variant_padding(media_path, variant))
+        return sha256.hexdigest()
+
+    @staticmethod
+    def _read_index(pool_path, index_path):
+        """ Private method which returns the saved index of the pool, or None if there is none usable """
+
+        try:
+            with open(index_path) as f:
+                index = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if index.get('index_version') != MEDIA_POOL_INDEX_VERSION or index.get('pool_path') != pool_path:
+            return None
+        return index
+
+    @staticmethod
+    def _index_entry(pool_path, media_type, filename):
+        """ Private method which returns index entry of the pool file: its size, mtime, hash, duration (of audio and
+            video) and dimensions (of image and video); metadata of a file which cannot be probed are None """
+
+        media_path = os.path.join(pool_path, media_type, filename)
+        stat = os.stat(media_path)
+        entry = {'filename': filename, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                 'hash': MediaCache.hash_file(media_path), 'duration': None, 'width': None, 'height': None}
+        try:
+            probe = ffmpeg.probe(media_path)
+        except (ffmpeg.Error, OSError):  # OSError when ffprobe is not installed
+            return entry
+        if media_type != 'image' and 'duration' in probe['format']:
+            entry['duration'] = float(probe['format']['duration'])
+        if media_type != 'audio':  # images are probed as single frame video streams
+            video_stream = next((stream for stream in probe['streams'] if stream['codec_type'] == 'video'), {})
+            entry['width'] = video_stream.get('width')
+            entry['height'] = video_stream.get('height')
+        return entry
+
+    @staticmethod
+    def _save(index_path, index):
+        """ Private method which writes the index into a temporary file and replaces the index by it, so concurrent
+            generators never read it half written """
+
+        os.makedirs(os.path.dirname(index_path) or '.', exist_ok=True)
+        index_fd, index_tmp_path = tempfile.mkstemp(suffix='.json.part', dir=os.path.dirname(index_path) or '.')
+        try:
+            with os.fdopen(index_fd, 'w') as f:
+                json.dump(index, f, separators=(',', ':'))
+            os.replace(index_tmp_path, index_path)
+        except BaseException:
+            os.remove(index_tmp_path)
+            raise
+
+
+class MediaPicker:
+    """ Picker of the media of a generated guide from the pool index. Media of types without a budget are picked at
+        random. For a media type with a budget (bytes the distinct payloads add to the archive), a block takes a new
+        payload (a pool file not used yet, or else a next variant of a pool file) of the size closest to the remaining
+        budget divided among the remaining expected blocks of the type, and once no new payload fits into the budget,
+        it takes one of the payloads already used; spent holds the bytes spent from the budgets. Budget left in
+        a type of spill_types, which no payload fits into, is divided among the other types of spill_types """
+
+    def __init__(self, index, budgets=None, expected_blocks=None, spill_types=()):
+        for media_type in budgets or {}:
+            if not index['media'].get(media_type):
+                raise ValueError(f'Provided a budget of media type without pool files ({media_type}).')
+        self.index = index
+        self.budgets = dict(budgets or {})
+        self.spill_types = set(spill_types) & set(self.budgets)
+        self.expected_blocks = dict(expected_blocks or {})
+        self.spent = {media_type: 0 for media_type in self.budgets}
+        self.used = {media_type: [] for media_type in self.budgets}
+        self.next_variants = {media_type: [0] * len(index['media'][media_type]) for media_type in self.budgets}
+
+    def pick(self, media_type):
+        """ Public method which returns index entry of the picked pool file and the variant number (0 for the pool
+            file itself) """
+
+        entries = self.index['media'][media_type]
+        if media_type not in self.budgets:
+            return random.choice(entries), 0
+        remaining_budget = self.budgets[media_type] - self.spent[media_type]
+        num_expected_blocks = max(1, self.expected_blocks.get(media_type, 1))
+        self.expected_blocks[media_type] = num_expected_blocks - 1
+
+        next_variants = self.next_variants[media_type]
+        sizes = [MediaPool.archived_size(media_type, entry) for entry in entries]
+        candidates = [(size, entry_idx) for entry_idx, size in enumerate(sizes) if size <= remaining_budget]
+        if any(next_variants[entry_idx] == 0 for size, entry_idx in candidates):
+            candidates = [(size, entry_idx) for size, entry_idx in candidates if next_variants[entry_idx] == 0]
+        if candidates:
+            wanted_size = remaining_budget / num_expected_blocks
+            candidates.sort(key=lambda candidate: (abs(candidate[0] - wanted_size), candidate[1]))
+            size, entry_idx = random.choice(candidates[:MEDIA_PICK_CANDIDATES])
+        elif self.used[media_type]:
+            self._spill(media_type)
+            return random.choice(self.used[media_type])
+        else:  # budget smaller than any pool file, the smallest one is taken anyway
+            size, entry_idx = min((size, entry_idx) for entry_idx, size in enumerate(sizes))
+        picked = entries[entry_idx], next_variants[entry_idx]
+        next_variants[entry_idx] += 1
+        self.spent[media_type] += size
+        self.used[media_type].append(picked)
+        if self.budgets[media_type] - self.spent[media_type] < min(sizes):
+            self._spill(media_type)
+        return picked
+
+    def _spill(self, media_type):
+        """ Private method which divides budget left in the media type among the other spill types (those no
+            payload fits into any more are left out of further spills) """
+
+        if media_type not in self.spill_types:
+            return
+        self.spill_types.remove(media_type)
+        remaining_budget = max(0, self.budgets[media_type] - self.spent[media_type])
+        self.budgets[media_type] -= remaining_budget
+        for spill_type in self.spill_types:
+            self.budgets[spill_type] += remaining_budget // len(self.spill_types)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build index of the xenial guides media pool.')
+    parser.add_argument('--pool', default=MEDIA_POOL_PATH, help='media pool directory')
+    parser.add_argument('--index', default=MEDIA_POOL_INDEX_PATH, help='path of the index file')
+    parser.add_argument('--rebuild', action='store_true', help='hash and probe all the pool files again')
+    args = parser.parse_args()
+
+    pool_index = MediaPool.load(args.pool, args.index, args.rebuild)
+    for pool_media_type, pool_entries in pool_index['media'].items():
+        num_probed = sum(pool_entry['width'] is not None or pool_entry['duration'] is not None
+                         for pool_entry in pool_entries)
+        pool_size = sum(pool_entry['size'] for pool_entry in pool_entries)
+        print(f'{pool_media_type}: {len(pool_entries)} files, {pool_size} bytes, {num_probed} probed')
@@ -0,0 +1,124 @@
+"""
+Xenial media transcoder
+=======================
+
+This module contains class for transcoding guide media files for a target device profile: images are scaled down to
+the profile's maximal edge and re-encoded as JPEG or WebP, audio is re-encoded to AAC and video to H.264 of
+the profile's height, at the profile's bitrates. GuidePackager runs the transcoding jobs on its media worker pool and
+caches their outputs in the media cache. Transcoded files are stored beside their sources, named after them with
+the profile name appended (e.g. media/image/<source name>.phone.jpeg).
+
+Modules API and guide format is experimental and highly unstable.
+"""
+
+from dataclasses import asdict, dataclass
+import os
+
+import ffmpeg
+
+TRANSCODE_PROFILE = None  # name of the profile (or TranscodeProfile) media are transcoded for, None keeps the media
+
+TRANSCODE_IMAGE_FORMATS = {'jpeg': '.jpeg', 'webp': '.webp'}  # image formats and extensions of the transcoded images
+TRANSCODE_AUDIO_EXTENSION = '.m4a'
+TRANSCODE_VIDEO_EXTENSION = '.mp4'
+TRANSCODE_VIDEO_PRESET = 'medium'  # x264 preset, slower presets make smaller videos of the same quality
+
+VIDEO_COVER_THUMBNAIL_WIDTHS = (480, 160)  # widths of the <cover name>_<width>.png thumbnails stored beside the cover
+
+
+@dataclass
+class TranscodeProfile:
+    """ Target device profile of the transcoded media; image_quality is 0-100 (mapped onto JPEG quantizer scale for
+        JPEG images), bitrates are in bits per second """
+
+    name: str
+    max_image_edge: int = 1280
+    image_format: str = 'jpeg'
+    image_quality: int = 80
+    audio_bitrate: int = 64000
+    video_height: int = 480
+    video_bitrate: int = 800000
+
+
+TRANSCODE_PROFILES = {
+    'phone': TranscodeProfile('phone'),
+    'phone_webp': TranscodeProfile('phone_webp', image_format='webp', image_quality=75),
+    'tablet': TranscodeProfile('tablet', max_image_edge=2048, image_quality=85, audio_bitrate=96000, video_height=720,
+                               video_bitrate=1500000),
+}
+
+
+class MediaTranscoder:
+    @staticmethod
+    def profile(transcode_profile):
+        """ Public method which returns the transcode profile given by its name or as TranscodeProfile, or None when
+            the media are not transcoded """
+
+        if transcode_profile is None or isinstance(transcode_profile, TranscodeProfile):
+            profile = transcode_profile
+        elif transcode_profile in TRANSCODE_PROFILES:
+            profile = TRANSCODE_PROFILES[transcode_profile]
+        else:
+            raise ValueError('Provided a transcode profile of unknown type.')
+        if profile is not None and profile.image_format not in TRANSCODE_IMAGE_FORMATS:
+            raise ValueError('Provided an image format of unknown type.')
+        return profile
+
+    @staticmethod
+    def variant(profile):
+        """ Public method which returns description of the profile keying its transcoded files in the media cache """
+
+        return 'transcode:' + ','.join(f'{field}={value}' for field, value in asdict(profile).items())
+
+    @staticmethod
+    def transcoded_filename(source, media_type, profile):
+        """ Public method which returns path of the media source transcoded for the profile """
+
+        if media_type == 'image':
+            extension = TRANSCODE_IMAGE_FORMATS[profile.image_format]
+        elif media_type == 'audio':
+            extension = TRANSCODE_AUDIO_EXTENSION
+        elif media_type == 'video':
+            extension = TRANSCODE_VIDEO_EXTENSION
+        else:
+            raise ValueError('Provided a media of unknown type.')
+        return f'{os.path.splitext(source)[0]}.{profile.name}{extension}'
+
+    @classmethod
+    def transcode_file(cls, in_mediafile_path, out_mediafile_path, media_type, profile):
+        """ Public method which transcodes the media file for the profile in one ffmpeg run; returns an error message
+            on failure, None otherwise """
+
+        media_input = ffmpeg.input(in_mediafile_path)
+        if media_type == 'image':
+            max_edge = profile.max_image_edge
+            image = media_input.filter('scale', f'min(iw,{max_edge})', f'min(ih,{max_edge})',
+                                       force_original_aspect_ratio='decrease')  # fits the image, never enlarges it
+            if profile.image_format == 'webp':
+                output = image.output(out_mediafile_path, vframes=1, vcodec='libwebp', quality=profile.image_quality)
+            else:
+                output = image.output(out_mediafile_path, vframes=1, **{'q:v': cls._jpeg_qscale(profile.image_quality)})
+        elif media_type == 'audio':
+            output = media_input.output(out_mediafile_path, vn=None, acodec='aac', audio_bitrate=profile.audio_bitrate)
+        elif media_type == 'video':
+            # libx264 needs even dimensions, the height is rounded down to even (and the width is derived as even)
+            video = media_input.video.filter('scale', -2, f'trunc(min(ih,{profile.video_height})/2)*2')
+            output = ffmpeg.output(video, media_input['a?'], out_mediafile_path, vcodec='libx264',
+                                   preset=TRANSCODE_VIDEO_PRESET, video_bitrate=profile.video_bitrate, acodec='aac',
+                                   audio_bitrate=profile.audio_bitrate, movflags='+faststart')
+        else:
+            raise ValueError('Provided a media of unknown type.')
+        try:
+            output.overwrite_output().run(capture_stdout=True, capture_stderr=True)
+        except ffmpeg.Error as e:
+            stderr_lines = e.stderr.decode('utf8', 'replace').strip().splitlines()
+            return stderr_lines[-1] if stderr_lines else str(e)
+        except OSError as e:  # ffmpeg is not installed
+            return str(e)
+        return None
+
+    @staticmethod
+    def _jpeg_qscale(image_quality):
+        """ Private method which maps image quality 0-100 onto ffmpeg JPEG quantizer scale 31-2 (lower is better) """
+
+        return max(2, min(31, round(31 - image_quality * 29 / 100)))
@@ -0,0 +1,122 @@
+"""
+Xenial packaging metrics
+========================
+
+This module contains class collecting metrics of a guide packaging run (GuidePackager.pack): wall times of the
+packaging stages and counters (rows inserted per table, media probes run and taken from the cache, archive bytes and
+members per compression method). Stage events are passed to an optional progress callback as they happen and the
+collected metrics are returned in the packaging report as a JSON serializable dict (see PackMetrics.to_dict); written
+as one JSON line per guide (see PackMetrics.json_line), they can be ingested by build dashboards. A packaging run can
+be profiled by cProfile (pstats file of the main thread) or tracemalloc (top allocation sites and the peak of traced
+memory).
+
+Modules API and guide format is experimental and highly unstable.
+"""
+
+import contextlib
+import cProfile
+import json
+import os
+import time
+import tracemalloc
+
+PACK_PROFILER = None  # None, 'cprofile' or 'tracemalloc' profiles the packaging run and dumps the results
+PACK_PROFILES_PATH = os.path.join('cache', 'profiles')  # directory of the dumped profiles, named after the guide
+PACK_PROFILE_TOP_STATS = 50  # number of the top allocation sites dumped by tracemalloc profiler
+PACK_PROFILE_TRACEMALLOC_FRAMES = 10  # depth of the allocation tracebacks recorded by tracemalloc profiler
+
+
+class PackMetrics:
+    """ Stage timers and counters of a guide packaging run, stage events are passed to progress (if any) as dicts
+        with guide_name, event ('stage_started', 'stage_finished' or 'stage_failed'), stage and time keys """
+
+    def __init__(self, guide_name, progress=None):
+        self.guide_name = guide_name
+        self.progress = progress
+        self.started_at = time.time()
+        self.stages = {}
+        self.counters = {}
+        self.profile = None
+
+    @contextlib.contextmanager
+    def stage(self, stage):
+        """ Public method (context manager) which times a stage of the run, times of repeated stages are summed """
+
+        self._emit('stage_started', stage, 0.0)
+        start_time = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self._emit('stage_failed', stage, time.perf_counter() - start_time)
+            raise
+        stage_time = time.perf_counter() - start_time
+        self.stages[stage] = self.stages.get(stage, 0.0) + stage_time
+        self._emit('stage_finished', stage, stage_time)
+
+    def count(self, counter, key, value=1):
+        """ Public method which adds value to the key of the counter (e.g. rows_inserted counter keyed by table) """
+
+        counter_values = self.counters.setdefault(counter, {})
+        counter_values[key] = counter_values.get(key, 0) + value
+
+    @contextlib.contextmanager
+    def profiled(self, profiler):
+        """ Public method (context manager) which profiles the run by profiler (None, 'cprofile' or 'tracemalloc') and
+            dumps the results into the profiles directory; cProfile profiles only the calling thread, the media and
+            archive worker threads are not profiled """
+
+        if profiler is None:
+            yield
+            return
+        if profiler not in ('cprofile', 'tracemalloc'):
+            raise ValueError('Provided a profiler of unknown type.')
+        os.makedirs(PACK_PROFILES_PATH, exist_ok=True)
+        profile_path = os.path.join(PACK_PROFILES_PATH, self.guide_name)
+        if profiler == 'cprofile':
+            profile = cProfile.Profile()
+            profile.enable()
+            try:
+                yield
+            finally:
+                profile.disable()
+                profile.dump_stats(profile_path + '.prof')
+                self.profile = {'profiler': profiler, 'path': profile_path + '.prof'}
+        else:
+            is_tracing = tracemalloc.is_tracing()  # e.g. started by PYTHONTRACEMALLOC
+            if not is_tracing:
+                tracemalloc.start(PACK_PROFILE_TRACEMALLOC_FRAMES)
+            if hasattr(tracemalloc, 'reset_peak'):  # Python 3.9+, otherwise the peak covers also allocations made
+                tracemalloc.reset_peak()  # since tracing was started by PYTHONTRACEMALLOC
+            try:
+                yield
+            finally:
+                snapshot = tracemalloc.take_snapshot()
+                peak_size = tracemalloc.get_traced_memory()[1]
+                if not is_tracing:
+                    tracemalloc.stop()
+                with open(profile_path + '.tracemalloc.txt', 'w') as f:
+                    f.write(f'peak traced memory: {peak_size} bytes\n')
+                    for statistic in snapshot.statistics('traceback')[:PACK_PROFILE_TOP_STATS]:
+                        f.write(f'\n{statistic.size} bytes in {statistic.count} blocks allocated at\n')
+                        f.writelines(f'{line}\n' for line in statistic.traceback.format(most_recent_first=True))
+                self.profile = {'profiler': profiler, 'path': profile_path + '.tracemalloc.txt',
+                                'peak_traced_bytes': peak_size}
+
+    def to_dict(self):
+        """ Public method which returns the collected metrics as a JSON serializable dict """
+
+        return {'guide_name': self.guide_name,
+                'started_at': self.started_at,
+                'stages': dict(self.stages),
+                'counters': {counter: dict(counter_values) for counter, counter_values in self.counters.items()},
+                'profile': self.profile}
+
+    @staticmethod
+    def json_line(metrics):
+        """ Public method which returns the metrics dict (as returned in the packaging report) as a single JSON line """
+
+        return json.dumps(metrics, separators=(',', ':')) + '\n'
+
+    def _emit(self, event, stage, stage_time):
+        if self.progress is not None:
+            self.progress({'guide_name': self.guide_name, 'event': event, 'stage': stage, 'time': stage_time})
@@ -0,0 +1,149 @@
+import os
+import random
+import sqlite3
+import sys
+from zipfile import ZipFile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from guide_delta import GuideDelta  # noqa: E402
+from guide_model import Article, Bookmark, Category, Guide  # noqa: E402
+from guide_packager import GuidePackager, DIST_PATH  # noqa: E402
+
+ICON_PATH = os.path.join('icons', 'guide.png')
+
+
+def text_guide(articles_paragraphs, guide_name='text_guide'):
+    """ Returns model of a guide without media: articles_paragraphs maps names of its articles to their paragraph
+        texts; every article has a subtitle block and its paragraph blocks, and the tags 'common' and its name """
+
+    articles = [Article(name=name, icon=ICON_PATH, title=f'{name} title', synopsis=f'{name} synopsis',
+                        tags=['common', name],
+                        content=[{'type': 'subtitle', 'text': f'{name} subtitle'}]
+                        + [{'type': 'paragraph', 'text': text} for text in paragraphs])
+                for name, paragraphs in articles_paragraphs.items()]
+    return Guide(guide_name=guide_name, guide_format_version='0.1', guide_icon=ICON_PATH, guide_title='Text guide',
+                 guide_description='Guide without media.', guide_lang=('English', 'en'), guide_from_place='Greece',
+                 guide_to_place='Germany', guide_content=[[article.name, article.title] for article in articles],
+                 categories=[Category(icon=ICON_PATH, name='category', description='Category.', tags=['common'])],
+                 articles=articles,
+                 bookmarks=[Bookmark(article_name=articles[0].name, article_title=articles[0].title,
+                                     created_at='2020-01-01 12:00:00')])
+
+
+def seeded_text_guide(seed, num_articles=40, guide_name='seeded_guide'):
+    """ Returns model of a guide without media whose articles have seeded random tags and paragraphs with markup and
+        refs to the other articles (and to a missing one); its guide content lists the articles in seeded random
+        order """
+
+    seed_random = random.Random(seed)
+    names = [f'article_{article_number}' for article_number in range(num_articles)]
+    articles_paragraphs = {
+        name: [f'Paragraph {paragraph_number} of {name} goes to [ref={seed_random.choice(names + ["missing"])}]'
+               f'{seed_random.choice(["there", "[b]there[/b]"])}[/ref] and [i]on[/i].'
+               for paragraph_number in range(seed_random.randint(1, 4))]
+        for name in names}
+    guide = text_guide(articles_paragraphs, guide_name)
+    for article in guide.articles:
+        article.tags += seed_random.sample([f'tag_{tag_number}' for tag_number in range(num_articles)], k=3)
+    seed_random.shuffle(guide.guide_content)
+    return guide
+
+
+def media_guide(articles_media, guide_name='media_guide'):
+    """ Returns model of a guide whose articles (keyed by their names) have a paragraph block and the media blocks
+        given as pairs of media type and source """
+
+    guide = text_guide({name: [f'Paragraph of {name}.'] for name in articles_media}, guide_name)
+    for article in guide.articles:
+        article.content += [{'type': media_type, 'source': source, 'caption': f'Caption of {source}.'}
+                            for media_type, source in articles_media[article.name]]
+    return guide
+
+
+def archive_db_rows(archive_path, extract_path):
+    """ Returns rows (with rowids) of the content tables of guide.db of the archive (extracted into extract_path)
+        keyed by the table name; sqlite internal tables and shadow tables of the full-text table are left out """
+
+    with ZipFile(archive_path) as zipf:
+        db_path = zipf.extract('guide.db', str(extract_path))
+    conn = sqlite3.connect(db_path)
+    tables_rows = {table_name: GuideDelta._fetchall_rows(conn, table_name, is_rowid_table)
+                   for table_name, is_rowid_table in GuideDelta._fetchall_content_tables(conn)}
+    conn.close()
+    return tables_rows
+
+
+def archive_db_content(archive_path, extract_path):
+    """ Returns rows of the content tables of guide.db of the archive like archive_db_rows, but without the ids of the
+        tags and blocks (and rowids of the full-text table) an incremental repack assigns anew: tags are given by their
+        names and blocks by their article id and order; rows of every table are sorted """
+
+    with ZipFile(archive_path) as zipf:
+        db_path = zipf.extract('guide.db', str(extract_path))
+    conn = sqlite3.connect(db_path)
+    tags_names = dict(conn.execute(""" SELECT id, name FROM tags; """).fetchall())
+    blocks_keys = {(block_type, block_id): (article_id, block_order) for article_id, block_id, block_order, block_type
+                   in conn.execute(""" SELECT article_id, block_id, block_order, block_type FROM articles_blocks; """)}
+    tables_rows = {}
+    for table_name, is_rowid_table in GuideDelta._fetchall_content_tables(conn):
+        columns = GuideDelta._fetchall_columns(conn, table_name)
+        rows = []
+        for row in GuideDelta._fetchall_rows(conn, table_name, is_rowid_table):
+            values = dict(zip(columns, row[1:] if is_rowid_table else row))
+            if 'tag_id' in values:
+                values['tag_id'] = tags_names[values['tag_id']]
+            if values.get('block_id') is not None:
+                values['block_id'] = blocks_keys[(values['block_type'], values['block_id'])]
+            if table_name.endswith('_blocks') and table_name != 'articles_blocks':
+                values['id'] = blocks_keys[(table_name[:-len('_blocks')], values['id'])]
+            rows.append(tuple(values.values()))
+        if table_name != 'tags':
+            tables_rows[table_name] = sorted(rows, key=repr)
+    tables_rows['tags'] = sorted(tags_names.values())
+    conn.close()
+    return tables_rows
+
+
+@pytest.fixture
+def pack_guide(tmp_path, monkeypatch):
+    """ Returns function which packs the guide model (in a temporary working directory) and returns path of its
+        archive; media_payloads (bytes keyed by the media source) are written into the guide directory first and,
+        if exported, the guide is packed from its exported JSON files. The report of the last run is kept in the
+        report attribute of the function. """
+
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(DIST_PATH)
+
+    def pack(guide, media_payloads=None, exported=False, **pack_kwargs):
+        guide_path = os.path.join('tmp', guide.guide_name)
+        os.makedirs(os.path.join(guide_path, 'icons'), exist_ok=True)
+        with open(os.path.join(guide_path, ICON_PATH), 'wb') as f:
+            f.write(b'icon')
+        for source, payload in (media_payloads or {}).items():
+            os.makedirs(os.path.dirname(os.path.join(guide_path, source)), exist_ok=True)
+            with open(os.path.join(guide_path, source), 'wb') as f:
+                f.write(payload)
+        if exported:
+            guide.export_json(guide_path)
+        pack_kwargs.setdefault('catalog', False)
+        pack_kwargs.setdefault('media_cache_path', None)
+        pack.report = GuidePackager.pack(guide.guide_name, guide_path, guide=None if exported else guide,
+                                         **pack_kwargs)
+        return os.path.join(DIST_PATH, f'{guide.guide_name}.zip')
+
+    return pack
+
+
+@pytest.fixture
+def generator_workdir(tmp_path, monkeypatch):
+    """ Changes the working directory to a temporary one linking the icons and the media pool of the repository, in
+        which guides are generated and packed """
+
+    repo_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    monkeypatch.chdir(tmp_path)
+    for dirname in ('icons', 'media'):
+        os.symlink(os.path.join(repo_path, dirname), dirname)
+    os.makedirs(DIST_PATH)
@@ -0,0 +1,80 @@
+import io
+import zlib
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED, ZIP_LZMA, ZIP_STORED
+
+import pytest
+
+from archive_writer import ArchiveWriter
+
+pytestmark = pytest.mark.skipif(not ArchiveWriter.supported(), reason='zipfile of this Python version not supported')
+
+DATA = b'xenial guide member data ' * 1000
+
+
+def compressed_member(name, compression, compresslevel=6):
+    compressor, data_header = ArchiveWriter.compressor(compression, compresslevel)
+    zinfo = ZipInfo(name)
+    zinfo.compress_type = compression
+    if compression == ZIP_LZMA:
+        zinfo.flag_bits |= 0x02
+    compressed_data = data_header + compressor.compress(DATA) + compressor.flush()
+    zinfo.CRC = zlib.crc32(DATA)
+    zinfo.file_size = len(DATA)
+    zinfo.compress_size = len(compressed_data)
+    return zinfo, io.BytesIO(compressed_data)
+
+
+@pytest.mark.parametrize('compression, compresslevel', [(ZIP_DEFLATED, 9), (ZIP_LZMA, 0), (ZIP_LZMA, 9)])
+def test_write_compressed_members(compression, compresslevel):
+    archive_file = io.BytesIO()
+    with ZipFile(archive_file, 'w') as zipf:
+        zipf.writestr('before.txt', b'before')
+        ArchiveWriter.write_member(zipf, *compressed_member('member.txt', compression, compresslevel))
+        zipf.writestr('after.txt', b'after')
+
+    with ZipFile(archive_file) as zipf:
+        assert zipf.testzip() is None
+        assert zipf.namelist() == ['before.txt', 'member.txt', 'after.txt']
+        assert zipf.read('member.txt') == DATA
+        assert zipf.getinfo('member.txt').compress_type == compression
+
+
+def test_write_aligned_and_rewritten_members():
+    archive_file = io.BytesIO()
+    with ZipFile(archive_file, 'w') as zipf:
+        reserved_zinfo = ZipInfo('index.json')
+        reserved_zinfo.CRC = zlib.crc32(b' ' * 16)
+        reserved_zinfo.file_size = reserved_zinfo.compress_size = 16
+        ArchiveWriter.write_member(zipf, reserved_zinfo, io.BytesIO(b' ' * 16))
+        aligned_zinfo = ZipInfo('guide.db')
+        aligned_zinfo.CRC = zlib.crc32(DATA)
+        aligned_zinfo.file_size = aligned_zinfo.compress_size = len(DATA)
+        ArchiveWriter.write_member(zipf, aligned_zinfo, io.BytesIO(DATA), alignment=4096)
+        zipf.writestr('after.txt', b'after')
+        with pytest.raises(ValueError):
+            ArchiveWriter.rewrite_member(zipf, reserved_zinfo, b'too long for the reserved member')
+        ArchiveWriter.rewrite_member(zipf, reserved_zinfo, b'{"members":{}}  ')
+
+    with ZipFile(archive_file) as zipf:
+        assert zipf.testzip() is None
+        assert zipf.read('index.json') == b'{"members":{}}  '
+        assert zipf.read('after.txt') == b'after'
+    data_offset = archive_file.getvalue().index(DATA)
+    assert data_offset % 4096 == 0
+
+
+def test_copy_member():
+    previous_archive_file = io.BytesIO()
+    with ZipFile(previous_archive_file, 'w', compression=ZIP_DEFLATED) as previous_zipf:
+        previous_zipf.writestr('member.txt', DATA)
+        previous_zipf.writestr('stored.txt', b'stored', compress_type=ZIP_STORED)
+    archive_file = io.BytesIO()
+    with ZipFile(previous_archive_file) as previous_zipf, ZipFile(archive_file, 'w') as zipf:
+        for zinfo in previous_zipf.infolist():
+            ArchiveWriter.copy_member(zipf, previous_archive_file, zinfo)
+
+    with ZipFile(archive_file) as zipf:
+        assert zipf.testzip() is None
+        assert zipf.read('member.txt') == DATA
+        assert zipf.read('stored.txt') == b'stored'
+        assert zipf.getinfo('member.txt').compress_type == ZIP_DEFLATED
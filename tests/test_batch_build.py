@@ -0,0 +1,38 @@
+import os
+import shutil
+
+import pytest
+
+from batch_build import GuideBatchBuilder
+from conftest import archive_db_rows
+from guide_packager import DIST_PATH
+
+
+def articles_texts(archive_path, extract_path):
+    return [(name, title, synopsis) for rowid, article_id, name, icon, title, synopsis
+            in archive_db_rows(archive_path, extract_path)['articles']]
+
+
+@pytest.mark.skipif(shutil.which('ffprobe') is None or shutil.which('ffmpeg') is None,
+                    reason='ffprobe and ffmpeg are needed to probe media and extract covers')
+def test_builds_seeded_guides_in_parallel(generator_workdir, tmp_path):
+    reports = GuideBatchBuilder.build(['first', 'second', 'third'], seeds=[7, 7, 8], max_workers=2)
+
+    assert [report['guide_name'] for report in reports] == ['first', 'second', 'third']
+    for report in reports:
+        assert report['error'] is None
+        assert report['generate_time'] > 0 and report['pack_time'] > 0
+    first_texts, second_texts, third_texts = [
+        articles_texts(os.path.join(DIST_PATH, f'{guide_name}.zip'), tmp_path / guide_name)
+        for guide_name in ('first', 'second', 'third')]
+    assert first_texts == second_texts != third_texts
+
+
+@pytest.mark.parametrize('guides_names, seeds', [(['first', 'first'], None), (['first', 'second'], [1])])
+def test_rejects_invalid_guides(guides_names, seeds):
+    with pytest.raises(ValueError):
+        GuideBatchBuilder.build(guides_names, seeds)
+
+
+def test_guides_names_are_numbered():
+    assert GuideBatchBuilder.guides_names(10, 'store') == [f'store_{number:02d}' for number in range(1, 11)]
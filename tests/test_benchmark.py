@@ -0,0 +1,27 @@
+import json
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+import benchmark
+
+# stages timed separately: text generation, file copies, DB inserts, ffprobe, cover extraction, FTS build and zip
+BENCHMARKED_STAGES = ('text_generation', 'file_copies', 'db_inserts', 'probe_media', 'extract_video_covers',
+                      'search_index', 'archive')
+
+
+@pytest.mark.skipif(shutil.which('ffprobe') is None or shutil.which('ffmpeg') is None,
+                    reason='ffprobe and ffmpeg are needed to probe media and extract covers')
+@pytest.mark.parametrize('benchmark_args', [[], ['--streaming']])
+def test_report_times_all_stages(generator_workdir, benchmark_args):
+    subprocess.run([sys.executable, benchmark.__file__, '--sizes', '20', '--output', 'benchmark.json']
+                   + benchmark_args, check=True, stdout=subprocess.DEVNULL)
+    with open('benchmark.json') as f:
+        report = json.load(f)
+
+    size_run, = report['runs']
+    assert set(BENCHMARKED_STAGES) <= set(size_run['stages'])
+    assert size_run['stages']['text_generation'] > 0
+    assert size_run['peak_rss_kib'] > 0
@@ -0,0 +1,36 @@
+import pytest
+
+from conftest import text_guide
+from guide_archive import GuideArchive, QUERY_PLAN_QUERIES
+
+ARTICLES_PARAGRAPHS = {
+    'first': ['Goes to [ref=second]second[/ref].'],
+    'second': ['Goes to [ref=first]first[/ref] and [ref=third]third[/ref].'],
+    'third': ['Goes nowhere.'],
+}
+
+
+@pytest.mark.parametrize('search_index', ['fts4', 'fts5'])
+def test_reference_queries_use_indexes(pack_guide, search_index):
+    archive_path = pack_guide(text_guide(ARTICLES_PARAGRAPHS), search_index=search_index)
+    with GuideArchive(archive_path) as archive:
+        plans = archive.explain_query_plans()
+
+    assert set(plans) == set(QUERY_PLAN_QUERIES)
+    for query_name, plan in plans.items():
+        assert not GuideArchive.query_plan_regression(plan), (query_name, plan)
+    assert any('tags_articles_by_article' in detail for detail in plans['tags of article'])
+    assert any('tags_categories_by_category' in detail for detail in plans['tags of category'])
+    assert any('article_links_by_source' in detail for detail in plans['articles linked from article'])
+    assert any('PRIMARY KEY (target_article_id=?)' in detail for detail in plans['articles linking to article'])
+
+
+@pytest.mark.parametrize('plan, regression', [
+    (['SEARCH ta USING COVERING INDEX tags_articles_by_article (article_id=?)'], False),
+    (['SEARCH al USING PRIMARY KEY (target_article_id=?)', 'SEARCH a USING INTEGER PRIMARY KEY (rowid=?)'], False),
+    (['SCAN ta', 'SEARCH t USING INTEGER PRIMARY KEY (rowid=?)'], True),
+    (['SEARCH articles_blocks USING PRIMARY KEY (article_id=?)', 'USE TEMP B-TREE FOR ORDER BY'], True),
+    ([], False),
+])
+def test_query_plan_regression(plan, regression):
+    assert GuideArchive.query_plan_regression(plan) == regression
@@ -0,0 +1,71 @@
+import os
+import shutil
+import sqlite3
+from zipfile import ZipFile
+
+import pytest
+
+from conftest import text_guide
+from guide_delta import GuideDelta
+
+BASE_ARTICLES_PARAGRAPHS = {
+    'kept': ['Unchanged paragraph.'],
+    'changed': ['Paragraph before the change.', 'Second paragraph.'],
+    'deleted': ['Paragraph of the deleted article.'],
+}
+ARTICLES_PARAGRAPHS = {
+    'kept': ['Unchanged paragraph.'],
+    'changed': ['Paragraph after the change, see [ref=added]added[/ref].'],
+    'added': ['Paragraph of the added article mentions zeppelin.'],
+}
+
+
+def fulltext_matches(db_path, word):
+    conn = sqlite3.connect(db_path)
+    rows = conn.execute(""" SELECT block_text FROM article_block_search WHERE article_block_search MATCH ?; """,
+                        (word,)).fetchall()
+    conn.close()
+    return sorted(row[0] for row in rows)
+
+
+@pytest.mark.parametrize('search_index', ['fts4', 'fts5'])
+def test_sql_patch_round_trip(pack_guide, tmp_path, search_index):
+    base_archive_path = pack_guide(text_guide(BASE_ARTICLES_PARAGRAPHS), search_index=search_index)
+    shutil.move(base_archive_path, base_archive_path + '.base')
+    base_archive_path += '.base'
+    archive_path = pack_guide(text_guide(ARTICLES_PARAGRAPHS), search_index=search_index)
+    guide_path = str(tmp_path / 'extracted')
+    with ZipFile(base_archive_path) as zipf:
+        zipf.extractall(guide_path)
+    with ZipFile(archive_path) as zipf:
+        zipf.extract('guide.db', str(tmp_path / 'target'))
+    target_db_path = str(tmp_path / 'target' / 'guide.db')
+    db_path = os.path.join(guide_path, 'guide.db')
+
+    report = GuideDelta.create(base_archive_path, archive_path, str(tmp_path / 'guide.delta.zip'), guide_db='patch')
+    assert report['delta_guide_db'] == 'patch'
+    assert GuideDelta.db_digest(db_path) != GuideDelta.db_digest(target_db_path)
+    GuideDelta.apply(report['delta_path'], guide_path)
+
+    assert GuideDelta.db_digest(db_path) == GuideDelta.db_digest(target_db_path)
+    conn = sqlite3.connect(db_path)
+    assert sorted(row[0] for row in conn.execute(""" SELECT name FROM articles; """)) == sorted(ARTICLES_PARAGRAPHS)
+    assert conn.execute(""" SELECT count(*) FROM paragraph_blocks
+                            WHERE paragraph_text LIKE '%before the change%'; """).fetchone()[0] == 0
+    conn.close()
+    assert fulltext_matches(db_path, 'zeppelin') == fulltext_matches(target_db_path, 'zeppelin') != []
+    assert fulltext_matches(db_path, 'deleted') == []
+
+
+def test_apply_rejects_other_base(pack_guide, tmp_path):
+    base_archive_path = pack_guide(text_guide(BASE_ARTICLES_PARAGRAPHS))
+    shutil.move(base_archive_path, base_archive_path + '.base')
+    base_archive_path += '.base'
+    archive_path = pack_guide(text_guide(ARTICLES_PARAGRAPHS))
+    guide_path = str(tmp_path / 'extracted')
+    with ZipFile(archive_path) as zipf:  # the target guide, not the delta base
+        zipf.extractall(guide_path)
+
+    report = GuideDelta.create(base_archive_path, archive_path, str(tmp_path / 'guide.delta.zip'), guide_db='patch')
+    with pytest.raises(ValueError):
+        GuideDelta.apply(report['delta_path'], guide_path)
@@ -0,0 +1,379 @@
+import json
+import os
+import random
+import shutil
+import sqlite3
+from zipfile import ZipFile
+
+import pytest
+
+from async_build import AsyncGuideBuilder
+from conftest import archive_db_content, archive_db_rows, media_guide, seeded_text_guide, text_guide
+from guide_generator import GuideGenerator, TMP_PATH
+from guide_packager import GuidePackager, DIST_PATH, GUIDE_SOURCES_PATHS, SEARCH_INDEX_PREFIXES
+from media_cache import MediaCache
+from media_pool import MediaPool, MEDIA_POOL_PATH
+from media_transcoder import VIDEO_COVER_THUMBNAIL_WIDTHS
+from pack_metrics import PackMetrics, PACK_PROFILES_PATH
+
+media_tools_required = pytest.mark.skipif(shutil.which('ffprobe') is None or shutil.which('ffmpeg') is None,
+                                          reason='ffprobe and ffmpeg are needed to probe media and extract covers')
+
+ARTICLES_DICTS = {'first': [1, None], 'second': [2, None]}
+
+ARTICLES_PARAGRAPHS = {
+    'first': ['Goes to [b][ref=second]second[/ref][/b] and [ref=missing]nowhere[/ref].'],
+    'second': ['Goes to [ref=first]first[/ref], [ref=first]first again[/ref] and [ref=]no article[/ref].'],
+}
+
+ARTICLES_MEDIA = {
+    'first': [('video', 'media/video/clip.mp4'), ('video', 'media/video/clip.mp4'), ('audio', 'media/audio/song.m4a')],
+    'second': [('video', 'media/video/copy.mp4'), ('image', 'media/image/photo.jpeg'),
+               ('audio', 'media/audio/song.m4a')],
+}
+
+
+def pool_payloads(media_type, num_payloads=1):
+    """ Returns contents of the smallest media pool files of the media type, so real ffprobe and ffmpeg take them """
+
+    pool_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), MEDIA_POOL_PATH, media_type)
+    payloads = []
+    for path in sorted((os.path.join(pool_path, filename) for filename in os.listdir(pool_path)),
+                       key=os.path.getsize)[:num_payloads]:
+        with open(path, 'rb') as f:
+            payloads.append(f.read())
+    return payloads
+
+
+VIDEO_PAYLOAD, OTHER_VIDEO_PAYLOAD = pool_payloads('video', 2)
+MEDIA_PAYLOADS = {'media/video/clip.mp4': VIDEO_PAYLOAD, 'media/video/copy.mp4': VIDEO_PAYLOAD,
+                  'media/audio/song.m4a': pool_payloads('audio')[0],
+                  'media/image/photo.jpeg': pool_payloads('image')[0]}
+
+
+@pytest.mark.parametrize('text, rewritten_text, spans, targets_ids, unresolved_refs', [
+    ('Plain text.', 'Plain text.', [['Plain text.', [], None]], [], set()),
+    ('Go [ref=second]there[/ref].', 'Go [ref=2]there[/ref].',
+     [['Go ', [], None], ['there', [], 2], ['.', [], None]], [2], set()),
+    ('[ref=missing]Gone[/ref] [ref= first ]back[/ref]', '[ref=]Gone[/ref] [ref=1]back[/ref]',
+     [['Gone ', [], None], ['back', [], 1]], [1], {'missing'}),
+    ('[ref=first]a[/ref][ref=second]b[/ref][ref=first]c[/ref]', '[ref=1]a[/ref][ref=2]b[/ref][ref=1]c[/ref]',
+     [['a', [], 1], ['b', [], 2], ['c', [], 1]], [1, 2], set()),
+    ('[ref=]Empty[/ref] ref', '[ref=]Empty[/ref] ref', [['Empty ref', [], None]], [], set()),
+    ('[b][i]both[/b] italic[/i] none', '[b][i]both[/b] italic[/i] none',
+     [['both', ['b', 'i'], None], [' italic', ['i'], None], [' none', [], None]], [], set()),
+    ('[color=#ff0000]red [b]bold[/b][/color]', '[color=#ff0000]red [b]bold[/b][/color]',
+     [['red ', ['color=#ff0000'], None], ['bold', ['color=#ff0000', 'b'], None]], [], set()),
+    ('&bl;b&br; &amp; [b]x[/b]', '&bl;b&br; &amp; [b]x[/b]', [['[b] & ', [], None], ['x', ['b'], None]], [], set()),
+])
+def test_parse_markup(text, rewritten_text, spans, targets_ids, unresolved_refs):
+    assert GuidePackager._parse_markup(text, ARTICLES_DICTS) == (rewritten_text, spans, targets_ids, unresolved_refs)
+
+
+def test_article_links_and_spans_tables(pack_guide, tmp_path):
+    archive_path = pack_guide(text_guide(ARTICLES_PARAGRAPHS), markup_spans=True)
+    with ZipFile(archive_path) as zipf:
+        zipf.extract('guide.db', str(tmp_path / 'extracted'))
+    conn = sqlite3.connect(str(tmp_path / 'extracted' / 'guide.db'))
+    articles_ids = dict(conn.execute(""" SELECT name, id FROM articles; """).fetchall())
+    paragraphs_ids = {text: block_id for block_id, text in conn.execute(
+        """ SELECT id, paragraph_text FROM paragraph_blocks; """).fetchall()}
+    first_paragraph_id, second_paragraph_id = sorted(paragraphs_ids.values())
+
+    links = conn.execute(""" SELECT source_article_id, target_article_id, block_type, block_id
+                             FROM article_links; """).fetchall()
+    assert sorted(links) == sorted([
+        (articles_ids['first'], articles_ids['second'], 'paragraph', first_paragraph_id),
+        (articles_ids['second'], articles_ids['first'], 'paragraph', second_paragraph_id),
+    ])
+    assert paragraphs_ids == {
+        f"Goes to [b][ref={articles_ids['second']}]second[/ref][/b] and [ref=]nowhere[/ref].": first_paragraph_id,
+        f"Goes to [ref={articles_ids['first']}]first[/ref], [ref={articles_ids['first']}]first again[/ref] and "
+        f"[ref=]no article[/ref].": second_paragraph_id,
+    }
+
+    blocks_spans = {(block_type, block_id): json.loads(spans) for block_type, block_id, spans in conn.execute(
+        """ SELECT block_type, block_id, spans FROM article_block_spans; """).fetchall()}
+    conn.close()
+    assert blocks_spans[('paragraph', first_paragraph_id)] == [
+        ['Goes to ', [], None], ['second', ['b'], articles_ids['second']], [' and nowhere.', [], None]]
+    assert blocks_spans[('paragraph', second_paragraph_id)] == [
+        ['Goes to ', [], None], ['first', [], articles_ids['first']], [', ', [], None],
+        ['first again', [], articles_ids['first']], [' and no article.', [], None]]
+    assert blocks_spans[('subtitle', 1)] == [['first subtitle', [], None]]
+
+
+@pytest.mark.parametrize('search_index', ['fts4', 'fts5'])
+def test_bulk_load_matches_row_by_row(pack_guide, tmp_path, search_index):
+    archive_path = pack_guide(seeded_text_guide(1), search_index=search_index, bulk_load=False)
+    rows_tables_rows = archive_db_rows(archive_path, tmp_path / 'rows')
+    archive_path = pack_guide(seeded_text_guide(1), search_index=search_index, bulk_load=True)
+    bulk_tables_rows = archive_db_rows(archive_path, tmp_path / 'bulk')
+
+    assert bulk_tables_rows == rows_tables_rows
+    tags_ids = [tag_id for tag_id, tag_id_column, tag_name in bulk_tables_rows['tags']]
+    assert tags_ids == list(range(1, len(tags_ids) + 1))
+
+
+@pytest.mark.parametrize('pack_kwargs', [{'bulk_load': False}, {'streaming': True}, {'incremental': True}])
+def test_builds_match_bulk_load(pack_guide, tmp_path, pack_kwargs):
+    guide = seeded_text_guide(2)
+    archive_path = pack_guide(guide, bulk_load=True)
+    bulk_tables_rows = archive_db_rows(archive_path, tmp_path / 'bulk')
+    archive_path = pack_guide(seeded_text_guide(2), **pack_kwargs)
+
+    assert archive_db_rows(archive_path, tmp_path / 'build') == bulk_tables_rows
+    articles_names = [article_name for rowid, article_id, article_name, icon, title, synopsis
+                      in bulk_tables_rows['articles']]
+    assert articles_names == [article_name for article_name, article_title in guide.guide_content]
+
+
+def edited_seeded_text_guide(seed):
+    """ Returns the seeded guide with the content and tags of one of its articles edited """
+
+    guide = seeded_text_guide(seed)
+    guide.articles[3].content[1]['text'] = 'Edited, goes to [ref=article_5]there[/ref] and [ref=gone]nowhere[/ref].'
+    guide.articles[3].content.append({'type': 'paragraph', 'text': 'Appended [b]paragraph[/b].'})
+    guide.articles[3].tags = ['common', 'edited']
+    return guide
+
+
+def test_incremental_repack_after_edit_matches_full_build(pack_guide, tmp_path):
+    archive_path = pack_guide(edited_seeded_text_guide(3))
+    full_build_content = archive_db_content(archive_path, tmp_path / 'full')
+
+    pack_guide(seeded_text_guide(3), incremental=True)
+    archive_path = pack_guide(edited_seeded_text_guide(3), incremental=True)
+    assert archive_db_content(archive_path, tmp_path / 'incremental') == full_build_content
+
+
+@media_tools_required
+def test_async_build_matches_pack(generator_workdir, tmp_path):
+    random.seed(4)
+    AsyncGuideBuilder.build('seeded_guide', catalog=False, media_cache_path=None)
+    async_tables_rows = archive_db_rows(os.path.join(DIST_PATH, 'seeded_guide.zip'), tmp_path / 'async')
+    random.seed(4)
+    guide_path, guide = GuideGenerator.generate_guide('seeded_guide')
+    GuidePackager.pack('seeded_guide', guide_path, guide=guide, catalog=False, media_cache_path=None)
+
+    pack_tables_rows = archive_db_rows(os.path.join(DIST_PATH, 'seeded_guide.zip'), tmp_path / 'pack')
+    for tables_rows in (async_tables_rows, pack_tables_rows):  # creation dates of the bookmarks are not seeded
+        tables_rows['bookmarks'] = [bookmark_row[:-1] for bookmark_row in tables_rows['bookmarks']]
+    assert pack_tables_rows == async_tables_rows
+    assert not os.path.exists(guide_path)
+
+
+@media_tools_required
+def test_failed_async_build_removes_guide_directory(generator_workdir, monkeypatch):
+    def fail_finalization(guide_path, db_page_size):
+        raise RuntimeError('Finalization failed.')
+
+    monkeypatch.setattr(GuidePackager, '_finalize_guide_db', fail_finalization)
+    with pytest.raises(RuntimeError, match='Finalization failed.'):
+        AsyncGuideBuilder.build('failed_guide', catalog=False, media_cache_path=None)
+    assert not os.path.exists(os.path.join(TMP_PATH, 'failed_guide'))
+
+
+@media_tools_required
+def test_distinct_media_probed_once_on_any_executor(pack_guide, tmp_path):
+    executors_tables_rows = []
+    for probe_executor in ('thread', 'process'):
+        archive_path = pack_guide(media_guide(ARTICLES_MEDIA), MEDIA_PAYLOADS, probe_executor=probe_executor,
+                                  probe_max_workers=2)
+        counters = pack_guide.report['metrics']['counters']
+        assert counters['media']['distinct'] == 3  # clip.mp4 and copy.mp4 are the same payload
+        assert counters['probes'] == {'run': 3}
+        executors_tables_rows.append(archive_db_rows(archive_path, tmp_path / probe_executor))
+
+    thread_tables_rows, process_tables_rows = executors_tables_rows
+    assert process_tables_rows == thread_tables_rows
+    audio_lengths = [audio_length for rowid, block_id, block_type, audio_source, audio_length, caption_text
+                     in thread_tables_rows['audio_blocks']]
+    assert len(audio_lengths) == 2 and audio_lengths[0] == audio_lengths[1] > 0
+
+
+def test_rejects_unknown_probe_executor(pack_guide):
+    with pytest.raises(ValueError, match='probe executor'):
+        pack_guide(media_guide(ARTICLES_MEDIA), MEDIA_PAYLOADS, probe_executor='fiber')
+
+
+@media_tools_required
+def test_repack_takes_probes_and_covers_from_media_cache(pack_guide, monkeypatch):
+    pack_guide(media_guide(ARTICLES_MEDIA), MEDIA_PAYLOADS, media_cache_path=os.path.join('cache', 'media.db'))
+    assert pack_guide.report['metrics']['counters']['probes'] == {'run': 3, 'cached': 0}
+
+    monkeypatch.setenv('PATH', '')  # neither ffprobe nor ffmpeg can run
+    archive_path = pack_guide(media_guide(ARTICLES_MEDIA), MEDIA_PAYLOADS,
+                              media_cache_path=os.path.join('cache', 'media.db'))
+    assert pack_guide.report['metrics']['counters']['probes'] == {'run': 0, 'cached': 3}
+    assert pack_guide.report['video_covers_failures'] == {}
+    with ZipFile(archive_path) as zipf:
+        assert set(GuidePackager._video_covers_filenames('media/video/clip.mp4')) <= set(zipf.namelist())
+
+
+@media_tools_required
+def test_archive_holds_every_media_payload_once(pack_guide, tmp_path):
+    archive_path = pack_guide(media_guide(ARTICLES_MEDIA), MEDIA_PAYLOADS)
+    with ZipFile(archive_path) as zipf:
+        media_members = sorted(name for name in zipf.namelist()
+                               if name.startswith('media/') and name.endswith(('.mp4', '.m4a', '.jpeg')))
+    assert media_members == ['media/audio/song.m4a', 'media/image/photo.jpeg', 'media/video/clip.mp4']
+
+    tables_rows = archive_db_rows(archive_path, tmp_path / 'extracted')
+    assert {video_row[2] for video_row in tables_rows['video_blocks']} == {'guides/media_guide/media/video/clip.mp4'}
+    assert len(tables_rows['video_blocks']) == 3
+
+
+def test_generator_links_every_pool_payload_once(generator_workdir):
+    GuideGenerator._reset_tmp_dir('linked_guide')
+    media_pool = MediaPool.list_files()
+    entry = media_pool['media']['audio'][0]
+    source = GuideGenerator._link_media_file('linked_guide', media_pool, 'audio', entry, 0)
+
+    assert GuideGenerator._link_media_file('linked_guide', media_pool, 'audio', entry, 0) == source
+    assert os.listdir(os.path.join(TMP_PATH, 'linked_guide', 'media', 'audio')) == [os.path.basename(source)]
+    pool_path = MediaPool.media_path(media_pool, 'audio', entry)
+    assert source == os.path.join('media', 'audio', MediaCache.hash_file(pool_path) + os.path.splitext(pool_path)[1])
+
+
+@pytest.mark.parametrize('bulk_load', [True, False])
+def test_pack_of_exported_guide_matches_pack_of_model(pack_guide, tmp_path, bulk_load):
+    archive_path = pack_guide(seeded_text_guide(5), bulk_load=bulk_load)
+    model_tables_rows = archive_db_rows(archive_path, tmp_path / 'model')
+    archive_path = pack_guide(seeded_text_guide(5), exported=True, bulk_load=bulk_load)
+
+    assert archive_db_rows(archive_path, tmp_path / 'exported') == model_tables_rows
+    with ZipFile(archive_path) as zipf:
+        assert json.loads(zipf.read('guide.json')) == json.loads(json.dumps(seeded_text_guide(5).to_dict()))
+        assert not [name for name in zipf.namelist() if name.split('/')[0] in GUIDE_SOURCES_PATHS]
+
+
+def search_matches(archive_path, extract_path, query):
+    with ZipFile(archive_path) as zipf:
+        db_path = zipf.extract('guide.db', str(extract_path))
+    conn = sqlite3.connect(db_path)
+    matches = conn.execute(""" SELECT article_id, block_order, block_type, block_id FROM article_block_search
+                               WHERE article_block_search MATCH ? ORDER BY article_id, block_order; """,
+                           (query,)).fetchall()
+    conn.close()
+    return matches
+
+
+@pytest.mark.parametrize('query', ['there', 'synopsis', 'subtitle', 'para*', '"article 3"'])
+def test_fts5_search_index_finds_fts4_matches(pack_guide, tmp_path, query):
+    fts4_matches = search_matches(pack_guide(seeded_text_guide(6), search_index='fts4'), tmp_path / 'fts4', query)
+    fts5_matches = search_matches(pack_guide(seeded_text_guide(6), search_index='fts5'), tmp_path / 'fts5', query)
+
+    assert fts5_matches == fts4_matches != []
+
+
+def test_fts5_search_index_has_prefix_indexes(pack_guide, tmp_path):
+    archive_path = pack_guide(seeded_text_guide(6), search_index='fts5')
+    with ZipFile(archive_path) as zipf:
+        db_path = zipf.extract('guide.db', str(tmp_path))
+    conn = sqlite3.connect(db_path)
+    table_sql, = conn.execute(""" SELECT sql FROM sqlite_master WHERE name='article_block_search'; """).fetchone()
+    conn.close()
+    assert "prefix='{prefixes}'".format(prefixes=' '.join(map(str, SEARCH_INDEX_PREFIXES))) in table_sql
+
+
+@pytest.mark.parametrize('bulk_load, db_page_size', [(False, 4096), (True, 1024)])
+def test_finalized_db_is_vacuumed_with_page_size(pack_guide, tmp_path, bulk_load, db_page_size):
+    archive_path = pack_guide(seeded_text_guide(7), bulk_load=bulk_load, db_page_size=db_page_size)
+    with ZipFile(archive_path) as zipf:
+        db_path = zipf.extract('guide.db', str(tmp_path))
+
+    assert os.path.getsize(db_path) == pack_guide.report['db_size_after'] <= pack_guide.report['db_size_before']
+    conn = sqlite3.connect(db_path)
+    assert conn.execute(""" PRAGMA page_size; """).fetchone()[0] == db_page_size
+    assert conn.execute(""" PRAGMA freelist_count; """).fetchone()[0] == 0
+    for table_name in ('tags_articles', 'tags_categories', 'articles_blocks'):
+        table_sql, = conn.execute(""" SELECT sql FROM sqlite_master WHERE name=?; """, (table_name,)).fetchone()
+        assert 'WITHOUT ROWID' in table_sql
+    conn.close()
+
+
+def test_rejects_unsupported_page_size(pack_guide):
+    with pytest.raises(ValueError, match='page size'):
+        pack_guide(seeded_text_guide(7), db_page_size=3000)
+
+
+def test_video_cover_and_thumbnails_taken_at_seek_time():
+    covers_filenames = GuidePackager._video_covers_filenames('media/video/clip.mp4')
+    args = GuidePackager._video_cover_outputs('clip.mp4', covers_filenames, 2.5).get_args()
+
+    assert args[:4] == ['-ss', '2.5', '-i', 'clip.mp4']
+    assert len(covers_filenames) == len(VIDEO_COVER_THUMBNAIL_WIDTHS) + 1
+    assert set(covers_filenames) <= set(args)
+    assert all(f'min(iw\\,{width})' in args[args.index('-filter_complex') + 1]
+               for width in VIDEO_COVER_THUMBNAIL_WIDTHS)
+
+
+@media_tools_required
+def test_failed_video_cover_is_recorded_per_video(pack_guide, tmp_path, monkeypatch):
+    extract_video_cover_files = GuidePackager._extract_video_cover_files
+
+    def fail_broken_video_cover(in_videofile_path, out_imagefiles_paths, seek_time):
+        if os.path.basename(in_videofile_path) == 'broken.mp4':
+            with open(out_imagefiles_paths[0], 'wb'):  # leaves a partial cover behind as a failed ffmpeg run may
+                pass
+            return 'Invalid data found when processing input'
+        return extract_video_cover_files(in_videofile_path, out_imagefiles_paths, seek_time)
+
+    monkeypatch.setattr(GuidePackager, '_extract_video_cover_files', staticmethod(fail_broken_video_cover))
+    articles_media = dict(ARTICLES_MEDIA, third=[('video', 'media/video/broken.mp4')])
+    media_payloads = dict(MEDIA_PAYLOADS, **{'media/video/broken.mp4': OTHER_VIDEO_PAYLOAD})
+    archive_path = pack_guide(media_guide(articles_media), media_payloads)
+
+    assert list(pack_guide.report['video_covers_failures']) == ['media/video/broken.mp4']
+    with ZipFile(archive_path) as zipf:
+        members = set(zipf.namelist())
+    assert set(GuidePackager._video_covers_filenames('media/video/clip.mp4')) <= members
+    assert not set(GuidePackager._video_covers_filenames('media/video/broken.mp4')) & members
+    video_rows = archive_db_rows(archive_path, tmp_path)['video_blocks']
+    videos_covers = {video_row[2]: video_row[7] for video_row in video_rows}  # video and cover sources
+    assert videos_covers == {'guides/media_guide/media/video/clip.mp4': 'guides/media_guide/media/video/clip.png',
+                             'guides/media_guide/media/video/broken.mp4': None}
+
+
+@pytest.mark.parametrize('pack_kwargs', [{'bulk_load': True}, {'bulk_load': False}, {'streaming': True},
+                                         {'incremental': True}, {'markup_spans': True}])
+def test_pack_metrics_match_progress_events_and_tables(pack_guide, tmp_path, pack_kwargs):
+    events = []
+    archive_path = pack_guide(seeded_text_guide(4), progress=events.append, **pack_kwargs)
+    metrics = pack_guide.report['metrics']
+
+    started_stages = []
+    for event in events:
+        assert set(event) == {'guide_name', 'event', 'stage', 'time'} and event['guide_name'] == 'seeded_guide'
+        if event['event'] == 'stage_started':
+            started_stages.append(event['stage'])
+        else:
+            assert event['event'] == 'stage_finished' and started_stages.pop() == event['stage']
+            assert event['time'] >= 0.0
+    assert not started_stages
+    assert {event['stage'] for event in events} == set(metrics['stages'])
+    assert {'pack', 'store_db', 'finalize_db', 'archive'} <= set(metrics['stages'])
+    tables_rows = archive_db_rows(archive_path, tmp_path)
+    assert metrics['counters']['rows_inserted'] == {table_name: len(tables_rows[table_name])
+                                                    for table_name in metrics['counters']['rows_inserted']}
+    assert metrics['profile'] is None
+    assert json.loads(PackMetrics.json_line(metrics)) == metrics
+
+
+@pytest.mark.parametrize('profiler, profile_filename', [('cprofile', 'seeded_guide.prof'),
+                                                        ('tracemalloc', 'seeded_guide.tracemalloc.txt')])
+def test_pack_profiler_dumps_profile(pack_guide, profiler, profile_filename):
+    pack_guide(seeded_text_guide(4), profiler=profiler)
+    profile = pack_guide.report['metrics']['profile']
+
+    assert profile['profiler'] == profiler
+    assert profile['path'] == os.path.join(PACK_PROFILES_PATH, profile_filename)
+    assert os.path.getsize(profile['path']) > 0
+    if profiler == 'tracemalloc':
+        assert profile['peak_traced_bytes'] > 0
+
+
+def test_rejects_unknown_profiler(pack_guide):
+    with pytest.raises(ValueError):
+        pack_guide(seeded_text_guide(4), profiler='perf')
@@ -0,0 +1,43 @@
+import itertools
+import os
+
+import media_cache
+from media_cache import MediaCache
+
+
+def test_evicts_least_recently_used_entries_with_derived_files(tmp_path, monkeypatch):
+    clock = itertools.count(1)
+    monkeypatch.setattr(media_cache.time, 'time', lambda: next(clock))
+    cache_path = str(tmp_path / 'cache' / 'media.db')
+    cover_path = str(tmp_path / 'cover.png')
+    with open(cover_path, 'wb') as f:
+        f.write(b'cover')
+    conn = MediaCache.connect(cache_path)
+    MediaCache.store_probe(conn, 'a', {'format': {'duration': '1.0'}})
+    MediaCache.store_probe(conn, 'b', {'format': {'duration': '2.0'}})
+    cached_cover_path, = MediaCache.store_derived(conn, cache_path, 'b', 'covers', [cover_path])
+    MediaCache.store_probe(conn, 'c', {'format': {'duration': '3.0'}})
+    assert MediaCache.fetch_probes(conn, ['a']) == {'a': {'format': {'duration': '1.0'}}}  # a is used last
+
+    assert MediaCache.evict(conn, max_entries=2) == 1
+    assert set(MediaCache.fetch_probes(conn, ['a', 'b', 'c'])) == {'a', 'c'}
+    assert MediaCache.fetch_derived(conn, 'b', 'covers') is None
+    assert not os.path.exists(cached_cover_path)
+    conn.close()
+
+
+def test_clear_removes_database_and_cached_files(tmp_path):
+    cache_path = str(tmp_path / 'cache' / 'media.db')
+    cover_path = str(tmp_path / 'cover.png')
+    with open(cover_path, 'wb') as f:
+        f.write(b'cover')
+    conn = MediaCache.connect(cache_path)
+    cached_cover_path, = MediaCache.store_derived(conn, cache_path, 'a', 'covers', [cover_path])
+    conn.close()
+
+    MediaCache.clear(cache_path)
+    assert not os.path.exists(cache_path)
+    assert not os.path.exists(cached_cover_path)
+    conn = MediaCache.connect(cache_path)
+    assert MediaCache.fetch_derived(conn, 'a', 'covers') is None
+    conn.close()
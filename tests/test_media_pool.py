@@ -0,0 +1,26 @@
+import pytest
+
+from media_pool import MediaPicker, MEDIA_POOL_INDEX_VERSION
+
+
+def pool_index(images_sizes, audios_sizes=(), videos_sizes=()):
+    media = {media_type: [{'filename': f'{media_type}_{entry_idx}', 'size': size, 'mtime_ns': 0, 'hash': None,
+                           'duration': None, 'width': None, 'height': None}
+                          for entry_idx, size in enumerate(sizes)]
+             for media_type, sizes in (('image', images_sizes), ('audio', audios_sizes), ('video', videos_sizes))}
+    return {'index_version': MEDIA_POOL_INDEX_VERSION, 'pool_path': 'media', 'media': media}
+
+
+@pytest.mark.parametrize('budgets', [{'audio': 1000}, {'image': 1000, 'video': 0}])
+def test_rejects_budgets_of_types_without_pool_files(budgets):
+    with pytest.raises(ValueError):
+        MediaPicker(pool_index([100, 200]), budgets)
+
+
+def test_picks_new_payloads_then_reuses_them():
+    picker = MediaPicker(pool_index([100], [300]), {'image': 250}, {'image': 2})
+    picks = [picker.pick('image') for block_idx in range(4)]
+
+    assert [variant for entry, variant in picks[:2]] == [0, 1]  # variants of the single pool file fill the budget
+    assert picker.spent['image'] == 200
+    assert all(pick in picks[:2] for pick in picks[2:])
@@ -0,0 +1,180 @@
+"""
+Xenial dummy text backends
+==========================
+
+This module contains classes synthesizing dummy texts (sentences and paragraphs of the Faker lorem words, optionally
+with kivy markups) for GuideGenerator. FakerTextBackend makes a Faker call per text, NumpyTextBackend preloads the Faker
+word list into a NumPy array and draws whole batches of texts (e.g. all texts of an article) together with their
+markups in vectorized calls. Both keep the shape of the Faker texts: number of words of a sentence and number of
+sentences of a paragraph vary by +/-40%, markups are inserted for 1/8 of the words of a text.
+
+NumPy is an optional dependency, needed only by NumpyTextBackend; install it by:
+
+    pip install -r requirements-numpy.txt
+
+Modules API and guide format is experimental and highly unstable.
+"""
+
+from abc import ABC, abstractmethod
+import random
+
+from faker.providers.lorem.en_US import Provider as LoremProvider
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+TEXT_BACKEND = 'numpy' if np is not None else 'faker'
+
+SENTENCE_NUM_WORDS = 6  # as Faker sentences
+PARAGRAPH_NUM_SENTENCES = 3  # as Faker paragraphs
+
+MARKUP_RATIO = 1 / 8
+MARKUP_TYPES = ['bold', 'italic', 'ref']
+
+
+class TextBackend(ABC):
+    @staticmethod
+    def create(text_backend, fake, seed=None):
+        """ Public method which returns text backend of given name, texts of the faker backend are drawn by the fake
+            (Faker instance), the numpy backend draws texts by its own random generator seeded with seed """
+
+        if text_backend == 'faker':
+            return FakerTextBackend(fake)
+        elif text_backend == 'numpy':
+            if np is None:
+                raise ValueError('Provided numpy text backend, but numpy is not installed.')
+            return NumpyTextBackend(seed)
+        else:
+            raise ValueError('Provided a text backend of unknown type.')
+
+    @abstractmethod
+    def words(self, nb_words):
+        """ Public method which returns list of nb_words random words """
+
+    @abstractmethod
+    def sentence(self, nb_words=SENTENCE_NUM_WORDS):
+        """ Public method which returns sentence of around nb_words words """
+
+    def paragraph(self, nb_sentences=PARAGRAPH_NUM_SENTENCES):
+        """ Public method which returns paragraph of around nb_sentences sentences """
+
+        return self.paragraphs([nb_sentences])[0]
+
+    @abstractmethod
+    def paragraphs(self, nbs_sentences, markupped=None, articles_names=None):
+        """ Public method which returns list of paragraphs of around nbs_sentences sentences; kivy markups are
+            (naively) inserted into the paragraphs flagged in markupped, ref markups target articles_names """
+
+
+class FakerTextBackend(TextBackend):
+    def __init__(self, fake):
+        self.fake = fake
+
+    def words(self, nb_words):
+        return self.fake.words(nb_words)
+
+    def sentence(self, nb_words=SENTENCE_NUM_WORDS):
+        return self.fake.sentence(nb_words=nb_words)
+
+    def paragraphs(self, nbs_sentences, markupped=None, articles_names=None):
+        markupped = markupped or [False] * len(nbs_sentences)
+        texts = []
+        for nb_sentences, text_markupped in zip(nbs_sentences, markupped):
+            text = self.fake.paragraph(nb_sentences)
+            texts.append(self._markup_text(text, articles_names) if text_markupped else text)
+        return texts
+
+    @staticmethod
+    def _markup_text(text, articles_names):
+        """ Private method (naively) inserting kivy markups to the provided text """
+
+        words = text.split()
+        for markup_idx in range(round(len(words) * MARKUP_RATIO)):
+            markup_type = random.choice(MARKUP_TYPES)
+            markup_start = random.randint(0, len(words) - 1)
+            markup_end = random.randint(markup_start, len(words) - 1)
+            if markup_type == 'bold':
+                words[markup_start] = '[b]' + words[markup_start]
+                words[markup_end] = words[markup_end] + '[/b]'
+            elif markup_type == 'italic':
+                words[markup_start] = '[i]' + words[markup_start]
+                words[markup_end] = words[markup_end] + '[/i]'
+            elif markup_type == 'ref':
+                article_ref = random.choice(articles_names)
+                words[markup_start] = f'[u][ref={article_ref}]' + words[markup_start]
+                words[markup_end] = words[markup_end] + '[/ref][/u]'
+        markupped_text = ' '.join(words)
+        return markupped_text
+
+
+class NumpyTextBackend(TextBackend):
+    WORD_LIST = None  # the Faker lorem words, loaded on the first use
+
+    def __init__(self, seed=None):
+        if NumpyTextBackend.WORD_LIST is None:
+            NumpyTextBackend.WORD_LIST = np.array(LoremProvider.word_list, dtype=object)
+        self.rng = np.random.default_rng(seed)
+
+    def words(self, nb_words):
+        return self.WORD_LIST[self.rng.integers(0, len(self.WORD_LIST), nb_words)].tolist()
+
+    def sentence(self, nb_words=SENTENCE_NUM_WORDS):
+        if nb_words <= 0:
+            return ''
+        return self._texts(np.ones(1, dtype=np.int64), self._randomize(np.array([nb_words])))[0]
+
+    def paragraphs(self, nbs_sentences, markupped=None, articles_names=None):
+        nbs_sentences = self._randomize(np.asarray(nbs_sentences, dtype=np.int64))
+        nbs_words = self._randomize(np.full(nbs_sentences.sum(), SENTENCE_NUM_WORDS))
+        markupped = np.zeros(len(nbs_sentences), dtype=bool) if markupped is None else np.asarray(markupped, bool)
+        return self._texts(nbs_sentences, nbs_words, markupped, articles_names)
+
+    def _randomize(self, numbers):
+        """ Private method which varies the numbers by +/-40% (with a minimum of 1) the way Faker does """
+
+        return np.maximum(numbers * self.rng.integers(60, 141, len(numbers)) // 100, 1)
+
+    def _texts(self, nbs_sentences, nbs_words, markupped=None, articles_names=None):
+        """ Private method which draws words of all the texts at once, capitalizes and punctuates their sentences,
+            inserts markups into the markupped texts and joins words of every text """
+
+        words = self.WORD_LIST[self.rng.integers(0, len(self.WORD_LIST), nbs_words.sum())]
+        sentences_ends = np.cumsum(nbs_words)
+        sentences_starts = sentences_ends - nbs_words
+        words[sentences_starts] = np.char.title(words[sentences_starts].astype(str)).astype(object)
+        words[sentences_ends - 1] += '.'
+
+        texts_ends = sentences_ends[np.cumsum(nbs_sentences) - 1]
+        texts_starts = np.concatenate(([0], texts_ends[:-1]))
+        if markupped is not None and markupped.any():
+            words = self._markup_words(words, texts_starts, texts_ends, markupped, articles_names)
+
+        words = words.tolist()
+        return [' '.join(words[text_start:text_end]) for text_start, text_end in zip(texts_starts, texts_ends)]
+
+    def _markup_words(self, words, texts_starts, texts_ends, markupped, articles_names):
+        """ Private method (naively) inserting kivy markups around words of the markupped texts; start and end word
+            of every markup are drawn within the same text, as by the faker backend """
+
+        texts_lengths = texts_ends - texts_starts
+        nbs_markups = np.where(markupped, np.round(texts_lengths * MARKUP_RATIO), 0).astype(np.int64)
+        markups_texts = np.repeat(np.arange(len(texts_lengths)), nbs_markups)
+        markups_lengths = texts_lengths[markups_texts]
+        markups_starts = (self.rng.random(len(markups_texts)) * markups_lengths).astype(np.int64)
+        markups_ends = markups_starts + (self.rng.random(len(markups_texts))
+                                         * (markups_lengths - markups_starts)).astype(np.int64)
+        markups_types = self.rng.integers(0, len(MARKUP_TYPES), len(markups_texts))
+
+        openings = np.array(['[b]', '[i]', None], dtype=object)[markups_types]
+        closings = np.array(['[/b]', '[/i]', '[/ref][/u]'], dtype=object)[markups_types]
+        refs = markups_types == MARKUP_TYPES.index('ref')
+        openings[refs] = [f'[u][ref={articles_names[article_idx]}]'
+                          for article_idx in self.rng.integers(0, len(articles_names), refs.sum())]
+
+        prefixes = np.full(len(words), '', dtype=object)
+        suffixes = np.full(len(words), '', dtype=object)
+        np.add.at(prefixes, texts_starts[markups_texts] + markups_starts, openings)
+        np.add.at(suffixes, texts_starts[markups_texts] + markups_ends, closings)
+        return prefixes + words + suffixes